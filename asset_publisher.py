@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+import os, shutil, threading, errno
+
+from image_cache import file_digest
+from log import log, trace
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+# ioctl of linux (btrfs, xfs, bcachefs, ...) sharing the blocks of one file with another.
+FICLONE = 0x40049409
+# errors meaning that a method does not work between these two directories.
+UNSUPPORTED = [errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY, errno.ENOSYS]
+METHODS = ['reflink', 'hardlink', 'copy_file_range', 'copy']
+
+
+class asset_publisher:
+  # Puts files (fonts, mathjax, logo, images) into the output directory with
+  # as little writing as possible: nothing if the target already has the same
+  # content, else a reflink, a hardlink, an in-kernel copy_file_range and last
+  # a plain copy, whichever works first. Targets are replaced atomically, so a
+  # hardlinked target is never written through. Safe to use from several
+  # threads.
+  on_disk = True
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.counts = {}
+    self.bytes = {}
+    # (source device, target device) pairs where a method has failed.
+    self.unsupported = set()
+
+  def publish(self, source, target):
+    st = os.stat(source)
+    if unchanged(source, target, st):
+      trace('unchanged %s', target)
+      self.count('unchanged', st.st_size)
+      return 'unchanged'
+    devices = (st.st_dev, os.stat(os.path.dirname(target) or '.').st_dev)
+    tmp_target = '{}.tmp.{}.{}'.format(target, os.getpid(), threading.get_ident())
+    for method, function in [('reflink', reflink), ('hardlink', os.link), ('copy_file_range', kernel_copy)]:
+      if (method, devices) in self.unsupported:
+        continue
+      try:
+        function(source, tmp_target)
+        break
+      except OSError as e:
+        if os.path.exists(tmp_target):
+          os.remove(tmp_target)
+        if e.errno not in UNSUPPORTED:
+          raise
+        trace('%s not possible for %s: %s', method, target, e)
+        with self.lock:
+          self.unsupported.add((method, devices))
+    else:
+      method = 'copy'
+      shutil.copyfile(source, tmp_target)
+    os.replace(tmp_target, target)
+    trace('%s %s %s', method, source, target)
+    self.count(method, st.st_size)
+    return method
+
+  def publish_data(self, data, target):
+    # for files made in memory.
+    tmp_target = '{}.tmp.{}.{}'.format(target, os.getpid(), threading.get_ident())
+    with open(tmp_target, 'wb') as f:
+      f.write(data)
+    os.replace(tmp_target, target)
+    trace('write %s', target)
+    self.count('write', len(data))
+
+  def exists(self, target):
+    return os.path.exists(target)
+
+  def count(self, method, size):
+    with self.lock:
+      self.counts[method] = self.counts.get(method, 0)+1
+      self.bytes[method] = self.bytes.get(method, 0)+size
+
+  @property
+  def bytes_avoided(self):
+    # bytes that did not have to be written to disk.
+    return sum(self.bytes.get(m, 0) for m in ['unchanged', 'reflink', 'hardlink'])
+
+  def report(self):
+    if len(self.counts) == 0:
+      return
+    log.info('assets: %s', ', '.join('{} {}'.format(n, m) for m,n in self.counts.items()))
+    log.info('assets: %.1f MB of %.1f MB not written', self.bytes_avoided/(1<<20), sum(self.bytes.values())/(1<<20))
+
+
+class memory_publisher(asset_publisher):
+  # For build() of the library api: keeps the files in assets, by path
+  # relative to root (the deck's output directory), or hands each one to
+  # writer(path, data) as soon as it is complete. Nothing is written to disk.
+  # writer is called from one thread at a time.
+  on_disk = False
+
+  def __init__(self, root, writer=None):
+    super().__init__()
+    self.root = root
+    self.writer = writer
+    self.assets = {}
+    self.published = set()
+
+  def name(self, target):
+    return os.path.relpath(target, self.root).replace(os.sep, '/')
+
+  def exists(self, target):
+    return self.name(target) in self.published
+
+  def publish(self, source, target):
+    with open(source, 'rb') as f:
+      self.publish_data(f.read(), target)
+    return 'memory'
+
+  def publish_data(self, data, target):
+    name = self.name(target)
+    with self.lock:
+      self.published.add(name)
+      if self.writer is None:
+        self.assets[name] = data
+      else:
+        self.writer(name, data)
+    self.count('memory', len(data))
+
+
+def unchanged(source, target, st):
+  try:
+    target_st = os.stat(target)
+  except OSError:
+    return False
+  if (target_st.st_dev, target_st.st_ino) == (st.st_dev, st.st_ino):
+    return True
+  return target_st.st_size == st.st_size and file_digest(target) == file_digest(source)
+
+
+def reflink(source, target):
+  if fcntl is None:
+    raise OSError(errno.ENOTSUP, 'no fcntl')
+  with open(source, 'rb') as src, open(target, 'wb') as dst:
+    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def kernel_copy(source, target):
+  if not hasattr(os, 'copy_file_range'):
+    raise OSError(errno.ENOSYS, 'no copy_file_range')
+  with open(source, 'rb') as src, open(target, 'wb') as dst:
+    while os.copy_file_range(src.fileno(), dst.fileno(), 1<<30) > 0:
+      pass
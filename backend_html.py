@@ -12,20 +12,41 @@
 # this program. If not, see <https://www.gnu.org/licenses/>.
 
 
-import os, os.path, shutil, re, time
+import os, os.path, shutil, re, time, hashlib, tempfile
 from lxml import etree as ET
 from markdown2 import markdown
-from lxml.html.soupparser import fromstring
-from PIL import Image
+from lxml.html import fragment_fromstring
+from PIL import Image, features
 from urllib.parse import urlparse
 import requests
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from image_cache import file_digest
+from asset_publisher import asset_publisher
+from font_subset import subset_woff2, subset_woff2_data
+from formula_renderer import formula_renderer
+from profiler import build_profiler
+from log import log, trace
 
 treat_as_raster_images = ['svg']
 DOWNSCALE_SLACK = 0.75
+WEBP_QUALITY = 80
+PILLOW_WEBP = features.check('webp')
+# depth of the page divs (html > body > div#slides > page) and the comment that
+# marks where output() splices in the streamed pages.
+SLIDES_LEVEL = 3
+SLIDES_MARKER = 'pymdslides: slides'
+# rendered markdown fragments kept in memory. Footers and the pages of
+# incremental bullets render the same markdown over and over.
+MD_CACHE_SIZE = 4096
+# names of the images converted by image(): basename, content hash, then the
+# page of a pdf or the size of a downscaled variant.
+CONVERTED_IMAGE_NAME = re.compile(r'.+-[0-9a-f]{10}(-\d+|-\d+x\d+)?\.\w+')
 
 
 class backend_html:
-  def __init__(self, input_file, formatting, script_home, overwrite_images=False):
+  def __init__(self, input_file, formatting, script_home, overwrite_images=False, jobs=1, image_cache=None, lazy_images=True, virtual_slides=False, subset_fonts=True, prerender_math=False, stream=True, minify=False, site_assets=None, publisher=None, profiler=None, disk_caches=True):
     self.html_output_filename = os.path.join(os.path.splitext(input_file)[0],'index.html')
     self.output_dir = os.path.dirname(self.html_output_filename)
     #print('output_dir',self.output_dir)
@@ -33,16 +54,31 @@ class backend_html:
       self.output_dir += '/'
     self.graphics_dir = os.path.join(self.output_dir,'graphics')
     self.resources_dir = os.path.join(self.output_dir,'resources')
-    try:
-      os.makedirs(self.graphics_dir)
-    except FileExistsError:
-      pass
-    try:
-      os.makedirs(self.resources_dir)
-    except FileExistsError:
-      pass
+    # publisher: where the output goes; a memory_publisher for the library api.
+    self.publisher = publisher or asset_publisher()
+    # profiler: the build_profiler of this build, for --profile.
+    self.profiler = profiler or build_profiler()
+    # disk_caches: whether font subsets and rendered formulas are cached in ~/.cache/pymdslides.
+    self.disk_caches = disk_caches
+    if self.publisher.on_disk:
+      try:
+        os.makedirs(self.graphics_dir)
+      except FileExistsError:
+        pass
+      try:
+        os.makedirs(self.resources_dir)
+      except FileExistsError:
+        pass
     #print('graphics_dir',self.graphics_dir)
     #print('resources_dir',self.resources_dir)
+    # site_assets: directory shared by the decks of a site, holding one
+    # content-hashed copy of the fonts, mathjax, css, javascript, logo and
+    # pointer. index.html refers to them relatively.
+    self.shared_dir = None
+    if site_assets is not None:
+      self.shared_dir = os.path.abspath(site_assets)
+      os.makedirs(self.shared_dir, exist_ok=True)
+      self.shared_url = os.path.relpath(self.shared_dir, os.path.abspath(self.output_dir or '.')).replace(os.sep, '/')
 
     self.page_width = formatting['dimensions']['page_width']
     self.page_height = formatting['dimensions']['page_height']
@@ -53,7 +89,9 @@ class backend_html:
     #self.oversized_images = "DONOTDOWNSCALE"
     self.downscale_resolution_width = 3840
     self.downscale_resolution_height = self.downscale_resolution_width*(self.page_height/self.page_width)
-    print(self.oversized_images, self.downscale_resolution_width, self.downscale_resolution_height)
+    # viewport widths that get their own, smaller, image variants (srcset).
+    self.srcset_widths = [640, 1280, 1920]
+    trace('%s %s %s', self.oversized_images, self.downscale_resolution_width, self.downscale_resolution_height)
 
     self.input_file_name = input_file
     self.x = formatting['dimensions']['page_margins']['x0']
@@ -66,10 +104,18 @@ class backend_html:
     self.current_title_tag = None
     self.current_subtitle_tag = None
     self.current_page_div = None
+    self.current_page_outer_div = None
     self.current_footer_div = None
     self.font_files = {}
     self.font_names = {}
     self.font_sizes = {}
+    # ttf source and full woff2 for each file in resources_dir, written by write_fonts().
+    self.font_sources = {}
+    # subsets differ from deck to deck, so shared fonts are complete.
+    self.subset_fonts = subset_fonts and self.shared_dir is None
+    self.used_codepoints = set()
+    # files referred to by the pages, see collect_media().
+    self.used_media = set()
     for font_cat in ['title', 'standard', 'footer']:
       if 'fonts' in formatting and 'font_file_{}'.format(font_cat) in formatting['fonts']:
         ttf_file = formatting['fonts']['font_file_{}'.format(font_cat)]
@@ -78,16 +124,18 @@ class backend_html:
           fontname = formatting['fonts']['font_name_{}'.format(font_cat)]
         woff2_file = change_filename_extension(ttf_file, 'woff2')
         if not os.path.exists(os.path.join(script_home,woff2_file)):
-          print(os.path.join(script_home,woff2_file), 'not found. Will try to convert ttf file.')
+          log.info('%s not found. Will try to convert ttf file.', os.path.join(script_home,woff2_file))
           from fontTools.ttLib import TTFont
           f = TTFont(os.path.join(script_home,ttf_file))
           f.flavor='woff2'
           f.save(os.path.join(script_home,woff2_file))
-        if self.resources_dir is not None:
-          shutil.copy(os.path.join(script_home,woff2_file), self.resources_dir)
-          self.font_files[font_cat] = os.path.join(self.resources_dir,os.path.basename(woff2_file))
-          # strip base dir (container of index file):
-          self.font_files[font_cat] = '/'.join(self.font_files[font_cat].split('/')[1:])
+        if self.shared_dir is not None:
+          # relative to the css, which is in the same directory.
+          self.font_files[font_cat] = self.shared_asset(os.path.join(script_home,woff2_file))
+        elif self.resources_dir is not None:
+          target_font_file = os.path.join(self.resources_dir,os.path.basename(woff2_file))
+          self.font_sources[target_font_file] = (os.path.join(script_home,ttf_file), os.path.join(script_home,woff2_file))
+          self.font_files[font_cat] = self.output_url(target_font_file)
         else:
           self.font_files[font_cat] = woff2_file
         self.font_names[font_cat] = fontname
@@ -101,22 +149,34 @@ class backend_html:
     mathjax_url = 'https://cdn.jsdelivr.net/npm/mathjax@3/es5/tex-mml-svg.js'
     mathjax_local_file = os.path.join(script_home, 'mathjax', 'tex-mml-svg.js')
     if not os.path.exists(mathjax_local_file):
-      print('Downloading mathjax to local storage...')
+      log.info('Downloading mathjax to local storage...')
       response = requests.get(mathjax_url)
-      print(response)
+      log.debug('%s', response)
       os.makedirs(os.path.dirname(mathjax_local_file))
       with open(mathjax_local_file, 'wb') as f:
         f.write(response.content)
-    if self.resources_dir is not None:
+    self.formula_renderer = None
+    if prerender_math:
+      try:
+        self.formula_renderer = formula_renderer(profiler=self.profiler, disk_cache=disk_caches)
+      except ImportError:
+        log.warning('matplotlib not found, formulas are left to MathJax.')
+    # set when a page taken from the build cache has formulas for MathJax.
+    self.cached_mathjax_formulas = False
+    self.mathjax_local_file = mathjax_local_file
+    self.target_mathjax_path = None
+    if self.shared_dir is not None:
+      mathjax_url = self.shared_url+'/'+self.shared_asset(mathjax_local_file)
+    elif self.resources_dir is not None:
       target_mathjax_path = os.path.join(self.resources_dir, os.path.basename(mathjax_local_file))
-      shutil.copy(mathjax_local_file, target_mathjax_path)
-      print('copy', mathjax_local_file, target_mathjax_path)
-      # strip base dir (container of index file):
-      target_mathjax_path = '/'.join(target_mathjax_path.split('/')[1:])
-      mathjax_url = target_mathjax_path
+      self.target_mathjax_path = target_mathjax_path
+      # with pre-rendered formulas, output() decides whether mathjax is needed at all.
+      if self.formula_renderer is None:
+        self.publisher.publish(mathjax_local_file, target_mathjax_path)
+      mathjax_url = self.output_url(target_mathjax_path)
     else:
       mathjax_url = mathjax_local_file
-      print('mathjax_url',mathjax_local_file)
+      log.debug('mathjax_url %s', mathjax_local_file)
       
       
 
@@ -133,14 +193,17 @@ class backend_html:
 @font-face {{
   font-family: "{}";
   src: url('{}') format('woff2');
+  font-display: swap;
 }}
 @font-face {{
   font-family: "{}";
   src: url('{}') format('woff2');
+  font-display: swap;
 }}
 @font-face {{
   font-family: "{}";
   src: url('{}') format('woff2');
+  font-display: swap;
 }}
 body {{
   overflow: hidden;
@@ -178,6 +241,12 @@ h4 {{
 .page_hidden {{
   visibility: hidden;
 }}
+.step_hidden {{
+  visibility: hidden;
+}}
+body.overview .page_div .step_hidden {{
+  visibility: inherit;
+}}
 div.page_div {{
   background-color: #fff;
 }}
@@ -407,6 +476,9 @@ body.overview .page_div .subcontainer {{
   .page_hidden {{
         visibility: visible;
   }}
+  .step_hidden {{
+    visibility: inherit;
+  }}
   #help_btn {{ opacity: 0; }}
 }}
 '''.format(self.font_names['title'], self.font_files['title'], self.font_names['standard'], self.font_files['standard'], self.font_names['footer'], self.font_files['footer'], self.font_names['standard'], self.font_names['title'], self.font_sizes['title'], self.font_names['title'], self.font_sizes['subtitle'], self.font_names['title'], self.font_sizes['subtitle_l3'], self.font_names['title'], self.font_sizes['subtitle_l4'], self.font_sizes['standard'], self.font_names['footer'], self.font_sizes['footer'])
@@ -421,6 +493,9 @@ var lastPage = 0;
 
 var overviewMode = false; // if you already declared this earlier, keep only one
 var helpBtnTimer = null;
+var lazyWindow = 2; // media is loaded for the current slide and this many on each side.
+var virtualSlides = false;
+var virtualWindow = 1;
 
 var initialHelpShown = false;
 
@@ -439,6 +514,96 @@ function onloadHandler() {
     initialHelpShown = true;
   }
 }
+function loadPageMedia(pageNumber) {
+  var el = document.getElementById('page-' + pageNumber);
+  if (!el) return;
+  var media = el.querySelectorAll('[data-src], [data-srcset]');
+  for (var i = 0; i < media.length; i++) {
+    var m = media[i];
+    if (m.hasAttribute('data-srcset')) {
+      m.setAttribute('srcset', m.getAttribute('data-srcset'));
+      m.removeAttribute('data-srcset');
+    }
+    if (m.hasAttribute('data-src')) {
+      m.setAttribute('src', m.getAttribute('data-src'));
+      m.removeAttribute('data-src');
+    }
+  }
+}
+function loadMediaWindow() {
+  var n = parseInt(currentPageId.split("-")[1]);
+  for (var i = n - lazyWindow; i <= n + lazyWindow; i++) {
+    loadPageMedia(i);
+  }
+}
+function loadAllMedia() {
+  for (var i = 1; i <= lastPage; i++) {
+    loadPageMedia(i);
+  }
+}
+window.addEventListener('beforeprint', function() {
+  materializeAllPages();
+  loadAllMedia();
+});
+window.addEventListener('afterprint', function() {
+  updateVirtualWindow();
+});
+
+/* With virtual slides, every slide is an inert <template>. Only the current
+   slide and virtualWindow slides on each side are instantiated. */
+function materializePage(pageNumber) {
+  var el = document.getElementById('page-' + pageNumber);
+  if (el || !virtualSlides) return el;
+  var t = document.getElementById('template-page-' + pageNumber);
+  if (!t) return null;
+  el = t.content.firstElementChild.cloneNode(true);
+  t.parentNode.insertBefore(el, t); // keep document order for the overview grid
+  if (overviewMode) el.addEventListener('click', overviewClickHandler);
+  if (window.MathJax && MathJax.typesetPromise) MathJax.typesetPromise([el]);
+  return el;
+}
+function materializeAllPages() {
+  for (var i = 1; i <= lastPage; i++) {
+    materializePage(i);
+  }
+}
+function updateVirtualWindow() {
+  if (!virtualSlides || overviewMode) return;
+  var n = parseInt(currentPageId.split("-")[1]);
+  for (var i = 1; i <= lastPage; i++) {
+    if (Math.abs(i - n) <= virtualWindow) {
+      materializePage(i);
+    }
+    else {
+      var el = document.getElementById('page-' + i);
+      if (el) el.remove();
+    }
+  }
+}
+
+/* Incremental bullets in steps mode: list items carry data-step, the page
+   data-steps (their count) and data-shown (how many are revealed). */
+function showSteps(el, shown) {
+  if (!el || !el.hasAttribute('data-steps')) return;
+  var steps = parseInt(el.getAttribute('data-steps'));
+  shown = Math.max(1, Math.min(shown, steps));
+  el.setAttribute('data-shown', shown);
+  var items = el.querySelectorAll('[data-step]');
+  for (var i = 0; i < items.length; i++) {
+    if (parseInt(items[i].getAttribute('data-step')) > shown) items[i].classList.add('step_hidden');
+    else items[i].classList.remove('step_hidden');
+  }
+}
+function changeStep(delta) {
+  // returns true if the current page had a step left in that direction.
+  var el = document.getElementById(currentPageId);
+  if (!el || !el.hasAttribute('data-steps')) return false;
+  var shown = parseInt(el.getAttribute('data-shown')) + delta;
+  if (shown < 1 || shown > parseInt(el.getAttribute('data-steps'))) return false;
+  showSteps(el, shown);
+  return true;
+}
+
 function showHelpBtn() {
   var b = document.getElementById('help_btn');
   if (b) b.classList.remove('hidden');
@@ -507,6 +672,8 @@ function enterOverview() {
 
   showHelpBtn();           // <— keep button visible in overview
   hideHelpPanel();         // <— close panel when mode changes
+  materializeAllPages();
+  loadAllMedia();
 
   // make all slides visible and clickable
   for (var i = 1; i <= lastPage; i++) {
@@ -554,6 +721,8 @@ function exitOverview() {
       el.classList.add('page_hidden');
     }
   }
+  updateVirtualWindow();
+  loadMediaWindow();
 }
 
 function toggleOverview() {
@@ -610,12 +779,14 @@ function prevPage(){
   //alert('prevPage')
   if (overviewMode) return;  // do nothing in overview
   hideHelpPanel();
+  if (changeStep(-1)) return;
   splits = currentPageId.split("-");
   currentPageNumber = parseInt(splits[1]);
   prevPageNumber = currentPageNumber-1;
   pageId = "page-"+prevPageNumber;
-  element = document.getElementById(pageId);
+  element = materializePage(prevPageNumber);
   if (element) {
+    showSteps(element, Infinity); // coming back, all bullets are revealed
     document.getElementById(currentPageId).classList.remove('page_visible');
     document.getElementById(currentPageId).classList.add('page_hidden');
     document.getElementById(pageId).classList.remove('page_hidden');
@@ -624,18 +795,22 @@ function prevPage(){
     //document.getElementById(pageId).style.visibility="visible";
     currentPageId = pageId;
     window.location.hash = pageId;
+    updateVirtualWindow();
+    loadMediaWindow();
   }
 }
 function nextPage(){
   //alert('nextPage')
   if (overviewMode) return;  // do nothing in overview
   hideHelpPanel();
+  if (changeStep(1)) return;
   splits = currentPageId.split("-");
   currentPageNumber = parseInt(splits[1]);
   nextPageNumber = currentPageNumber+1;
   pageId = "page-"+nextPageNumber;
-  element = document.getElementById(pageId);
+  element = materializePage(nextPageNumber);
   if (element) {
+    showSteps(element, 1);
     document.getElementById(currentPageId).classList.remove('page_visible');
     document.getElementById(currentPageId).classList.add('page_hidden');
     document.getElementById(pageId).classList.remove('page_hidden');
@@ -644,15 +819,20 @@ function nextPage(){
     //document.getElementById(pageId).style.visibility="visible";
     currentPageId = pageId;
     window.location.hash = pageId;
+    updateVirtualWindow();
+    loadMediaWindow();
   }
 }
 function goToPage(pageId){
   //alert(pageId);
   hideHelpPanel();
-  if (!document.getElementById(pageId)){
+  if (!materializePage(parseInt(pageId.split("-")[1]))){
     //alert(pageId+": page not found")
     pageId = "page-1";
+    materializePage(1);
   }
+  materializePage(parseInt(currentPageId.split("-")[1]));
+  showSteps(document.getElementById(pageId), 1);
   document.getElementById(currentPageId).classList.remove('page_visible');
   document.getElementById(currentPageId).classList.add('page_hidden');
   document.getElementById(pageId).classList.remove('page_hidden');
@@ -661,6 +841,8 @@ function goToPage(pageId){
   //document.getElementById(pageId).style.visibility="visible";
   currentPageId = pageId;
   window.location.hash = pageId;
+  updateVirtualWindow();
+  loadMediaWindow();
   setCurrentMarker();
 }
 function localPageLink(pageId, event){
@@ -743,16 +925,49 @@ document.onkeydown = function(event) {
     self.html = ET.Element('html')
     self.head = ET.Element('head')
     self.html.append(self.head)
-    self.doc_style = ET.Element('style')
-    #self.doc_style.set('media', 'screen')
-    self.doc_style.text = screen_css
+    if self.shared_dir is not None:
+      self.doc_style = ET.Element('link')
+      self.doc_style.set('rel', 'stylesheet')
+      self.doc_style.set('href', self.shared_url+'/'+self.shared_asset(data=screen_css, name='pymdslides.css'))
+    else:
+      self.doc_style = ET.Element('style')
+      #self.doc_style.set('media', 'screen')
+      self.doc_style.text = screen_css
     self.head.append(self.doc_style)
     self.title = ET.Element('title')
     self.title.text = 'PYMD HTML SLIDES'
     self.head.append(self.title)
+    # preload links by font url, renamed by write_fonts().
+    self.font_preloads = {}
+    for font_file in sorted(set(self.font_files.values())):
+      if self.shared_dir is not None:
+        font_file = self.shared_url+'/'+font_file
+      if font_file.startswith('resources/') or self.shared_dir is not None:
+        preload = ET.Element('link')
+        preload.set('rel', 'preload')
+        preload.set('href', font_file)
+        preload.set('as', 'font')
+        preload.set('type', 'font/woff2')
+        preload.set('crossorigin', 'anonymous')
+        self.head.append(preload)
+        self.font_preloads[font_file] = preload
     self.script = ET.Element('script')
-    self.script.text = default_javascript
-    self.head.append(self.script)
+    if self.shared_dir is not None:
+      # the settings of this deck stay inline, the rest is shared.
+      pointer_url = self.shared_url+'/'+self.shared_asset(os.path.join(script_home, 'pointer.png'))
+      shared_javascript = default_javascript.replace('var lastPage = 0;\n', '').replace('var virtualSlides = false;\n', '')
+      shared_javascript = shared_javascript.replace('includes("pointer.png")', 'includes(pointerImage)').replace('"url(\'graphics/pointer.png\'), auto"', '"url(\'" + pointerImage + "\'), auto"')
+      self.script.text = 'var lastPage = 0;\nvar virtualSlides = {};\nvar pointerImage = "{}";\n'.format('true' if virtual_slides else 'false', pointer_url)
+      self.head.append(self.script)
+      shared_script = ET.Element('script')
+      shared_script.set('src', self.shared_url+'/'+self.shared_asset(data=shared_javascript, name='pymdslides.js'))
+      shared_script.text = ' '
+      self.head.append(shared_script)
+    else:
+      if virtual_slides:
+        default_javascript = default_javascript.replace('var virtualSlides = false;', 'var virtualSlides = true;')
+      self.script.text = default_javascript
+      self.head.append(self.script)
     mathjax0 = ET.Element('script')
     mathjax0.text = '''
 MathJax = {
@@ -775,6 +990,7 @@ MathJax = {
     mathjax2.set('src', mathjax_url)
     mathjax2.text = ' '
     self.head.append(mathjax2)
+    self.mathjax_scripts = [mathjax0, mathjax2]
 
     self.body = ET.Element('body')
     self.slides_container = ET.Element('div')
@@ -827,27 +1043,72 @@ MathJax = {
     loading_subdiv.append(loading_span7)
     loading_subdiv.append(loading_span8)
     self.body.append(loading_div)
+    # the spool file is written next to the output.
+    self.stream = stream and self.publisher.on_disk
+    self.minify = minify
+    self.slides_spool = None
+    self.slides_spool_filename = os.path.join(self.output_dir, '.'+os.path.basename(self.html_output_filename)+'.slides.tmp')
     self.overwrite_images = overwrite_images
+    self.jobs = max(1, jobs)
+    self.image_jobs = {}
+    # targets of the variants queued with another image's job, see add_image_variants().
+    self.image_variants = set()
+    self.image_cache = image_cache
+    self.lazy_images = lazy_images
+    self.virtual_slides = virtual_slides
     self.onload_added = False
-    new_filename = os.path.join(self.graphics_dir,'pointer.png')
-    shutil.copyfile(os.path.join(script_home, 'pointer.png'), new_filename)
+    if self.shared_dir is None:
+      new_filename = os.path.join(self.graphics_dir,'pointer.png')
+      self.publisher.publish(os.path.join(script_home, 'pointer.png'), new_filename)
+
+  def shared_asset(self, filename=None, data=None, name=None):
+    # stores a file (or text) in the shared directory under a name with its
+    # content hash, unless it is already there, and returns that name.
+    if data is not None:
+      data = data.encode('utf-8')
+      digest = hashlib.sha256(data).hexdigest()
+    else:
+      digest = file_digest(filename)
+      name = os.path.basename(filename)
+    stem, ext = os.path.splitext(name)
+    hashed_name = '{}-{}{}'.format(stem, digest[:12], ext)
+    target = os.path.join(self.shared_dir, hashed_name)
+    if not os.path.exists(target):
+      if data is not None:
+        tmp_filename = target+'.tmp.{}'.format(os.getpid())
+        with open(tmp_filename, 'wb') as f:
+          f.write(data)
+        os.replace(tmp_filename, target)
+      else:
+        self.publisher.publish(filename, target)
+      log.debug('shared asset %s', target)
+    return hashed_name
 
 
   def set_logo(self, logo, x, y, w, h):
     #print('setting_logo', str(logo))
     new_filename = logo
-    #if self.graphics_dir is not None:
-    new_filename = os.path.join(self.graphics_dir,os.path.basename(logo))
-    shutil.copyfile(logo, new_filename)
-
-    # strip base dir (container of index file):
-    new_filename = '/'.join(new_filename.split('/')[1:])
+    if self.shared_dir is not None:
+      new_filename = self.shared_url+'/'+self.shared_asset(logo)
+    else:
+      #if self.graphics_dir is not None:
+      new_filename = os.path.join(self.graphics_dir,os.path.basename(logo))
+      self.publisher.publish(logo, new_filename)
+      new_filename = self.output_url(new_filename)
     self.logo = new_filename
     self.logo_x = x
     self.logo_y = y
     self.logo_w = w
     self.logo_h = h
 
+  def md_to_html(self, md):
+    with self.profiler.timer('markdown'):
+      return md_to_html(md, self.formula_renderer)
+
+  def output_url(self, filename):
+    # a file in the output directory, as the index file refers to it.
+    return os.path.relpath(filename, self.output_dir).replace(os.sep, '/')
+
   def html_x(self, x):
     x_frac = x/self.page_width
     #return str(round(x_frac*100))+'%'
@@ -891,7 +1152,8 @@ MathJax = {
     self.override_font_size = {} # override fonts are per page.
     self.pages_count += 1
     self.current_page_div = ET.Element('div')
-    self.slides_container.append(self.current_page_div)
+    self.append_page_div(self.current_page_div)
+    self.current_page_outer_div = self.current_page_div
     self.current_page_div.set('id', 'page-{}'.format(self.pages_count))
     html_class = 'page_div page_hidden'
     style = ''
@@ -918,6 +1180,108 @@ MathJax = {
       style = 'position: absolute; left: {}; top: {}; width: {}; height: {}; z-index: 5;'.format(self.html_x(self.logo_x),self.html_y(self.logo_y),self.html_x(self.logo_w),self.html_y(self.logo_h))
       logo_img.set('style', style)
       self.current_page_div.append(logo_img)
+    # font changes for the new page must not touch the tags of the previous one.
+    self.current_title_tag = None
+    self.current_subtitle_tag = None
+    self.current_footer_div = None
+    return True
+
+  def add_incremental_steps(self):
+    # incremental bullets in steps mode: the page is emitted once, and the
+    # viewer reveals one list item per step. The first item is visible from the start.
+    items = [li for li in self.current_page_div.iter('li') if not any([a.get('class') == 'footer' for a in li.iterancestors()])]
+    if len(items) < 2:
+      return False
+    self.current_page_outer_div.set('data-steps', str(len(items)))
+    self.current_page_outer_div.set('data-shown', '1')
+    for i,li in enumerate(items):
+      li.set('data-step', str(i+1))
+      if i > 0:
+        li.set('class', 'step_hidden')
+    return True
+
+  def append_page_div(self, page_div):
+    self.flush_pages()
+    if self.virtual_slides:
+      # inert until the viewer instantiates it, see materializePage().
+      template = ET.Element('template')
+      template.set('id', 'template-page-{}'.format(self.pages_count))
+      template.append(page_div)
+      self.slides_container.append(template)
+    else:
+      self.slides_container.append(page_div)
+
+  def flush_pages(self):
+    # streaming output: finished pages are serialized to a spool file next to
+    # the output and dropped from the tree, so memory does not grow with the
+    # deck. output() splices the spool into the document.
+    if not self.stream:
+      return
+    for page in list(self.slides_container):
+      self.collect_codepoints(page)
+      self.collect_media(page)
+      self.ensure_closing_tags(page)
+      if self.slides_spool is None:
+        self.slides_spool = open(self.slides_spool_filename, 'w')
+      elif not self.minify:
+        self.slides_spool.write('\n'+'\t'*SLIDES_LEVEL)
+      if not self.minify:
+        ET.indent(page, space='\t', level=SLIDES_LEVEL)
+      self.slides_spool.write(ET.tostring(page, method='html', encoding='unicode', with_tail=False))
+      self.slides_container.remove(page)
+
+  def collect_media(self, element):
+    # local files the pages refer to, including those of cached pages.
+    for media in element.iter('img', 'iframe'):
+      self.used_media.update(media_sources(media))
+
+  def remove_stale_images(self):
+    # converted images are named after the content of their source, so every
+    # edit of an image leaves the previous conversion behind in graphics_dir.
+    if not self.publisher.on_disk:
+      return
+    self.collect_media(self.html)
+    used = set(os.path.basename(src) for src in self.used_media)
+    removed = 0
+    for name in os.listdir(self.graphics_dir):
+      if CONVERTED_IMAGE_NAME.fullmatch(name) and name not in used:
+        os.remove(os.path.join(self.graphics_dir, name))
+        removed += 1
+    if removed > 0:
+      log.info('removed %s images no longer used from %s', removed, self.graphics_dir)
+
+  def get_page_fragment(self):
+    # serialized current page, used by the build cache.
+    if self.current_page_outer_div is None:
+      return None
+    return ET.tostring(self.current_page_outer_div, encoding='unicode', with_tail=False)
+
+  def add_cached_page(self, fragment):
+    # adds a page previously returned by get_page_fragment. Returns False
+    # (and adds nothing) if the fragment refers to graphics that are missing.
+    page_div = ET.fromstring(fragment)
+    for element in page_div.iter('img', 'iframe'):
+      for src in media_sources(element):
+        if '://' in src or src.startswith('data:'):
+          continue
+        if not self.publisher.exists(os.path.join(self.output_dir, src)):
+          return False
+    self.override_font = {}
+    self.override_font_size = {}
+    self.pages_count += 1
+    page_div.set('id', 'page-{}'.format(self.pages_count))
+    self.append_page_div(page_div)
+    self.current_page_outer_div = page_div
+    self.current_page_div = page_div[0]
+    if self.formula_renderer is not None:
+      # the formulas of the page need their symbols in this document.
+      for svg in page_div.iter('svg'):
+        if svg.get('class') == 'formula':
+          self.formula_renderer.render(svg.get('aria-label'))
+      if any('$' in t for t in page_div.itertext()):
+        self.cached_mathjax_formulas = True
+    self.current_title_tag = None
+    self.current_subtitle_tag = None
     self.current_footer_div = None
     return True
 
@@ -1102,15 +1466,13 @@ MathJax = {
          new_lines.append(line)
 
       lines = new_lines
-      formatted_lines = md_to_html('\n'.join(lines))
+      formatted_lines = self.md_to_html('\n'.join(lines))
       
       #formatted_lines = formatted_lines.replace('\n', '<br />\n')
       #if len(lines) > 0 and 'A small one' in lines[0]:
       #  print(lines)
       #  print(formatted_lines)
-      tree = fromstring(formatted_lines)
-      #print(trees)
-      for subtree in tree: # parser puts everything in an <html> root
+      for subtree in parse_html_fragment(formatted_lines):
         text_tag.append(subtree)
       self.align_tables([text_tag], align)
     else:
@@ -1129,7 +1491,7 @@ MathJax = {
       align = 'start'
     elif align == 'right':
       align = 'end'
-    print('l4_box', x, y, w, h, '---'.join(lines))
+    trace('l4_box %s %s %s %s %s', x, y, w, h, '---'.join(lines))
     text_div = ET.Element('div')
     self.current_page_div.append(text_div)
     text_tag = text_div
@@ -1145,15 +1507,14 @@ MathJax = {
       if text_vertical_align == 'bottom':
         text_vertical_align = 'flex-end'
       style += 'display: flex; align-items: {};'.format(text_vertical_align)
-    print('align', align)
+    trace('align %s', align)
     if align == 'center':
       style += 'align-items: center; '
     text_div.set('class', 'l4_box')
     text_div.set('style', style)
     if markdown_format:
-      formatted_lines = md_to_html('\n'.join(lines))
-      tree = fromstring(formatted_lines)
-      for subtree in tree: # parser puts everything in an <html> root
+      formatted_lines = self.md_to_html('\n'.join(lines))
+      for subtree in parse_html_fragment(formatted_lines):
         text_tag.append(subtree)
       self.align_tables([text_tag], align)
     else:
@@ -1190,15 +1551,15 @@ MathJax = {
       if child.tag == 'a':
         href = child.get('href')
         if len(href) > 0 and href[0] == '#':
-          print('looking for local link',href)
+          trace('looking for local link %s', href)
           try:
             page_no = int(headlines.index(href[1:].strip()))+1
-            print('found local link', page_no)
+            trace('found local link %s', page_no)
             child.set('href', '#')
             child.set('onclick', 'localPageLink("page-{}", event); return false;'.format(page_no))
             child.set('onmouseup', 'stopProp(event);')
           except ValueError:
-            print('Warning: Link to heading:',href[1:].strip(),'not found. Not linking.')
+            log.warning('Link to heading: %s not found. Not linking.', href[1:].strip())
       self.fix_local_links(child, headlines)
     
   def fix_external_links(self, tag):
@@ -1265,9 +1626,8 @@ MathJax = {
           style = self.update_css_string(style, 'font-size', self.override_font_size['subtitle'])
       h_tag.set('style', style)
     if markdown_format:
-      formatted = md_to_html(txt)
-      tree = fromstring(formatted)
-      for subtree in tree: # parser puts everything in an <html> root
+      formatted = self.md_to_html(txt)
+      for subtree in parse_html_fragment(formatted):
         text_tag.append(subtree)
     else:
       text_tag.text = txt
@@ -1314,14 +1674,16 @@ MathJax = {
     return False
 
   def image(self, file, x, y, w, h, crop_images=False, link=None):
-    print('crop', crop_images)
-    print('image', x, y, w, h, self.html_x(x), self.html_y(y), self.html_x(w), self.html_y(h))
+    trace('crop %s', crop_images)
+    trace('image %s %s %s %s %s %s %s %s', x, y, w, h, self.html_x(x), self.html_y(y), self.html_x(w), self.html_y(h))
     original_filename = file
     current_filename = file
     current_ext = os.path.splitext(current_filename)[1][1:]
     media_tag = ET.Element('img')
     style = ''
     already_copied = False
+    responsive = None
+    intrinsic_size = None
     is_video = is_video_link(file)
     page_no_is_set = False
 
@@ -1331,10 +1693,12 @@ MathJax = {
       media_tag.set('allow', 'autoplay; encrypted-media')
       media_tag.set('allowfullscreen', 'true')
       media_tag.text = ' '
-      media_tag.set('src', file)
+      self.set_media_source(media_tag, 'src', file)
     else:
       input_file = current_filename.split('#')[0]
+      # the content hash keeps images with the same basename from colliding.
       target_filename_no_ext = os.path.join(self.graphics_dir,os.path.splitext(os.path.basename(original_filename))[0])
+      target_filename_no_ext += '-'+file_digest(input_file)[:10]
       if page_no_is_set:
         target_filename_no_ext += '-'+str(page_no)
       page_no = '0'
@@ -1348,30 +1712,29 @@ MathJax = {
         if current_ext == 'pdf' and shutil.which('pdf2svg') is not None:
           target_extension = 'svg'
           target_filename = target_filename_no_ext+'-'+page_no+'.'+target_extension
-          command = 'pdf2svg {} {} {}'.format(input_file, target_filename, int(page_no)+1) # page_no is zero-indexed
+          command = ['pdf2svg', '{input}', '{output}', str(int(page_no)+1)] # page_no is zero-indexed
           current_ext = target_extension
           command_is_chosen = True
         elif current_ext == 'eps' and shutil.which('eps2svg') is not None:
           target_extension = 'svg'
           target_filename = target_filename_no_ext+'.'+target_extension
-          command = 'eps2svg {} {}'.format(input_file, target_filename)
+          command = ['eps2svg', '{input}', '{output}']
           current_ext = target_extension
           command_is_chosen = True
         if not command_is_chosen:
           if current_ext == 'pdf':
-            print('pdf: pdf2svg not found. falling back to converting to png.')
+            log.info('pdf: pdf2svg not found. falling back to converting to png.')
           if current_ext == 'eps':
-            print('eps: eps2svg not found. falling back to converting to png.')
+            log.info('eps: eps2svg not found. falling back to converting to png.')
           target_extension = 'png'
           target_filename = target_filename_no_ext+'-'+page_no+'.'+target_extension
-          command = 'magick -density 150 '+input_file+'['+page_no+'] '+target_filename
+          command = ['magick', '-density', '150', '{input}['+page_no+']', '{output}']
           current_ext = target_extension
           command_is_chosen = True
-        if not os.path.exists(target_filename) or self.overwrite_images:
-          print('image conversion:',command)
-          os.system(command)
+        if not self.publisher.exists(target_filename) or self.overwrite_images:
+          self.add_image_job(target_filename, 'command', source=input_file, command=command)
         else:
-          print('reusing image at ',target_filename)
+          trace('reusing image at %s', target_filename)
       else:
         target_extension = current_ext
         if current_ext in ['png', 'gif']:
@@ -1398,37 +1761,47 @@ MathJax = {
                 target_width_pixels = round(im_aspect*target_height_pixels)
               #print('target_width_pixels, im_w', target_width_pixels, im_w)
               if target_width_pixels < im_w*DOWNSCALE_SLACK:
-                print('image requires downscaling {}, {}x{} pixels'.format(os.path.basename(current_filename), target_width_pixels, target_height_pixels))
+                trace('image requires downscaling %s, %sx%s pixels', os.path.basename(current_filename), target_width_pixels, target_height_pixels)
                 target_filename = target_filename_no_ext+ '-{}x{}'.format(target_width_pixels, target_height_pixels)+'.'+target_extension
-                print('target_filename', target_filename)
-                print('exists', os.path.exists(target_filename), 'overwrite', self.overwrite_images)
-                if not os.path.exists(target_filename) or self.overwrite_images:
-                  im = im.resize((target_width_pixels, target_height_pixels))
-                  im.save(target_filename)
-                  print('saved image at ', target_filename)
+                trace('target_filename %s', target_filename)
+                trace('exists %s overwrite %s', self.publisher.exists(target_filename), self.overwrite_images)
+                if not self.publisher.exists(target_filename) or self.overwrite_images:
+                  self.add_image_job(target_filename, 'pillow', source=current_filename, size=(target_width_pixels, target_height_pixels))
                 else:
-                  print('reusing image at ',target_filename)
+                  trace('reusing image at %s', target_filename)
                 already_copied = True
+                responsive = (target_width_pixels, target_height_pixels, target_width_pixels)
+                intrinsic_size = (target_width_pixels, target_height_pixels)
+              else:
+                responsive = (target_width_pixels, target_height_pixels, im_w)
+                intrinsic_size = (im_w, im_h)
         if not already_copied:
-          print('exists', os.path.exists(target_filename), 'overwrite', self.overwrite_images)
-          if not os.path.exists(target_filename) or self.overwrite_images:
+          trace('exists %s overwrite %s', self.publisher.exists(target_filename), self.overwrite_images)
+          if not self.publisher.exists(target_filename) or self.overwrite_images:
             if target_extension != current_ext:
-              command = 'magick -define webp:lossless=false '+current_filename+' '+target_filename
+              command = ['magick', '-define', 'webp:lossless=false', '{input}', '{output}']
               #if target_extension == 'webp':
-              #  command = 'cwebp {} -o {}'.format(current_filename, target_filename)
+              #  command = ['cwebp', '{input}', '-o', '{output}']
               if current_ext == 'gif' and target_extension == 'webp':
-                command = 'gif2webp {} -o {}'.format(current_filename, target_filename)
-              print(command)
-              os.system(command)
+                command = ['gif2webp', '{input}', '-o', '{output}']
+              if PILLOW_WEBP:
+                # the external tools are only needed if Pillow fails on the file.
+                self.add_image_job(target_filename, 'pillow', source=current_filename, fallback_command=command)
+              else:
+                self.add_image_job(target_filename, 'command', source=current_filename, command=command)
             else:
-              shutil.copyfile(current_filename, target_filename)
-              print('copied image to ', target_filename)
+              self.add_image_job(target_filename, 'copy', source=current_filename)
           else:
-            print('reusing image at ',target_filename)
-      # strip base dir (container of index file):
-      src_filename = '/'.join(target_filename.split('/')[1:])
-      print('src_filename', src_filename)
-      media_tag.set('src', src_filename)
+            trace('reusing image at %s', target_filename)
+      src_filename = self.output_url(target_filename)
+      trace('src_filename %s', src_filename)
+      self.set_media_source(media_tag, 'src', src_filename)
+      if responsive is not None:
+        self.set_srcset(media_tag, current_filename, target_filename, target_filename_no_ext, target_extension, src_filename, *responsive)
+      if intrinsic_size is not None:
+        # lets the browser reserve the space before the image is loaded.
+        media_tag.set('width', str(intrinsic_size[0]))
+        media_tag.set('height', str(intrinsic_size[1]))
     style += 'position: absolute; left: {}; top: {}; width: {}; height: {};'.format(self.html_x(x), self.html_y(y), self.html_x(w), self.html_y(h))
     #print('image style',style)
     if crop_images == False:
@@ -1440,6 +1813,89 @@ MathJax = {
     self.set_xy(self.x, self.y+h)
     return True
 
+  def set_srcset(self, media_tag, source, target_filename, target_filename_no_ext, target_extension, src_filename, full_width_pixels, full_height_pixels, src_width_pixels):
+    # full_width_pixels is what the image needs at downscale_resolution_width.
+    # smaller variants are made for each width in srcset_widths, and the
+    # browser picks one based on the displayed size given in sizes.
+    candidates = []
+    variants = []
+    for viewport_width in self.srcset_widths:
+      if viewport_width >= self.downscale_resolution_width:
+        continue
+      variant_width = round(full_width_pixels*viewport_width/self.downscale_resolution_width)
+      variant_height = round(full_height_pixels*viewport_width/self.downscale_resolution_width)
+      if variant_width < 1 or variant_height < 1 or variant_width >= src_width_pixels*DOWNSCALE_SLACK:
+        continue
+      variant_filename = target_filename_no_ext+'-{}x{}'.format(variant_width, variant_height)+'.'+target_extension
+      if not self.publisher.exists(variant_filename) or self.overwrite_images:
+        variants.append({'target': variant_filename, 'size': (variant_width, variant_height)})
+      candidates.append('{} {}w'.format(self.output_url(variant_filename), variant_width))
+    self.add_image_variants(target_filename, source, variants)
+    if len(candidates) == 0:
+      return
+    candidates.append('{} {}w'.format(src_filename, src_width_pixels))
+    # displayed width as a fraction of the slide, which is at most 100vw wide (16:9).
+    slide_fraction = full_width_pixels/self.downscale_resolution_width
+    self.set_media_source(media_tag, 'srcset', ', '.join(candidates))
+    media_tag.set('sizes', 'calc(min(100vw, 177.78vh) * {:.3f})'.format(slide_fraction))
+
+  def set_media_source(self, media_tag, attribute, value):
+    # with lazy_images, the viewer moves data-src to src when the slide gets
+    # close to the current one.
+    if self.lazy_images:
+      attribute = 'data-'+attribute
+    media_tag.set(attribute, value)
+
+  def add_image_job(self, target_filename, kind, **kwargs):
+    # image conversions are deferred and run in parallel by convert_images().
+    # the target filename (and thereby the src attribute) is known up front.
+    if target_filename in self.image_jobs:
+      return
+    job = {'kind': kind, 'target': target_filename}
+    job.update(kwargs)
+    # for --profile, the conversion is attributed to the slide that needed it first.
+    job['slide'] = self.profiler.current_slide
+    self.image_jobs[target_filename] = job
+
+  def add_image_variants(self, target_filename, source, variants):
+    # the variants of an image are made from one decoding of the source: by
+    # the job of the full size image if Pillow converts that too, else by a
+    # job of their own.
+    variants = [v for v in variants if v['target'] not in self.image_jobs and v['target'] not in self.image_variants]
+    if len(variants) == 0:
+      return
+    self.image_variants.update(v['target'] for v in variants)
+    job = self.image_jobs.get(target_filename)
+    if job is not None and job['kind'] == 'pillow' and job['source'] == source:
+      job.setdefault('variants', []).extend(variants)
+    else:
+      self.add_image_job(variants[0]['target'], 'pillow', source=source, size=variants[0]['size'], variants=variants[1:])
+
+  def convert_images(self):
+    jobs = list(self.image_jobs.values())
+    self.image_jobs = {}
+    self.image_variants = set()
+    if len(jobs) == 0:
+      return True
+    log.info('converting %s images using %s workers', sum(len(image_job_outputs(job)) for job in jobs), self.jobs)
+    start = time.time()
+    def run(job):
+      job_start = time.perf_counter()
+      ok = run_image_job(job, self.publisher, self.image_cache, self.overwrite_images)
+      if self.profiler.enabled:
+        self.profiler.add('image_conversion', time.perf_counter()-job_start, slide=job['slide'])
+      return ok
+    with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+      results = list(executor.map(run, jobs))
+    failed = [job for job,ok in zip(jobs, results) if not ok]
+    for job in failed:
+      log.warning('image conversion failed for %s.', job['target'])
+    log.info('converted %s images in %.2f s', sum(len(image_job_outputs(job)) for job,ok in zip(jobs, results) if ok), time.time()-start)
+    if self.image_cache is not None:
+      log.info('image cache: %s hits, %s misses', self.image_cache.hits, self.image_cache.misses)
+      self.image_cache.evict()
+    return len(failed) == 0
+
   def rect_clip(self, *args, **kwargs):
     class rect_clipper:
       def __init__(self):
@@ -1473,6 +1929,52 @@ MathJax = {
     for c in T:
       self.ensure_closing_tags(c)
 
+  def collect_codepoints(self, element):
+    for text in element.itertext():
+      self.used_codepoints.update(ord(c) for c in text)
+
+  def write_fonts(self):
+    # writes each font used by the css into resources_dir, subset to the
+    # characters that occur in the deck when possible.
+    for target_font_file, (ttf_file, woff2_file) in self.font_sources.items():
+      font_file = None
+      data = None
+      if self.subset_fonts and self.disk_caches:
+        font_file = subset_woff2(ttf_file, self.used_codepoints)
+      elif self.subset_fonts:
+        data = subset_woff2_data(ttf_file, self.used_codepoints)
+      if font_file is None and data is None:
+        font_file = woff2_file
+      # the content hash in the name keeps browsers from using a cached font
+      # with other glyphs.
+      digest = file_digest(font_file) if data is None else hashlib.sha256(data).hexdigest()
+      stem, extension = os.path.splitext(target_font_file)
+      published_file = '{}-{}{}'.format(stem, digest[:12], extension)
+      if data is None:
+        self.publisher.publish(font_file, published_file)
+      else:
+        self.publisher.publish_data(data, published_file)
+      self.rename_font_url(target_font_file, published_file)
+      self.remove_old_fonts(target_font_file, published_file)
+      log.debug('font %s %s bytes', os.path.basename(published_file), os.path.getsize(font_file) if data is None else len(data))
+
+  def remove_old_fonts(self, target_font_file, published_file):
+    # the fonts of earlier builds, with other glyphs.
+    if not self.publisher.on_disk:
+      return
+    stem, extension = os.path.splitext(os.path.basename(target_font_file))
+    old_name = re.compile(re.escape(stem)+'-[0-9a-f]{12}'+re.escape(extension))
+    for name in os.listdir(self.resources_dir):
+      if old_name.fullmatch(name) and name != os.path.basename(published_file):
+        os.remove(os.path.join(self.resources_dir, name))
+
+  def rename_font_url(self, target_font_file, published_file):
+    old_url = self.output_url(target_font_file)
+    new_url = self.output_url(published_file)
+    self.doc_style.text = self.doc_style.text.replace("url('{}')".format(old_url), "url('{}')".format(new_url))
+    if old_url in self.font_preloads:
+      self.font_preloads[old_url].set('href', new_url)
+
   def set_last_page_js(self, html_source_code):
     return html_source_code.replace('var lastPage = 0;', 'var lastPage = {};'.format(self.pages_count));
 
@@ -1491,31 +1993,261 @@ MathJax = {
     #tree = ET.ElementTree(self.html)
     #ET.indent(tree, space="\t", level=0)
 
+    with self.profiler.phase('flush_slides'):
+      self.flush_pages()
+    with self.profiler.phase('image_conversion'):
+      self.convert_images()
+      self.remove_stale_images()
+    with self.profiler.phase('formulas'):
+      self.write_formulas()
+    with self.profiler.phase('fonts'):
+      self.collect_codepoints(self.body)
+      self.write_fonts()
+    self.publisher.report()
+    with self.profiler.phase('write'):
+      return self.write_output()
+
+  def write_output(self):
+    slides_marker = None
+    if self.slides_spool is not None:
+      slides_marker = ET.Comment(SLIDES_MARKER)
+      self.slides_container.append(slides_marker)
     self.ensure_closing_tags(self.html)
     self.set_onload()
 
-    print('writing file',self.html_output_filename)
+    log.info('writing file %s', self.html_output_filename)
 
-    with open(self.html_output_filename, 'w') as f:
-      #s = ET.tostring(tree, xml_declaration=True, encoding="UTF-8", doctype="<!DOCTYPE html>")
+    #s = ET.tostring(tree, xml_declaration=True, encoding="UTF-8", doctype="<!DOCTYPE html>")
+    if not self.minify:
       ET.indent(self.html, space="\t", level=0)
-      s = ET.tostring(self.html, method='html', encoding="unicode")
-      s = '<!DOCTYPE html>\n\n'+s
-      s = self.set_last_page_js(s)
-      f.write(s)
+    s = ET.tostring(self.html, method='html', encoding="unicode")
+    s = '<!DOCTYPE html>\n\n'+s
+    s = self.set_last_page_js(s)
+    if not self.publisher.on_disk:
+      self.publisher.publish_data(s.encode('utf-8'), self.html_output_filename)
+      return True
+    tmp_filename = self.html_output_filename+'.tmp'
+    with open(tmp_filename, 'w') as f:
+      if slides_marker is None:
+        f.write(s)
+      else:
+        before_slides, after_slides = s.split('<!--{}-->'.format(SLIDES_MARKER), 1)
+        f.write(before_slides)
+        self.slides_spool.close()
+        with open(self.slides_spool_filename, 'r') as spool:
+          shutil.copyfileobj(spool, f, 1<<20)
+        f.write(after_slides)
+        os.remove(self.slides_spool_filename)
+        self.slides_spool = None
+        self.slides_container.remove(slides_marker)
+    os.replace(tmp_filename, self.html_output_filename)
     # TODO: index.html shutil.copyfile(filename, os.path.join(graphics_dir, 'index.html'))
     #tree.docinfo.doctype = '<!DOCTYPE html>'
     #tree.write(args[0], encoding="utf-8", xml_declaration=True)
     return True
 
-def md_to_html(md):
+  def write_formulas(self):
+    # adds the symbols of pre-rendered formulas, and drops mathjax if no formula is left for it.
+    if self.formula_renderer is None:
+      return
+    r = self.formula_renderer
+    if len(r.symbols) > 0:
+      self.body.insert(0, r.symbols_element())
+    log.info('formulas: %s pre-rendered (%s distinct, %s from cache), %s left to MathJax', r.rendered, len(r.symbols), r.cache_hits, r.fallbacks)
+    if r.fallbacks == 0 and not self.cached_mathjax_formulas:
+      for script in self.mathjax_scripts:
+        self.head.remove(script)
+    elif self.target_mathjax_path is not None:
+      self.publisher.publish(self.mathjax_local_file, self.target_mathjax_path)
+
+def media_sources(element):
+  # all local files an img or iframe refers to, loaded or not.
+  sources = []
+  for attribute in ['src', 'data-src']:
+    if element.get(attribute) is not None:
+      sources.append(element.get(attribute))
+  for attribute in ['srcset', 'data-srcset']:
+    if element.get(attribute) is not None:
+      sources += [c.strip().split(' ')[0] for c in element.get(attribute).split(',')]
+  return sources
+
+def run_image_job(job, publisher, cache=None, overwrite=False):
+  # runs in a worker thread. the heavy lifting happens in external processes or
+  # in Pillow, both of which release the GIL.
+  try:
+    if job['kind'] == 'copy':
+      publisher.publish(job['source'], job['target'])
+      return True
+    # conversions still to do: (output, temporary file, cache key). Without a
+    # cache they go to a temporary file that then replaces the target (or is
+    # published in memory). The target may be a hardlink into the image cache,
+    # which must not be written through.
+    pending = []
+    try:
+      for output in image_job_outputs(job):
+        extension = os.path.splitext(output['target'])[1][1:]
+        if cache is None:
+          tmp_dir = os.path.dirname(output['target']) if publisher.on_disk else None
+          fd, tmp_filename = tempfile.mkstemp(dir=tmp_dir, suffix='.tmp.'+extension)
+          os.close(fd)
+          pending.append((output, tmp_filename, None))
+          continue
+        key = cache.key(output['source'], image_job_params(output))
+        cached = None if overwrite else cache.lookup(key, extension)
+        if cached is None:
+          pending.append((output, cache.new_entry_path(key, extension), key))
+        else:
+          trace('reusing cached conversion of %s', output['source'])
+          publisher.publish(cached, output['target'])
+      ok = True
+      converted = convert_image_outputs([output for output,_,_ in pending], [tmp for _,tmp,_ in pending])
+      for (output, tmp_filename, key), done in zip(pending, converted):
+        if not done or not os.path.exists(tmp_filename) or os.path.getsize(tmp_filename) == 0:
+          ok = False
+        elif cache is not None:
+          publisher.publish(cache.commit(tmp_filename, key, os.path.splitext(output['target'])[1][1:]), output['target'])
+        elif publisher.on_disk:
+          os.replace(tmp_filename, output['target'])
+        else:
+          publisher.publish(tmp_filename, output['target'])
+      return ok
+    finally:
+      for _, tmp_filename, _ in pending:
+        if os.path.exists(tmp_filename):
+          os.remove(tmp_filename)
+  except OSError as e:
+    log.warning('%s: %s', job['target'], e)
+    return False
+
+def image_job_outputs(job):
+  # a job and the srcset variants made with it, each as a job of its own.
+  outputs = [{k: v for k,v in job.items() if k != 'variants'}]
+  for variant in job.get('variants', []):
+    outputs.append({'kind': 'pillow', 'target': variant['target'], 'source': job['source'], 'size': variant['size'], 'slide': job.get('slide')})
+  return outputs
+
+def image_job_params(job):
+  # everything except the file names determines the result of a conversion.
+  params = {'kind': job['kind'], 'extension': os.path.splitext(job['target'])[1][1:]}
+  for k in ['command', 'size', 'fallback_command']:
+    if job.get(k) is not None:
+      params[k] = job[k]
+  if job['kind'] == 'pillow':
+    params['webp_quality'] = WEBP_QUALITY
+  return params
+
+def run_command(command, source, target):
+  command = [c.replace('{input}', source).replace('{output}', target) for c in command]
+  trace('image conversion: %s', ' '.join(command))
+  try:
+    return subprocess.run(command).returncode == 0
+  except FileNotFoundError:
+    log.warning('%s not found.', command[0])
+    return False
+
+def convert_image(job, target):
+  if job['kind'] == 'command':
+    return run_command(job['command'], job['source'], target)
+  elif job['kind'] == 'pillow':
+    try:
+      pillow_convert(job['source'], [(target, job.get('size'))])
+    except OSError as e:
+      if job.get('fallback_command') is None:
+        raise
+      log.info('Pillow could not convert %s (%s). Falling back to %s.', job['source'], e, job['fallback_command'][0])
+      return run_command(job['fallback_command'], job['source'], target)
+    trace('saved image at %s', target)
+    return True
+  raise ValueError('Unknown image job: '+str(job['kind']))
+
+def convert_image_outputs(outputs, targets):
+  # outputs of one job share their source; Pillow decodes it once for all.
+  if len(outputs) < 2:
+    return [convert_image(output, target) for output,target in zip(outputs, targets)]
+  try:
+    pillow_convert(outputs[0]['source'], [(target, output.get('size')) for output,target in zip(outputs, targets)])
+  except OSError:
+    # one at a time, so that a fallback command gets its chance.
+    results = []
+    for output, target in zip(outputs, targets):
+      try:
+        results.append(convert_image(output, target))
+      except OSError as e:
+        log.warning('%s: %s', output['target'], e)
+        results.append(False)
+    return results
+  trace('saved images at %s', ', '.join(targets))
+  return [True]*len(outputs)
+
+def pillow_convert(source, targets):
+  # decodes the source once and encodes it into each (target, size) of
+  # targets, downscaled to size if given, in the format given by the target
+  # extension. Animated images keep all frames unless they need resizing.
+  with Image.open(source) as original:
+    for target, size in targets:
+      im = original
+      animated = getattr(im, 'is_animated', False)
+      if animated:
+        im.seek(0)
+      if size is not None and tuple(size) != im.size:
+        if im.mode in ['P', '1', 'LA', 'PA']:
+          im = im.convert('RGBA')
+        im = im.resize(size)
+        animated = False
+      target_ext = os.path.splitext(target)[1][1:].lower()
+      if target_ext == 'webp':
+        if animated:
+          im.save(target, 'WEBP', save_all=True, lossless=False, quality=WEBP_QUALITY)
+        else:
+          im.save(target, 'WEBP', lossless=False, quality=WEBP_QUALITY)
+      else:
+        im.save(target)
+
+def md_to_html(md, formula_renderer=None):
+  html, formulas_ = render_markdown(md)
+  if len(formulas_) == 0:
+    return html
+  return md_reconstruct_math(html, formulas_, formula_renderer)
+
+@lru_cache(maxsize=MD_CACHE_SIZE)
+def render_markdown(md):
+  # the html of md with numbered placeholders for the formulas, which
+  # md_to_html puts back with the formula renderer of the build. The cache
+  # only depends on the text, so it holds nothing of a build.
   md_, formulas_ = md_extract_formulas(md)
   #print(md_)
   #print(formulas_)
   #print('md_to_html:',md_)
   html = markdown(md_, extras=['cuddled-lists', 'tables'])
-  final_output = md_reconstruct_math(html, formulas_)
-  return final_output
+  return html, tuple(formulas_)
+
+def parse_html_fragment(html):
+  # top level elements of a markdown2 result. libxml2's html parser builds the
+  # same tree as BeautifulSoup (soupparser) for this well formed input, at a
+  # fraction of the cost. Whitespace is normalized the way BeautifulSoup does it:
+  # text before the first and after the last element is dropped, and blank text
+  # outside <pre> becomes a single newline or space.
+  elements = list(fragment_fromstring(html, create_parent='div'))
+  for element in elements:
+    collapse_blank_text(element)
+  if len(elements) > 0 and collapse_blank(elements[-1].tail) in [' ', '\n']:
+    elements[-1].tail = None
+  return elements
+
+def collapse_blank_text(element):
+  if element.tag in ['pre', 'textarea']:
+    element.tail = collapse_blank(element.tail)
+    return
+  element.text = collapse_blank(element.text)
+  element.tail = collapse_blank(element.tail)
+  for child in element:
+    collapse_blank_text(child)
+
+def collapse_blank(text):
+  # only ascii whitespace counts as blank, no-break spaces are content.
+  if text is None or text == '' or text.strip(' \t\n\r\f') != '':
+    return text
+  return '\n' if '\n' in text else ' '
 
 def md_extract_formulas(md):
   md_sane_lines = []
@@ -1546,9 +2278,10 @@ def md_extract_formulas(md):
       md_sane_lines.append(line)
   return '\n'.join(md_sane_lines), formulas
 
-def md_reconstruct_math(html, formulas):
+def md_reconstruct_math(html, formulas, formula_renderer=None):
   for (n,f) in formulas:
-    html = html.replace('${}$'.format(n), f)
+    rendered = formula_renderer.render(f) if formula_renderer is not None else None
+    html = html.replace('${}$'.format(n), rendered if rendered is not None else f)
   return html
 
 def dec_to_hex_color(color, alpha=1.0):
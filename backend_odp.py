@@ -17,9 +17,13 @@ from odf.text import P, H, Span, A
 from odf.draw import Page, Frame, TextBox, Image as OdfImage, Rect
 from odf import teletype
 
+from log import log
+from profiler import build_profiler
+
 class backend_odp:
-    def __init__(self, input_file, formatting, script_home, overwrite_images=False):
+    def __init__(self, input_file, formatting, script_home, overwrite_images=False, profiler=None):
         self.doc = OpenDocumentPresentation()
+        self.profiler = profiler or build_profiler()
         self.output_filename = os.path.join(os.path.splitext(input_file)[0], 'slides.odp')
         self.script_home = script_home
         self.formatting = formatting
@@ -375,7 +379,7 @@ class backend_odp:
         # Easier to crop the bitmap itself before embedding.
         
         if not os.path.exists(file):
-            print(f"Image not found: {file}")
+            log.warning("Image not found: %s", file)
             return False
 
         try:
@@ -421,7 +425,7 @@ class backend_odp:
             self.current_page.addElement(frame)
             
         except Exception as e:
-            print(f"Error processing image {file}: {e}")
+            log.error("Error processing image %s: %s", file, e)
             return False
 
         return True
@@ -522,7 +526,7 @@ class backend_odp:
         pass
 
     def output(self):
-        print(f"Saving ODP to {self.output_filename}...")
+        log.info("Saving ODP to %s...", self.output_filename)
         self.doc.save(self.output_filename)
         return True
 
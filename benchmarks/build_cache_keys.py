@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <https://www.gnu.org/licenses/>.
+
+# Checks that the build cache notices what changes the pages: a small deck is
+# built, one input or option is changed, and the next build must render every
+# page again. An unchanged rebuild must reuse every page.
+#
+# usage: python benchmarks/build_cache_keys.py [--keep]
+
+import os, re, sys, shutil, tempfile, subprocess
+from PIL import Image
+
+script_home = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DECK = '''---
+logo_path: {logo}
+---
+
+# First slide
+
+* a bullet
+* and another one
+
+# Second slide
+
+Some text.
+
+![An image](image.png)
+'''
+
+CACHE_LINE = re.compile(r'build cache: (\d+) pages reused, (\d+) pages rendered')
+
+
+def write_image(filename, color):
+  Image.new('RGB', (64, 48), color).save(filename)
+
+
+def build(workdir, args, env):
+  # returns (pages reused, pages rendered) of a build in a fresh process.
+  p = subprocess.run([sys.executable, os.path.join(script_home, 'pymdslides.py')]+args+['deck.md'], cwd=workdir, capture_output=True, text=True, env=env)
+  m = CACHE_LINE.search(p.stdout+p.stderr)
+  if p.returncode != 0 or m is None:
+    raise RuntimeError('build failed:\n'+p.stdout+p.stderr)
+  return int(m.group(1)), int(m.group(2))
+
+
+def main():
+  workdir = tempfile.mkdtemp(prefix='pymd-cache-keys-')
+  env = dict(os.environ, XDG_CACHE_HOME=os.path.join(workdir, 'cache'))
+  logo = os.path.join(workdir, 'logo.png')
+  write_image(logo, 'red')
+  write_image(os.path.join(workdir, 'image.png'), 'blue')
+  with open(os.path.join(workdir, 'deck.md'), 'w') as f:
+    f.write(DECK.format(logo=logo))
+  site_a = os.path.join(workdir, 'site_a')
+  site_b = os.path.join(workdir, 'site_b')
+  def change_logo():
+    write_image(logo, 'green')
+    # a new mtime, even on file systems with coarse timestamps.
+    st = os.stat(logo)
+    os.utime(logo, ns=(st.st_atime_ns, st.st_mtime_ns+10**9))
+  # (what changes, options of the first build, options of the second, change between them)
+  cases = [
+    ('logo content', [], [], change_logo),
+    ('site assets directory', ['--site-assets', site_a], ['--site-assets', site_b], None),
+    ('virtual slides', [], ['--virtual-slides'], None),
+    ('minify', [], ['--minify'], None),
+    ('lazy images', [], ['--no-lazy-images'], None),
+  ]
+  failures = 0
+  build(workdir, [], env)
+  reused, rendered = build(workdir, [], env)
+  print('{:24} {} reused, {} rendered'.format('unchanged', reused, rendered))
+  if rendered != 0:
+    print('  expected every page to be reused')
+    failures += 1
+  for name, before, after, change in cases:
+    build(workdir, before, env)
+    if change is not None:
+      change()
+    reused, rendered = build(workdir, after, env)
+    print('{:24} {} reused, {} rendered'.format(name, reused, rendered))
+    if reused != 0:
+      print('  expected every page to be rendered again')
+      failures += 1
+  if '--keep' in sys.argv:
+    print('decks in {}'.format(workdir))
+  else:
+    shutil.rmtree(workdir)
+  print('cache keys: {}'.format('ok' if failures == 0 else '{} failures'.format(failures)))
+  return 0 if failures == 0 else 1
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <https://www.gnu.org/licenses/>.
+
+# Checks that pymdslides.build() can be called from several threads at once:
+# each deck is built alone first, then all of them several times from a pool
+# of threads, and every result must be the same as the one built alone.
+#
+# usage: python benchmarks/concurrent_builds.py [deck.md ...] [--threads N] [--repeat N]
+
+import os, re, sys, time, random
+from concurrent.futures import ThreadPoolExecutor
+
+script_home = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, script_home)
+import pymdslides
+
+# the build date differs between builds.
+META = re.compile(r'<meta [^>]*>')
+
+
+def build_deck(md_file):
+  with open(md_file, 'r') as f:
+    markdown_text = f.read()
+  directory = os.path.dirname(os.path.abspath(md_file))
+  result = pymdslides.build(markdown_text, assets=lambda name: os.path.join(directory, name))
+  return META.sub('', result.html), result.assets
+
+
+def main():
+  argv = sys.argv
+  threads = int(argv[argv.index('--threads')+1]) if '--threads' in argv else 4
+  repeat = int(argv[argv.index('--repeat')+1]) if '--repeat' in argv else 3
+  md_files = [a for a in argv[1:] if a.endswith('.md')]
+  if len(md_files) == 0:
+    md_files = [os.path.join(script_home, 'test', n) for n in ['test_minimal.md', 'test_table.md', 'test_incremental_bullets.md', 'test_doc.md']]
+  start = time.perf_counter()
+  expected = {md_file: build_deck(md_file) for md_file in md_files}
+  sequential_time = time.perf_counter()-start
+  jobs = md_files*repeat
+  random.shuffle(jobs)
+  start = time.perf_counter()
+  with ThreadPoolExecutor(threads) as pool:
+    results = list(pool.map(build_deck, jobs))
+  threaded_time = time.perf_counter()-start
+  mismatches = 0
+  for md_file, result in zip(jobs, results):
+    if result != expected[md_file]:
+      mismatches += 1
+      print('different result for {}'.format(md_file))
+  print('{} decks, {} builds in {} threads'.format(len(md_files), len(jobs), threads))
+  print('alone:    {:6.2f} s/build'.format(sequential_time/len(md_files)))
+  print('threaded: {:6.2f} s/build'.format(threaded_time/len(jobs)))
+  print('identical output: {}'.format('yes' if mismatches == 0 else 'no, {} mismatches'.format(mismatches)))
+  return 0 if mismatches == 0 else 1
+
+
+if __name__ == '__main__':
+  sys.exit(main())
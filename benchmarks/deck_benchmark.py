@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <https://www.gnu.org/licenses/>.
+
+# End to end build benchmark on synthetic decks. Generates decks of a given
+# scale, builds them with pymdslides (one fresh process per build), and appends
+# wall time, peak RSS, output size and per-phase timings to a JSON results file
+# that can be compared across commits.
+#
+# usage: python benchmarks/deck_benchmark.py [options]
+#        python benchmarks/deck_benchmark.py --compare results.json
+
+import os, sys, json, time, shutil, random, tempfile, subprocess, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+script_home = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HELP = '''deck_benchmark usage
+python benchmarks/deck_benchmark.py [options]
+
+options:
+  --help                 - print this message and exit
+  --scenario NAME[,NAME] - predefined scales: {scenarios} (default: small)
+  --slides N             - number of slides
+  --bullets N            - bullets per slide
+  --formulas N           - formulas per slide
+  --tables N             - a table on every Nth slide (0: no tables)
+  --images N             - images per slide
+  --image-size WxH       - resolution of the generated images
+  --incremental MODE     - incremental_bullets: false, true or steps
+  --columns N            - content columns per slide
+  --backends LIST        - comma separated, html and/or odp (default: html)
+  --repeat N             - builds per scenario and backend (default: 3)
+  --warm                 - keep build and image caches between repetitions
+  --args "ARGS"          - extra arguments for pymdslides
+  --workdir DIR          - where decks are generated (default: a temporary directory)
+  --output FILE          - results file to append to (default: benchmark_results.json)
+  --label NAME           - name of this run in the results (default: git commit)
+  --compare FILE         - print median results per label, scenario and backend, and exit
+'''
+
+SCENARIOS = {
+  'small':       {'slides': 20,  'bullets': 5,  'formulas': 1, 'tables': 5, 'images': 0, 'image_size': '1920x1080', 'incremental': 'false', 'columns': 1},
+  'large':       {'slides': 500, 'bullets': 8,  'formulas': 2, 'tables': 5, 'images': 0, 'image_size': '1920x1080', 'incremental': 'false', 'columns': 1},
+  'images':      {'slides': 20,  'bullets': 3,  'formulas': 0, 'tables': 0, 'images': 2, 'image_size': '3000x2000', 'incremental': 'false', 'columns': 1},
+  'incremental': {'slides': 50,  'bullets': 12, 'formulas': 1, 'tables': 0, 'images': 1, 'image_size': '1280x720',  'incremental': 'true',  'columns': 1},
+  'columns':     {'slides': 50,  'bullets': 8,  'formulas': 1, 'tables': 0, 'images': 0, 'image_size': '1920x1080', 'incremental': 'false', 'columns': 3},
+}
+
+# lines of the build log that mark the end of a phase, see phase_timings().
+# Only used for builds that do not write a --profile report; -v keeps the
+# per-slide lines in the log.
+PHASE_MARKERS = [
+  ('parse', ['generating page', 'reusing cached page']),
+  ('layout', ['converting ', 'writing file']),
+  ('images_and_fonts', ['writing file']),
+]
+
+FORMULAS = [r'$a = \frac{b}{c}$', r'$\sum_{i=0}^N x_i^2$', r'$\mathbf{x} = A \theta + b$', r'$e^{i \pi} + 1 = 0$', r'$\sqrt{\alpha^2 + \beta^2}$']
+WORDS = 'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et dolore magna aliqua'.split(' ')
+
+
+def get_option(name, default=None):
+  if name in sys.argv:
+    i = sys.argv.index(name)
+    if i+1 < len(sys.argv):
+      return sys.argv[i+1]
+  return default
+
+
+def generate_deck(directory, name, params, seed=0):
+  # writes name.md (and its images) into directory, returns the md filename.
+  rng = random.Random(seed)
+  os.makedirs(directory, exist_ok=True)
+  width, height = [int(v) for v in params['image_size'].split('x')]
+  # images are generated in a separate interpreter: the peak rss of this
+  # process would otherwise be inherited by every build it starts.
+  image_jobs = [(directory, '{}-image-{}.jpg'.format(name, i), width, height, rng.randint(0, 1<<30)) for i in range(params['images']*params['slides'])]
+  image_files = []
+  if len(image_jobs) > 0:
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context('spawn')) as executor:
+      image_files = list(executor.map(generate_image, *zip(*image_jobs)))
+  lines = ['# {} synthetic deck'.format(name), '']
+  for s in range(params['slides']):
+    lines.append('# Slide {}'.format(s+1))
+    lines.append('')
+    config = []
+    if params['images'] > 0:
+      config.append('layout: image_left_half')
+    if params['columns'] > 1:
+      config.append('columns: {}'.format(params['columns']))
+    if params['incremental'] != 'false':
+      config.append('incremental_bullets: {}'.format(params['incremental']))
+    if len(config) > 0:
+      lines += ['---']+config+['---', '']
+    for image_file in image_files[s*params['images']:(s+1)*params['images']]:
+      lines.append('![]({})'.format(os.path.basename(image_file)))
+    per_column = max(1, params['bullets']//params['columns'])
+    for b in range(params['bullets']):
+      if params['columns'] > 1 and b > 0 and b%per_column == 0 and b//per_column < params['columns']:
+        lines += ['', '-----', '']
+      text = ' '.join(rng.choice(WORDS) for w in range(rng.randint(3, 10)))
+      if b < params['formulas']:
+        text += ' '+FORMULAS[(s+b)%len(FORMULAS)]
+      if b%3 == 1:
+        text = '**{}**'.format(text)
+      lines.append('* '+text)
+    if params['tables'] > 0 and s%params['tables'] == 0:
+      lines += ['', '| Column 1 | Column 2 | Column 3 |', '| -------- | -------- | -------- |']
+      for r in range(3):
+        lines.append('| {} | {} | {} |'.format(rng.choice(WORDS), rng.randint(0, 1000), FORMULAS[r] if params['formulas'] > 0 else rng.choice(WORDS)))
+    lines.append('')
+  md_file = os.path.join(directory, name+'.md')
+  with open(md_file, 'w') as f:
+    f.write('\n'.join(lines))
+  return md_file
+
+
+def generate_image(directory, name, width, height, seed):
+  filename = os.path.join(directory, name)
+  if os.path.exists(filename):
+    return filename
+  from PIL import Image
+  rng = random.Random(seed)
+  # noise over a gradient, so that the image does not compress to nothing.
+  image = Image.effect_noise((width, height), 48).convert('RGB')
+  gradient = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+  tint = Image.new('RGB', (width, height), (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255)))
+  image = Image.blend(Image.blend(image, gradient, 0.5), tint, 0.3)
+  image.save(filename, quality=90)
+  return filename
+
+
+def output_size(md_file, backend):
+  output_dir = os.path.splitext(md_file)[0]
+  total = 0
+  for root, dirs, files in os.walk(output_dir):
+    for name in files:
+      if name.startswith('.pymd_build_cache'):
+        continue
+      total += os.path.getsize(os.path.join(root, name))
+  return total
+
+
+def phase_timings(events, end):
+  # events: (seconds since start, log line). Each phase ends with the first
+  # line that matches one of its markers after the previous phase ended.
+  phases = {}
+  start = 0.0
+  position = 0
+  for phase, markers in PHASE_MARKERS:
+    found = None
+    for i in range(position, len(events)):
+      if any([m in events[i][1] for m in markers]):
+        found = i
+        break
+    if found is None:
+      phases[phase] = None
+      continue
+    phases[phase] = round(events[found][0]-start, 4)
+    start = events[found][0]
+    position = found
+  phases['write'] = round(end-start, 4)
+  return phases
+
+
+def run_build(md_file, backend, extra_args, env):
+  args = [sys.executable, os.path.join(script_home, 'pymdslides.py'), '--profile', '-v']+extra_args
+  profile_file = os.path.splitext(md_file)[0]+'-profile.json'
+  if os.path.exists(profile_file):
+    os.remove(profile_file)
+  if backend == 'odp':
+    args.append('--odp')
+  args.append(os.path.basename(md_file))
+  events = []
+  start = time.perf_counter()
+  p = subprocess.Popen(args, cwd=os.path.dirname(md_file), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env, text=True)
+  for line in p.stdout:
+    events.append((time.perf_counter()-start, line))
+  pid, status, rusage = os.wait4(p.pid, 0)
+  wall = time.perf_counter()-start
+  p.returncode = os.waitstatus_to_exitcode(status)
+  result = {
+    'ok': p.returncode == 0,
+    'wall_s': round(wall, 4),
+    # ru_maxrss is in kilobytes on linux.
+    'peak_rss_mb': round(rusage.ru_maxrss/1024, 1),
+    'output_bytes': output_size(md_file, backend) if p.returncode == 0 else None,
+    'phases_s': phase_timings(events, wall),
+  }
+  # builds that support --profile report their own phases.
+  if os.path.exists(profile_file):
+    with open(profile_file, 'r') as f:
+      profile = json.load(f)
+    result['phases_s'] = profile['phases_s']
+    result['categories_s'] = profile['categories_s']
+  if not result['ok']:
+    result['error'] = ''.join(line for t,line in events[-5:]).strip()
+  return result
+
+
+def git_commit():
+  try:
+    return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=script_home, capture_output=True, text=True).stdout.strip()
+  except OSError:
+    return None
+
+
+def load_results(filename):
+  if not os.path.exists(filename):
+    return {'runs': []}
+  with open(filename, 'r') as f:
+    return json.load(f)
+
+
+def median(values):
+  values = sorted(values)
+  if len(values) == 0:
+    return None
+  return values[len(values)//2]
+
+
+def compare(filename):
+  results = load_results(filename)
+  rows = {}
+  for run in results['runs']:
+    if not run['ok']:
+      continue
+    key = (run['scenario'], run['backend'], run['label'])
+    rows.setdefault(key, []).append(run)
+  print('{:<14} {:<8} {:<16} {:>9} {:>9} {:>12}'.format('scenario', 'backend', 'label', 'wall s', 'rss MB', 'output kB'))
+  for key in sorted(rows.keys()):
+    runs = rows[key]
+    print('{:<14} {:<8} {:<16} {:>9.3f} {:>9.1f} {:>12.1f}'.format(key[0], key[1], key[2], median([r['wall_s'] for r in runs]), median([r['peak_rss_mb'] for r in runs]), median([r['output_bytes'] for r in runs])/1024))
+
+
+def main():
+  if '--help' in sys.argv:
+    print(HELP.format(scenarios=', '.join(SCENARIOS.keys())))
+    return 0
+  if '--compare' in sys.argv:
+    compare(get_option('--compare'))
+    return 0
+  results_file = os.path.abspath(get_option('--output', 'benchmark_results.json'))
+  label = get_option('--label', git_commit())
+  backends = get_option('--backends', 'html').split(',')
+  repeat = int(get_option('--repeat', '3'))
+  warm = '--warm' in sys.argv
+  extra_args = get_option('--args', '').split()
+  if not warm:
+    extra_args.append('--no-cache')
+  workdir = get_option('--workdir')
+  if workdir is None:
+    workdir = tempfile.mkdtemp(prefix='pymdslides-benchmark-')
+  workdir = os.path.abspath(workdir)
+  # config.yaml is looked up next to pymdslides.py, the image cache is kept out of ~/.cache.
+  env = dict(os.environ)
+  env['XDG_CACHE_HOME'] = os.path.join(workdir, 'cache')
+
+  results = load_results(results_file)
+  for scenario in get_option('--scenario', 'small').split(','):
+    params = dict(SCENARIOS[scenario])
+    for key in ['slides', 'bullets', 'formulas', 'tables', 'images', 'columns']:
+      params[key] = int(get_option('--'+key.replace('_', '-'), params[key]))
+    params['image_size'] = get_option('--image-size', params['image_size'])
+    params['incremental'] = get_option('--incremental', params['incremental'])
+    md_file = generate_deck(os.path.join(workdir, scenario), scenario, params)
+    print('{}: {} ({} bytes)'.format(scenario, md_file, os.path.getsize(md_file)))
+    for backend in backends:
+      for r in range(repeat):
+        if not warm:
+          shutil.rmtree(env['XDG_CACHE_HOME'], ignore_errors=True)
+          shutil.rmtree(os.path.splitext(md_file)[0], ignore_errors=True)
+        result = run_build(md_file, backend, extra_args, env)
+        run = {'label': label, 'commit': git_commit(), 'date': datetime.now().isoformat(timespec='seconds'), 'python': sys.version.split(' ')[0], 'scenario': scenario, 'params': params, 'backend': backend, 'args': extra_args, 'repetition': r}
+        run.update(result)
+        results['runs'].append(run)
+        if result['ok']:
+          print('  {} #{}: {:.3f} s, {:.1f} MB peak rss, {} output bytes, phases {}'.format(backend, r, result['wall_s'], result['peak_rss_mb'], result['output_bytes'], result['phases_s']))
+        else:
+          print('  {} #{}: build failed: {}'.format(backend, r, result['error']))
+  tmp_filename = results_file+'.tmp'
+  with open(tmp_filename, 'w') as f:
+    json.dump(results, f, indent=1)
+  os.replace(tmp_filename, results_file)
+  print('results appended to', results_file)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
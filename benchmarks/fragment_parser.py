@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <https://www.gnu.org/licenses/>.
+
+# Compares the html fragment parser used by backend_html with the BeautifulSoup
+# based soupparser it replaced, on the text blocks of a deck: both must produce
+# the same elements, and the time per block is printed for each.
+#
+# usage: python benchmarks/fragment_parser.py [deck.md] [repetitions]
+
+import os, sys, time
+from lxml import etree as ET
+from lxml.html.soupparser import fromstring as soup_fromstring
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from backend_html import md_to_html, parse_html_fragment
+
+
+def text_blocks(md_file):
+  # the markdown between headlines, roughly what pymdslides hands to textbox().
+  blocks = []
+  current = []
+  with open(md_file, 'r') as f:
+    for line in f.read().split('\n'):
+      if line.startswith('#') or line.startswith('```'):
+        if len(current) > 0:
+          blocks.append('\n'.join(current))
+        current = []
+        if line.startswith('#'):
+          blocks.append(line.lstrip('#').strip())
+      elif not line.startswith('!['):
+        current.append(line)
+  if len(current) > 0:
+    blocks.append('\n'.join(current))
+  return [b for b in blocks if b.strip() != '']
+
+
+def soup_parse(html):
+  return list(soup_fromstring(html))
+
+
+def serialize(elements):
+  return ''.join(ET.tostring(e, encoding='unicode') for e in elements)
+
+
+def timed(parse, fragments, repetitions):
+  start = time.perf_counter()
+  for i in range(repetitions):
+    for html in fragments:
+      parse(html)
+  return (time.perf_counter()-start)/(repetitions*len(fragments))
+
+
+def main():
+  script_home = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  md_file = sys.argv[1] if len(sys.argv) > 1 else os.path.join(script_home, 'test', 'test_doc.md')
+  repetitions = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+  fragments = [md_to_html(b) for b in text_blocks(md_file)]
+  mismatches = 0
+  for html in fragments:
+    if serialize(soup_parse(html)) != serialize(parse_html_fragment(html)):
+      mismatches += 1
+      print('different result for:\n'+html)
+  soup_time = timed(soup_parse, fragments, repetitions)
+  fragment_time = timed(parse_html_fragment, fragments, repetitions)
+  print('{} fragments from {}, {} repetitions'.format(len(fragments), md_file, repetitions))
+  print('soupparser:      {:8.1f} us/fragment'.format(soup_time*1e6))
+  print('fragment parser: {:8.1f} us/fragment'.format(fragment_time*1e6))
+  print('speedup:         {:8.1f}x'.format(soup_time/fragment_time))
+  print('identical output: {}'.format('yes' if mismatches == 0 else 'no, {} mismatches'.format(mismatches)))
+  return 0 if mismatches == 0 else 1
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+import os, json, hashlib
+
+from log import log
+
+# bump when the layout of the cache file or of the cached fragments changes.
+CACHE_VERSION = 2
+CACHE_FILENAME = '.pymd_build_cache.jsonl'
+
+
+class build_cache:
+  # Persistent per-deck cache of rendered slides. Keys are fingerprints of
+  # everything that goes into rendering one preprocessed page, values are the
+  # serialized page fragments produced by the backend. The cache file has a
+  # header line and then one json line per page; only the offsets of the
+  # lines are kept in memory, and the pages of a build are written out as
+  # they are rendered, so memory does not grow with the deck.
+  def __init__(self, output_dir, script_home, enabled=True):
+    self.cache_filename = os.path.join(output_dir, CACHE_FILENAME)
+    self.enabled = enabled
+    # fingerprint: offset of its line in the cache file of the last build.
+    self.offsets = {}
+    self.cache_file = None
+    # the cache file of this build, renamed over the old one by save().
+    self.new_file = None
+    self.written = set()
+    self.hits = 0
+    self.misses = 0
+    self.generator_digest = generator_digest(script_home) if enabled else None
+    if self.enabled and os.path.exists(self.cache_filename):
+      try:
+        self.load()
+      except (ValueError, OSError) as e:
+        log.warning('ignoring unreadable build cache %s: %s', self.cache_filename, e)
+        self.close()
+        self.offsets = {}
+
+  def load(self):
+    self.cache_file = open(self.cache_filename, 'rb')
+    header = json.loads(self.cache_file.readline())
+    if not isinstance(header, dict) or header.get('version') != CACHE_VERSION or header.get('generator') != self.generator_digest:
+      self.close()
+      return
+    while True:
+      offset = self.cache_file.tell()
+      line = self.cache_file.readline()
+      if not line:
+        break
+      # the fingerprint is at the start of each line, see put().
+      self.offsets[line[2:66].decode('ascii')] = offset
+
+  def close(self):
+    if self.cache_file is not None:
+      self.cache_file.close()
+      self.cache_file = None
+
+  def fingerprint(self, page, headlines, page_number, extra=None):
+    config = page.config
+    key = {
+      'lines': page.source_lines(),
+      'config': config.digest,
+      'headlines': headlines,
+      # the page number is only visible on the page if it is printed in the footer.
+      'page_number': page_number if config.get('page_numbering', False) else None,
+      'images': [file_signature(f) for f in referenced_files(page)],
+      'extra': extra,
+    }
+    s = json.dumps(key, sort_keys=True, default=str)
+    return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+  def get(self, fingerprint):
+    if not self.enabled or fingerprint not in self.offsets:
+      return None
+    try:
+      self.cache_file.seek(self.offsets[fingerprint])
+      return json.loads(self.cache_file.readline())[1]
+    except (ValueError, OSError, IndexError) as e:
+      log.warning('ignoring unreadable build cache entry in %s: %s', self.cache_filename, e)
+      return None
+
+  def put(self, fingerprint, fragment, reused=False):
+    if not self.enabled or fragment is None:
+      return
+    if reused:
+      self.hits += 1
+    else:
+      self.misses += 1
+    if fingerprint in self.written:
+      return
+    if self.new_file is None:
+      self.start_new_file()
+    # json.dumps of a list starts with '["', then the 64 hex digits.
+    self.new_file.write(json.dumps([fingerprint, fragment])+'\n')
+    self.written.add(fingerprint)
+
+  def start_new_file(self):
+    self.new_file = open(self.cache_filename+'.tmp', 'w')
+    self.new_file.write(json.dumps({'version': CACHE_VERSION, 'generator': self.generator_digest})+'\n')
+
+  def save(self):
+    # only entries used in this build are kept, so the cache does not grow with old edits.
+    if not self.enabled:
+      return
+    self.close()
+    if self.new_file is None:
+      # no pages: an empty cache.
+      self.start_new_file()
+    self.new_file.close()
+    self.new_file = None
+    os.replace(self.cache_filename+'.tmp', self.cache_filename)
+
+
+def referenced_files(page):
+  # the images of a page, named as put_images_on_page() opens them. The logo
+  # is the same on every page, and part of the cache context.
+  files = [n.src for n in page.images if n.src is not None]
+  if page.config.get('background_image'):
+    files.append(page.config['background_image'])
+  return files
+
+
+def file_signature(filename):
+  filename = filename.split('#')[0]
+  try:
+    st = os.stat(filename)
+  except OSError:
+    return [filename, None, None]
+  return [filename, st.st_mtime_ns, st.st_size]
+
+
+def generator_digest(script_home):
+  # code changes in the generator invalidate the whole cache.
+  h = hashlib.sha256()
+  for name in sorted(os.listdir(script_home)):
+    if not name.endswith('.py'):
+      continue
+    try:
+      with open(os.path.join(script_home, name), 'rb') as f:
+        h.update(f.read())
+    except OSError:
+      pass
+  return h.hexdigest()
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <https://www.gnu.org/licenses/>.
+
+# The build daemon (pymdslides.py --daemon) keeps an interpreter with the
+# backends and caches loaded, and builds decks for clients on a unix socket.
+# Run as a script, this file is the client: it forwards its arguments to the
+# daemon if one is running, and otherwise runs pymdslides.py itself. It only
+# imports the standard library, so that it starts quickly.
+#
+# Protocol: one json line from the client, {"argv": [...], "cwd": "..."};
+# then json lines from the daemon, {"out": "..."} for output and finally
+# {"exit": status}, or {"restart": true} if the daemon's code is out of date
+# and the client should build by itself.
+
+import os, sys, json, socket, struct, tempfile, traceback
+
+script_home = os.path.dirname(os.path.realpath(__file__))
+# seconds a client has to send its request, so that one that connects and
+# says nothing does not hold up the builds of the others.
+REQUEST_TIMEOUT = 10
+MAX_REQUEST_SIZE = 1<<20
+
+
+def socket_path(argv):
+  if '--socket' in argv:
+    return os.path.abspath(argv[argv.index('--socket')+1])
+  runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+  return os.path.join(runtime_dir, 'pymdslides-{}.sock'.format(os.getuid()))
+
+
+class client_stream:
+  # file-like object for logging handlers, sending each write to the client.
+  def __init__(self, conn):
+    self.conn = conn
+
+  def write(self, s):
+    send(self.conn, {'out': s})
+
+  def flush(self):
+    pass
+
+
+def send(conn, message):
+  conn.sendall(json.dumps(message).encode('utf-8')+b'\n')
+
+
+def read_request(conn):
+  # raises ValueError for anything but the request of the protocol.
+  line = conn.makefile('rb').readline(MAX_REQUEST_SIZE)
+  if not line.endswith(b'\n'):
+    raise ValueError('incomplete request')
+  request = json.loads(line)
+  if not isinstance(request, dict) or not isinstance(request.get('cwd'), str) or not isinstance(request.get('argv'), list) or not all(isinstance(a, str) for a in request['argv']):
+    raise ValueError('expected {"argv": [...], "cwd": "..."}')
+  return request
+
+
+def serve(path, build):
+  # serves until interrupted, or until the code changes. build(argv) runs one
+  # invocation in the current directory and returns its exit status.
+  # Builds run one at a time, as they change directory.
+  from build_cache import generator_digest
+  from log import log, setup_logging
+  if os.path.exists(path):
+    try:
+      with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        probe.connect(path)
+      log.error('a daemon is already listening on %s', path)
+      return 1
+    except OSError:
+      os.remove(path)
+  server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  # created private, not made private after others could connect.
+  umask = os.umask(0o077)
+  try:
+    server.bind(path)
+  finally:
+    os.umask(umask)
+  server.listen(8)
+  digest = generator_digest(script_home)
+  daemon_level = log.level
+  daemon_handlers = list(log.handlers)
+  log.info('pymdslides daemon listening on %s', path)
+  try:
+    while True:
+      conn, _ = server.accept()
+      with conn:
+        conn.settimeout(REQUEST_TIMEOUT)
+        try:
+          request = read_request(conn)
+        except OSError as e:
+          log.warning('no request from client: %s', e)
+          continue
+        except ValueError as e:
+          log.warning('malformed request: %s', e)
+          try:
+            send(conn, {'exit': 2})
+          except OSError:
+            pass
+          continue
+        conn.settimeout(None)
+        if generator_digest(script_home) != digest:
+          log.info('pymdslides has changed, the daemon stops')
+          send(conn, {'restart': True})
+          return 0
+        argv = request['argv']
+        log.info('building in %s: %s', request['cwd'], ' '.join(argv[1:]))
+        cwd = os.getcwd()
+        setup_logging(argv, client_stream(conn))
+        try:
+          os.chdir(request['cwd'])
+          status = build(argv)
+        except Exception as e:
+          log.error('build failed: %s', e)
+          log.debug(traceback.format_exc())
+          status = 1
+        finally:
+          os.chdir(cwd)
+          log.handlers = daemon_handlers
+          log.setLevel(daemon_level)
+        try:
+          send(conn, {'exit': status})
+        except OSError:
+          pass
+  except KeyboardInterrupt:
+    return 0
+  finally:
+    server.close()
+    os.remove(path)
+
+
+def peer_uid(conn):
+  # the user of the process on the other end, or None where the platform
+  # does not tell.
+  if not hasattr(socket, 'SO_PEERCRED'):
+    return None
+  credentials = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+  pid, uid, gid = struct.unpack('3i', credentials)
+  return uid
+
+
+def forward(argv, path):
+  # returns the exit status of the build in the daemon, or None if there is
+  # no daemon to do it. Only a daemon of the same user gets the build: in a
+  # shared temporary directory, anyone could have created the socket.
+  try:
+    if os.stat(path).st_uid != os.getuid():
+      sys.stderr.write('warning: {} belongs to another user, not using it\n'.format(path))
+      return None
+  except OSError:
+    return None
+  conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    conn.connect(path)
+  except OSError:
+    conn.close()
+    return None
+  if peer_uid(conn) not in [None, os.getuid()]:
+    sys.stderr.write('warning: the daemon on {} runs as another user, not using it\n'.format(path))
+    conn.close()
+    return None
+  with conn:
+    send(conn, {'argv': argv, 'cwd': os.getcwd()})
+    for line in conn.makefile('rb'):
+      message = json.loads(line)
+      if 'out' in message:
+        sys.stdout.write(message['out'])
+        sys.stdout.flush()
+      elif 'exit' in message:
+        return message['exit']
+      elif message.get('restart'):
+        return None
+  sys.stderr.write('error: the pymdslides daemon stopped during the build\n')
+  return 1
+
+
+if __name__ == "__main__":
+  argv = [os.path.join(script_home, 'pymdslides.py')]+sys.argv[1:]
+  if not any(o in argv for o in ['--daemon', '--no-daemon', '--watch', '--help']):
+    status = forward(argv, socket_path(argv))
+    if status is not None:
+      sys.exit(status)
+  os.execv(sys.executable, [sys.executable]+argv)
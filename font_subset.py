@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+import os, io, hashlib, tempfile
+
+from image_cache import file_digest, default_cache_dir
+from log import log
+
+# always kept in a subset: printable ascii and no-break space, so that text added
+# by the viewer (and small last-minute edits in the browser) still renders.
+BASE_CODEPOINTS = set(range(0x20, 0x7f)) | {0xa0}
+# bump when the subsetting options change.
+FONT_SUBSET_VERSION = 1
+
+
+def subset_woff2(font_file, codepoints, cache_dir=None):
+  # returns a woff2 file with only the glyphs for codepoints (and what the
+  # layout features need to shape them). Subsets are cached by font content and
+  # glyph set. Returns None if fontTools (or its brotli dependency) is missing.
+  try:
+    from fontTools import subset
+    import brotli
+  except ImportError:
+    return None
+  if cache_dir is None:
+    cache_dir = default_cache_dir('fonts')
+  codepoints = sorted(set(codepoints) | BASE_CODEPOINTS)
+  glyphs_digest = hashlib.sha256(','.join(str(c) for c in codepoints).encode('ascii')).hexdigest()
+  name = '{}-{}-{}-{}.woff2'.format(os.path.splitext(os.path.basename(font_file))[0], file_digest(font_file)[:16], glyphs_digest[:16], FONT_SUBSET_VERSION)
+  cached = os.path.join(cache_dir, name)
+  if os.path.exists(cached):
+    return cached
+  os.makedirs(cache_dir, exist_ok=True)
+  # unique across threads and processes subsetting the same glyphs.
+  fd, tmp_filename = tempfile.mkstemp(dir=cache_dir, prefix=name+'.', suffix='.tmp')
+  os.close(fd)
+  try:
+    save_subset(subset, font_file, codepoints, tmp_filename)
+    os.replace(tmp_filename, cached)
+  finally:
+    if os.path.exists(tmp_filename):
+      os.remove(tmp_filename)
+  log.debug('font subset: %s glyph codepoints of %s in %s', len(codepoints), os.path.basename(font_file), cached)
+  return cached
+
+
+def subset_woff2_data(font_file, codepoints):
+  # as subset_woff2, but returns the woff2 data and writes nothing.
+  try:
+    from fontTools import subset
+    import brotli
+  except ImportError:
+    return None
+  data = io.BytesIO()
+  save_subset(subset, font_file, sorted(set(codepoints) | BASE_CODEPOINTS), data)
+  return data.getvalue()
+
+
+def save_subset(subset, font_file, codepoints, target):
+  # target is a file name or a binary file object.
+  options = subset.Options()
+  options.flavor = 'woff2'
+  options.layout_features = ['*']
+  options.name_IDs = ['*']
+  options.notdef_outline = True
+  font = subset.load_font(font_file, options)
+  subsetter = subset.Subsetter(options)
+  subsetter.populate(unicodes=codepoints)
+  subsetter.subset(font)
+  subset.save_font(font, target, options)
+  font.close()
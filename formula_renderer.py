@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+import os, json, hashlib, html, tempfile
+from lxml import etree as ET
+
+from image_cache import default_cache_dir
+from profiler import build_profiler
+from log import log
+
+# bump when the generated paths or their metrics change.
+FORMULA_CACHE_VERSION = 1
+
+
+class formula_renderer:
+  # Renders $...$ formulas to svg paths at build time, using matplotlib mathtext.
+  # Paths are in units of the font size and filled with currentColor, so one
+  # rendering serves every font size and text color. Each distinct formula is
+  # emitted once as a <symbol>; occurrences refer to it with <use>. Renderings
+  # are cached in cache_dir, unless disk_cache is False.
+  def __init__(self, cache_dir=None, profiler=None, disk_cache=True):
+    import matplotlib
+    from matplotlib.textpath import TextPath
+    from matplotlib.font_manager import FontProperties
+    self.TextPath = TextPath
+    self.font_properties = FontProperties(family='DejaVu Sans')
+    self.cache_dir = cache_dir if cache_dir is not None else default_cache_dir('formulas')
+    self.disk_cache = disk_cache
+    self.profiler = profiler or build_profiler()
+    self.settings = [FORMULA_CACHE_VERSION, matplotlib.__version__, matplotlib.rcParams['mathtext.fontset']]
+    self.symbols = {}
+    self.rendered = 0
+    self.fallbacks = 0
+    self.cache_hits = 0
+
+  def render(self, formula):
+    # returns an inline svg element as html source, or None if mathtext can not
+    # handle the formula (it is then left for MathJax).
+    key = hashlib.sha256(json.dumps(self.settings+[formula]).encode('utf-8')).hexdigest()
+    symbol_id = 'formula-'+key[:16]
+    if symbol_id not in self.symbols:
+      entry = self.load(key)
+      if entry is None:
+        with self.profiler.timer('formula'):
+          entry = self.render_path(formula)
+          self.store(key, entry)
+      else:
+        self.cache_hits += 1
+      self.symbols[symbol_id] = entry
+    entry = self.symbols[symbol_id]
+    if entry.get('d') is None:
+      self.fallbacks += 1
+      return None
+    self.rendered += 1
+    return '<svg class="formula" role="img" aria-label="{}" style="width: {:.3f}em; height: {:.3f}em; vertical-align: {:.3f}em;"><use href="#{}"></use></svg>'.format(html.escape(formula, quote=True), entry['w'], entry['h'], entry['y0'], symbol_id)
+
+  def render_path(self, formula):
+    if formula.strip('$').strip() == '':
+      return {'d': None}
+    try:
+      path = self.TextPath((0, 0), formula, size=1, prop=self.font_properties)
+    except (ValueError, RuntimeError) as e:
+      log.warning('formula %s can not be pre-rendered, leaving it to MathJax: %s', formula, str(e).strip().split('\n')[0])
+      return {'d': None}
+    commands = []
+    letters = {1: 'M', 2: 'L', 3: 'Q', 4: 'C'}
+    for vertices, code in path.iter_segments(curves=True, simplify=False):
+      if code == 79:
+        commands.append('Z')
+      else:
+        # svg has the y axis pointing down.
+        points = ['{:.3f} {:.3f}'.format(vertices[i], -vertices[i+1]) for i in range(0, len(vertices), 2)]
+        commands.append(letters[int(code)]+' '.join(points))
+    extents = path.get_extents()
+    return {'d': ''.join(commands), 'x0': extents.x0, 'y0': extents.y0, 'w': extents.width, 'h': extents.height}
+
+  def load(self, key):
+    if not self.disk_cache:
+      return None
+    try:
+      with open(os.path.join(self.cache_dir, key[:2], key+'.json'), 'r') as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return None
+
+  def store(self, key, entry):
+    if not self.disk_cache:
+      return
+    filename = os.path.join(self.cache_dir, key[:2], key+'.json')
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    # unique across threads and processes rendering the same formula.
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename), prefix=key+'.', suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+      json.dump(entry, f)
+    os.replace(tmp_filename, filename)
+
+  def symbols_element(self):
+    # hidden svg holding one <symbol> per distinct formula in the document.
+    svg = ET.Element('svg')
+    # not display: none, which keeps some browsers from rendering the <use> references.
+    svg.set('style', 'position: absolute; width: 0; height: 0; overflow: hidden;')
+    svg.set('aria-hidden', 'true')
+    for symbol_id, entry in sorted(self.symbols.items()):
+      if entry.get('d') is None:
+        continue
+      symbol = ET.Element('symbol')
+      symbol.set('id', symbol_id)
+      symbol.set('viewBox', '{:.3f} {:.3f} {:.3f} {:.3f}'.format(entry['x0'], -(entry['y0']+entry['h']), entry['w'], entry['h']))
+      path = ET.Element('path')
+      path.set('d', entry['d'])
+      path.set('fill', 'currentColor')
+      symbol.append(path)
+      svg.append(symbol)
+    return svg
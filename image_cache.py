@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+import os, re, json, hashlib, threading, tempfile
+
+from log import log
+
+DEFAULT_MAX_SIZE_MB = 1024
+# bump when conversions change in a way that is not visible in the job parameters.
+IMAGE_CACHE_VERSION = 1
+# total size of the entries, kept up to date by commit() and evict().
+SIZE_FILENAME = 'size'
+# a committed entry; conversions in progress have other names, see new_entry_path().
+ENTRY_NAME = re.compile(r'[0-9a-f]{64}\.\w+')
+
+_digest_lock = threading.Lock()
+_digests = {}
+
+
+def default_cache_dir(kind='images'):
+  cache_home = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+  return os.path.join(cache_home, 'pymdslides', kind)
+
+
+def file_digest(filename):
+  # content hash of a source file, memoized on (path, mtime, size).
+  st = os.stat(filename)
+  memo_key = (os.path.realpath(filename), st.st_mtime_ns, st.st_size)
+  with _digest_lock:
+    if memo_key in _digests:
+      return _digests[memo_key]
+  h = hashlib.sha256()
+  with open(filename, 'rb') as f:
+    for block in iter(lambda: f.read(1<<20), b''):
+      h.update(block)
+  digest = h.hexdigest()
+  with _digest_lock:
+    _digests[memo_key] = digest
+  return digest
+
+
+class image_cache:
+  # Content addressed store of converted images, shared between decks. Entries
+  # are keyed by the hash of the source file and the conversion parameters,
+  # and hardlinked into the graphics directory of each deck.
+  def __init__(self, cache_dir=None, max_size_mb=DEFAULT_MAX_SIZE_MB):
+    self.cache_dir = cache_dir if cache_dir is not None else default_cache_dir()
+    self.max_size = max_size_mb*1024*1024
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+    os.makedirs(self.cache_dir, exist_ok=True)
+
+  def key(self, source, params):
+    s = json.dumps([IMAGE_CACHE_VERSION, file_digest(source), params], sort_keys=True)
+    return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+  def path(self, key, extension):
+    return os.path.join(self.cache_dir, key[:2], key+'.'+extension)
+
+  def lookup(self, key, extension):
+    # returns the cached file, marking it as recently used, or None.
+    path = self.path(key, extension)
+    try:
+      os.utime(path)
+    except FileNotFoundError:
+      with self.lock:
+        self.misses += 1
+      return None
+    with self.lock:
+      self.hits += 1
+    return path
+
+  def new_entry_path(self, key, extension):
+    # conversions write to a temporary file, unique across threads and batch
+    # worker processes, that commit() moves into place.
+    path = self.path(key, extension)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=key+'.', suffix='.tmp.'+extension)
+    os.close(fd)
+    return tmp_path
+
+  def commit(self, tmp_path, key, extension):
+    path = self.path(key, extension)
+    size = os.path.getsize(tmp_path)
+    os.replace(tmp_path, path)
+    with self.lock:
+      # other processes may commit at the same time; the recorded size is
+      # only a hint for evict(), which counts again before removing anything.
+      recorded = self.recorded_size()
+      if recorded is not None:
+        self.record_size(recorded+size)
+    return path
+
+  def recorded_size(self):
+    try:
+      with open(os.path.join(self.cache_dir, SIZE_FILENAME), 'r') as f:
+        return int(f.read())
+    except (OSError, ValueError):
+      return None
+
+  def record_size(self, size):
+    fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=SIZE_FILENAME+'.', suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+      f.write(str(size))
+    os.replace(tmp_path, os.path.join(self.cache_dir, SIZE_FILENAME))
+
+  def evict(self):
+    # least recently used entries are removed until the cache fits max_size.
+    # Only committed entries count and are removed.
+    # The cache is only walked when the size recorded by commit() is over the
+    # limit, or unknown.
+    recorded = self.recorded_size()
+    if recorded is not None and recorded <= self.max_size:
+      return 0
+    entries = []
+    total = 0
+    for root, dirs, files in os.walk(self.cache_dir):
+      for name in files:
+        # temporary files may belong to a conversion in another thread or process.
+        if not ENTRY_NAME.fullmatch(name):
+          continue
+        path = os.path.join(root, name)
+        try:
+          st = os.stat(path)
+        except FileNotFoundError:
+          continue
+        entries.append((st.st_mtime, st.st_size, path))
+        total += st.st_size
+    if total <= self.max_size:
+      self.record_size(total)
+      return 0
+    entries.sort()
+    removed = 0
+    for mtime, size, path in entries:
+      if total <= self.max_size:
+        break
+      try:
+        os.remove(path)
+      except FileNotFoundError:
+        pass
+      total -= size
+      removed += 1
+    self.record_size(total)
+    log.info('image cache: evicted %s entries from %s', removed, self.cache_dir)
+    return removed
+
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+import json, hashlib
+from collections.abc import Mapping
+
+COLOR_KEYS = ['background_color', 'text_color', 'footer_color', 'l4_box_fill_color']
+
+named_colors = {
+  'white': [255,255,255],
+  'grey': [100,100,100],
+  'black': [0,0,0],
+  'orange': [255,180,0],
+  'red': [255,0,0],
+  'green': [0,255,0],
+  'blue': [0,0,255],
+  'yellow': [255,255,0],
+  'purple': [225,0,255],
+  'pink': [255,86,235],
+  'darkorange': [180,100,0],
+  'darkred': [100,0,0],
+  'darkgreen': [0,80,45],
+  'darkblue': [0,0,100],
+  'darkpurple': [120,0,140],
+  'lightgrey': [180,180,180],
+  'lightpink': [255,155,235],
+  'lightgreen': [120,255,180],
+  'lightblue': [160,180,255],
+}
+
+
+class layered_config(Mapping):
+  # Formatting configuration as a stack of layers: the defaults, config.yaml,
+  # the preamble of the document and the yaml blocks of a slide. A layer is
+  # never modified once created; overlay() returns a new one on top of it.
+  # Values are merged when a layer is created, sharing every value the
+  # overlay does not touch with the layer below, so a slide without yaml
+  # costs nothing and lookups are plain dict lookups. Nested dicts and lists
+  # are shared between layers and must not be modified by the caller.
+  def __init__(self, values=None, parent=None, name='defaults'):
+    self.parent = parent
+    self.name = name
+    overlay = normalize(dict(values or {}), name)
+    self.values = merge(parent.values, overlay) if parent is not None else overlay
+    self._digest = None
+
+  def overlay(self, values, name=''):
+    if not values:
+      return self
+    return layered_config(values, self, name)
+
+  def __getitem__(self, key):
+    return self.values[key]
+
+  def __iter__(self):
+    return iter(self.values)
+
+  def __len__(self):
+    return len(self.values)
+
+  def __repr__(self):
+    return repr(self.values)
+
+  @property
+  def digest(self):
+    # for cache keys, computed once per layer.
+    if self._digest is None:
+      s = json.dumps(self.values, sort_keys=True, default=str)
+      self._digest = hashlib.sha256(s.encode('utf-8')).hexdigest()
+    return self._digest
+
+
+def merge(base, overlay):
+  # like updating base with overlay recursively, but base is left as it is and
+  # only the dicts on the path to an overridden value are copied.
+  merged = dict(base)
+  for k,v in overlay.items():
+    if isinstance(merged.get(k), dict) and isinstance(v, dict):
+      merged[k] = merge(merged[k], v)
+    else:
+      merged[k] = v
+  return merged
+
+
+def normalize(values, name):
+  # colors given as names or html hex strings become rgb lists.
+  for color in COLOR_KEYS:
+    value = values.get(color)
+    if isinstance(value, str):
+      if value in named_colors:
+        values[color] = list(named_colors[value])
+      elif value.startswith('#'):
+        values[color] = [int(value[1:3], 16), int(value[3:5], 16), int(value[5:7], 16)]
+  if 'dimensions' in values:
+    check_dimensions(values['dimensions'], '{}: dimensions'.format(name))
+  return values
+
+
+def check_dimensions(dimensions, path):
+  if not isinstance(dimensions, dict):
+    raise ValueError('{} must be a mapping, not {!r}'.format(path, dimensions))
+  for k,v in dimensions.items():
+    if isinstance(v, dict):
+      check_dimensions(v, path+'.'+str(k))
+    elif isinstance(v, bool) or not isinstance(v, (int, float)):
+      raise ValueError('{}.{} must be a number, not {!r}'.format(path, k, v))
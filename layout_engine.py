@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+import math, threading
+
+# credit images are placed in the bottom margin, this high relative to it.
+CRED_ASPECT_RATIO = 1.05
+CRED_FRACTION = 0.6
+
+
+class layout_engine:
+  # Geometry of the areas on a page (title, text, columns, images), in page
+  # units, for the dimensions of one document. Every result is computed once
+  # per distinct set of arguments and then shared: callers must not modify the
+  # returned dicts. Safe to use from several threads; pickles without its
+  # cache, so worker processes can get their own copy.
+  def __init__(self, dimensions):
+    self.dimensions = dimensions
+    self.cache = {}
+    self.lock = threading.Lock()
+
+  def __getstate__(self):
+    return {'dimensions': self.dimensions}
+
+  def __setstate__(self, state):
+    self.__init__(state['dimensions'])
+
+  def cached(self, key, compute, *args):
+    result = self.cache.get(key)
+    if result is None:
+      # computing twice in a race is harmless; the results are equal.
+      result = compute(*args)
+      with self.lock:
+        result = self.cache.setdefault(key, result)
+    return result
+
+  def offsets(self, layout):
+    # the area inside the page margins, used for titles.
+    return self.cached(('offsets', layout), self.compute_offsets, layout)
+
+  def text_offsets(self, layout, images=True):
+    # the area for the text, next to or below the images.
+    return self.cached(('text', layout, images), self.compute_text_offsets, layout, images)
+
+  def column_offsets(self, layout, images, num_columns, column):
+    return self.cached(('column', layout, images, num_columns, column), self.compute_column_offsets, layout, images, num_columns, column)
+
+  def image_area(self, layout, has_text):
+    return self.cached(('image_area', layout, has_text), self.compute_image_area, layout, has_text)
+
+  def image_locations(self, num_images, layout, has_text, packed_images=False, cred=False):
+    # one location (x0, y0, w, h) per image, in a grid over the image area.
+    return self.cached(('images', num_images, layout, has_text, packed_images, cred), self.compute_image_locations, num_images, layout, has_text, packed_images, cred)
+
+  def background_location(self):
+    return self.cached(('background',), lambda: {'x0': 0, 'y0': 0, 'w': self.dimensions['page_width'], 'h': self.dimensions['page_height']})
+
+  def compute_offsets(self, layout):
+    d = self.dimensions
+    m = d['page_margins']
+    if layout == 'image_left_half':
+      offsets = {'x0': (d['page_width']//2)+m['x0'], 'y0': m['y0'], 'x1': d['page_width']-m['x1'], 'y1': d['page_height']-m['y1']}
+    elif layout == 'image_right_half':
+      offsets = {'x0': m['x0'], 'y0': m['y0'], 'x1': (d['page_width']//2)-m['x1'], 'y1': d['page_height']-m['y1']}
+    else:
+      offsets = {'x0': m['x0'], 'y0': m['y0'], 'x1': d['page_width']-m['x1'], 'y1': d['page_height']-m['y1']}
+    offsets['w'] = offsets['x1']-offsets['x0']
+    offsets['h'] = offsets['y1']-offsets['y0']
+    return offsets
+
+  def compute_text_offsets(self, layout, images):
+    d = self.dimensions
+    m = d['page_margins']
+    y0 = m['y0']+d['em_title']+d['internal_margin']*2
+    if layout == 'image_center':
+      y = y0
+      if images:
+        drawable_height = (d['page_height']-m['y0']-d['em_title']-m['y1'])//2
+        y += d['internal_margin']//2
+        y += drawable_height
+      offsets = {'x0': m['x0'], 'y0': y, 'x1': d['page_width']-m['x1'], 'y1': d['page_height']-m['y1']}
+    elif layout in ['image_left_half', 'image_left_small']:
+      offsets = {'x0': (d['page_width']//2)+d['internal_margin']//2, 'y0': y0, 'x1': d['page_width']-m['x1'], 'y1': d['page_height']-m['y1']}
+    elif layout in ['image_right_half', 'image_right_small']:
+      offsets = {'x0': m['x0'], 'y0': y0, 'x1': (d['page_width']//2)-d['internal_margin']//2, 'y1': d['page_height']-m['y1']}
+    else: # image_fill
+      offsets = {'x0': m['x0'], 'y0': y0, 'x1': d['page_width']-m['x1'], 'y1': d['page_height']-m['y1']}
+    offsets['w'] = offsets['x1']-offsets['x0']
+    offsets['h'] = offsets['y1']-offsets['y0']
+    return offsets
+
+  def compute_column_offsets(self, layout, images, num_columns, column):
+    offsets = self.text_offsets(layout, images)
+    column_offsets = offsets.copy()
+    column_width_incl_margin = offsets['w']//num_columns
+    column_width_excl_margin = column_width_incl_margin-self.dimensions['internal_margin']
+    column_offsets['x0'] = offsets['x0']+column_width_incl_margin*column
+    column_offsets['x1'] = column_offsets['x0']+column_width_excl_margin
+    column_offsets['w'] = column_width_excl_margin
+    return column_offsets
+
+  def compute_image_area(self, layout, has_text):
+    d = self.dimensions
+    m = d['page_margins']
+    y0 = m['y0']+d['em_title']+d['internal_margin']*2
+    if layout == 'image_center':
+      if has_text:
+        drawable_height = d['page_height']-m['y0']-d['em_title']-m['y1']
+        image_area = {'x0': m['x0'], 'y0': y0, 'x1': d['page_width']-m['x1'], 'y1': drawable_height//2+m['y0']+d['em_title']-d['internal_margin']//2}
+      else:
+        image_area = {'x0': m['x0'], 'y0': y0, 'x1': d['page_width']-m['x1'], 'y1': d['page_height']-m['y1']}
+    elif layout == 'image_left_half':
+      image_area = {'x0': 0, 'y0': 0, 'x1': d['page_width']//2, 'y1': d['page_height']}
+    elif layout == 'image_left_small':
+      image_area = {'x0': m['x0'], 'y0': y0, 'x1': (d['page_width']//2)-m['x1'], 'y1': d['page_height']-m['y1']}
+    elif layout == 'image_right_half':
+      image_area = {'x0': d['page_width']//2, 'y0': 0, 'x1': d['page_width'], 'y1': d['page_height']}
+    elif layout == 'image_right_small':
+      image_area = {'x0': (d['page_width']//2)+m['x0'], 'y0': y0, 'x1': d['page_width']-m['x1'], 'y1': d['page_height']-m['y1']}
+    else: # image_fill
+      image_area = {'x0': 0, 'y0': 0, 'x1': d['page_width'], 'y1': d['page_height']}
+    return image_area
+
+  def compute_image_locations(self, num_images, layout, has_text, packed_images, cred):
+    d = self.dimensions
+    m = d['page_margins']
+    if cred:
+      image_area = dict(self.text_offsets(layout))
+      cred_image_height = int(CRED_FRACTION*m['y1'])
+      image_area['y0'] = d['page_height']-m['y1']+int((m['y1']-cred_image_height)/2)
+      image_area['y1'] = image_area['y0']+cred_image_height
+    else:
+      image_area = dict(self.image_area(layout, has_text))
+    image_area['w'] = image_area['x1']-image_area['x0']
+    image_area['h'] = image_area['y1']-image_area['y0']
+
+    if cred or layout == 'image_center':
+      grid_width = num_images
+      grid_height = 1
+    else:
+      grid_height = math.sqrt(num_images)
+      if grid_height-int(grid_height) > 0.0:
+        grid_height = int(grid_height)+1
+        grid_width = math.ceil(num_images/grid_height)
+      else:
+        grid_height = int(grid_height)
+        grid_width = grid_height
+    if layout == 'image_fill' and not cred:
+      # prefer to put images side-by-side instead of on top of each other:
+      grid_width, grid_height = grid_height, grid_width
+
+    if cred:
+      tot_width = int(image_area['h']*CRED_ASPECT_RATIO*num_images)
+      image_area['x0'] = image_area['x0']+image_area['w']//2-tot_width//2
+      image_area['x1'] = image_area['x0']+tot_width
+      image_area['w'] = image_area['x1']-image_area['x0']
+
+    margin = 0
+    if not packed_images and not cred:
+      margin = d['internal_margin']
+    image_size = {'w': int((image_area['w']-(grid_width-1)*margin)/grid_width),
+                  'h': int((image_area['h']-(grid_height-1)*margin)/grid_height)}
+    locations = []
+    for i in range(num_images):
+      pos_x = i % grid_width
+      pos_y = i // grid_width
+      locations.append({'x0': image_area['x0']+pos_x*(image_size['w']+margin),
+                        'y0': image_area['y0']+pos_y*(image_size['h']+margin),
+                        'w': image_size['w'],
+                        'h': image_size['h']})
+    return locations
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+import os, re, json, time, threading, traceback
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from urllib.parse import quote, unquote, urlparse
+from lxml import etree as ET
+import lxml.html
+
+from log import log, trace
+
+EVENTS_PATH = '/_pymd/events'
+POLL_INTERVAL = 0.25
+# sent to idle event streams, so that closed connections are noticed.
+KEEPALIVE_INTERVAL = 15
+PAGE_ID = re.compile(r'page-\d+$')
+
+# added to the served index.html (not to the file): replaces the pages that
+# changed in place, keeping the current page, its revealed steps and the
+# loaded media, and reloads (at the same #page-N) when anything else changed.
+LIVE_SCRIPT = '''<script>
+(function() {
+  var events = new EventSource("''' + EVENTS_PATH + '''");
+  events.addEventListener("pages", function(e) {
+    var pages = JSON.parse(e.data);
+    var patched = [];
+    for (var id in pages) {
+      var t = document.getElementById("template-" + id);
+      if (t) t.innerHTML = pages[id];
+      var old = document.getElementById(id);
+      if (!old) {
+        if (!t) { location.reload(); return; }
+        continue;
+      }
+      var holder = document.createElement("template");
+      holder.innerHTML = pages[id];
+      var fresh = holder.content.firstElementChild;
+      fresh.className = old.className;
+      if (old.hasAttribute("data-shown")) showSteps(fresh, parseInt(old.getAttribute("data-shown")));
+      if (overviewMode) fresh.addEventListener("click", overviewClickHandler);
+      old.replaceWith(fresh);
+      patched.push(fresh);
+    }
+    loadMediaWindow();
+    if (patched.length && window.MathJax && MathJax.typesetPromise) MathJax.typesetPromise(patched);
+  });
+  events.addEventListener("reload", function() { location.reload(); });
+})();
+</script>
+'''
+
+
+class live_channel:
+  # the latest events for the browsers that follow a deck. Each event has a
+  # number; a browser waits for those after the last one it got.
+  def __init__(self, history=16):
+    self.condition = threading.Condition()
+    self.events = []
+    self.number = 0
+    self.history = history
+
+  def publish(self, name, data):
+    with self.condition:
+      self.number += 1
+      self.events = self.events[-self.history+1:]+[(self.number, name, data)]
+      self.condition.notify_all()
+
+  def wait(self, after, timeout):
+    with self.condition:
+      self.condition.wait_for(lambda: self.number > after, timeout)
+      if self.events and self.events[0][0] > after+1:
+        # missed events: only a reload brings the browser up to date.
+        return self.number, [(self.number, 'reload', '{}')]
+      return self.number, [e for e in self.events if e[0] > after]
+
+
+def page_fragments(html_file):
+  # the serialized page divs of a deck by id, and a digest of everything
+  # else (styles, scripts, formula symbols, the number of pages).
+  tree = lxml.html.parse(html_file)
+  elements = [el for el in tree.getroot().iter('div') if PAGE_ID.match(el.get('id') or '')]
+  pages = {el.get('id'): ET.tostring(el, method='html', encoding='unicode', with_tail=False) for el in elements}
+  # the build date and commit are in meta elements.
+  for el in elements+list(tree.getroot().iter('meta')):
+    el.getparent().remove(el)
+  return pages, ET.tostring(tree.getroot(), method='html', encoding='unicode')
+
+
+def changes(old, new):
+  # the event that brings a browser showing old up to date with new.
+  old_pages, old_rest = old
+  new_pages, new_rest = new
+  if old_rest != new_rest or set(old_pages) != set(new_pages):
+    return 'reload', {}
+  changed = {k: v for k,v in new_pages.items() if old_pages[k] != v}
+  if len(changed) == 0:
+    return None, {}
+  return 'pages', changed
+
+
+def handler_class(channel, index_path):
+  # index_path: url path of the deck's index.html, served with LIVE_SCRIPT.
+  class live_handler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+      trace('http: '+format, *args)
+
+    def do_GET(self):
+      path = urlparse(self.path).path
+      if path == EVENTS_PATH:
+        return self.send_events()
+      if path == index_path:
+        return self.send_index()
+      return super().do_GET()
+
+    def send_index(self):
+      filename = self.translate_path(index_path)
+      try:
+        with open(filename, 'r') as f:
+          html = f.read()
+      except OSError:
+        return self.send_error(404)
+      i = html.rfind('</body>')
+      i = len(html) if i < 0 else i
+      data = (html[:i]+LIVE_SCRIPT+html[i:]).encode('utf-8')
+      self.send_response(200)
+      self.send_header('Content-Type', 'text/html; charset=utf-8')
+      self.send_header('Content-Length', str(len(data)))
+      self.send_header('Cache-Control', 'no-store')
+      self.end_headers()
+      self.wfile.write(data)
+
+    def send_events(self):
+      self.send_response(200)
+      self.send_header('Content-Type', 'text/event-stream')
+      self.send_header('Cache-Control', 'no-store')
+      self.end_headers()
+      number = channel.number
+      try:
+        while True:
+          number, events = channel.wait(number, KEEPALIVE_INTERVAL)
+          message = ''.join('event: {}\ndata: {}\n\n'.format(name, data) for _, name, data in events)
+          self.wfile.write((message or ':\n\n').encode('utf-8'))
+          self.wfile.flush()
+      except OSError:
+        pass
+  return live_handler
+
+
+def signature(filenames):
+  result = {}
+  for filename in filenames:
+    try:
+      st = os.stat(filename)
+      result[filename] = (st.st_mtime_ns, st.st_size)
+    except OSError:
+      result[filename] = None
+  return result
+
+
+def watch(build, watched_files, port=8000):
+  # --watch: serves the deck built by build() (which returns the path of its
+  # index.html) from the working directory, and builds it again whenever one
+  # of watched_files() changes. Open browsers get the pages that changed.
+  output_file = build()
+  channel = live_channel()
+  index_path = '/'+quote(os.path.relpath(output_file).replace(os.sep, '/'))
+  server = ThreadingHTTPServer(('127.0.0.1', port), handler_class(channel, index_path))
+  server.daemon_threads = True
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  log.info('serving http://127.0.0.1:%s%s, watching for changes (ctrl-c stops)', port, index_path)
+  current = page_fragments(output_file)
+  files = watched_files()
+  state = signature(files)
+  try:
+    while True:
+      time.sleep(POLL_INTERVAL)
+      new_state = signature(files)
+      if new_state == state:
+        continue
+      changed = [f for f in files if new_state[f] != state.get(f)]
+      log.info('changed: %s', ', '.join(changed))
+      # editors write in several steps; wait for the last one.
+      time.sleep(POLL_INTERVAL)
+      try:
+        build()
+        files = watched_files()
+        state = signature(files)
+        new = page_fragments(output_file)
+      except Exception as e:
+        log.error('build failed: %s', e)
+        log.debug(traceback.format_exc())
+        state = new_state
+        continue
+      name, pages = changes(current, new)
+      current = new
+      if name is not None:
+        log.info('sending %s to the browser', 'a reload' if name == 'reload' else ', '.join(sorted(pages, key=lambda p: int(p[5:]))))
+        channel.publish(name, json.dumps(pages))
+  except KeyboardInterrupt:
+    return 0
+  finally:
+    server.shutdown()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+import sys, logging
+
+# below DEBUG: one line per element on a slide (-vv).
+TRACE = 5
+logging.addLevelName(TRACE, 'TRACE')
+
+log = logging.getLogger('pymdslides')
+
+
+def trace(msg, *args):
+  # arguments are only formatted if tracing is enabled.
+  if log.isEnabledFor(TRACE):
+    log.log(TRACE, msg, *args)
+
+
+def tracing():
+  # for trace output that is expensive to prepare (e.g. yaml dumps).
+  return log.isEnabledFor(TRACE)
+
+
+class message_formatter(logging.Formatter):
+  def format(self, record):
+    msg = record.getMessage()
+    if record.levelno >= logging.ERROR:
+      return 'error: '+msg
+    if record.levelno >= logging.WARNING:
+      return 'warning: '+msg
+    return msg
+
+
+def setup_logging(argv, stream=None):
+  # -q: warnings and errors only. default: progress and summaries. -v: also
+  # one line per slide and configuration changes. -vv: every element.
+  # stream defaults to stdout; the daemon passes one to its client.
+  level = logging.INFO
+  if '-q' in argv:
+    level = logging.WARNING
+  elif '-vv' in argv:
+    level = TRACE
+  elif '-v' in argv:
+    level = logging.DEBUG
+  handler = logging.StreamHandler(stream or sys.stdout)
+  handler.setFormatter(message_formatter())
+  log.handlers = [handler]
+  log.setLevel(level)
+  log.propagate = False
+  # fontTools reports every table it drops while subsetting.
+  logging.getLogger('fontTools').setLevel(logging.WARNING if level <= TRACE else logging.ERROR)
+  return level
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+import time, json, threading
+
+from log import log
+
+class null_timer:
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type, value, traceback):
+    return False
+
+NULL_TIMER = null_timer()
+
+
+class phase_timer:
+  def __init__(self, profiler, name):
+    self.profiler = profiler
+    self.name = name
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, type, value, traceback):
+    self.profiler.add_phase(self.name, time.perf_counter()-self.start)
+    return False
+
+
+class category_timer:
+  # exclusive time: time spent in nested timers (a formula rendered while
+  # rendering markdown) is only counted for the innermost one.
+  def __init__(self, profiler, category):
+    self.profiler = profiler
+    self.category = category
+
+  def __enter__(self):
+    stack = self.profiler.timer_stack()
+    self.children = 0.0
+    self.start = time.perf_counter()
+    stack.append(self)
+    return self
+
+  def __exit__(self, type, value, traceback):
+    elapsed = time.perf_counter()-self.start
+    stack = self.profiler.timer_stack()
+    stack.pop()
+    if len(stack) > 0:
+      stack[-1].children += elapsed
+    self.profiler.add(self.category, elapsed-self.children)
+    return False
+
+
+class slide_timer:
+  def __init__(self, profiler, record):
+    self.profiler = profiler
+    self.record = record
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    self.profiler.current_slide = self.record
+    return self.record
+
+  def __exit__(self, type, value, traceback):
+    self.record['layout_s'] = time.perf_counter()-self.start
+    self.profiler.current_slide = None
+    return False
+
+
+class build_profiler:
+  # Wall time per build phase and per slide, for --profile. Each build has its
+  # own, which the backend carries. When it is not enabled, every hook returns
+  # a shared no-op context manager.
+  def __init__(self, enabled=False):
+    self.enabled = enabled
+    self.start = time.perf_counter()
+    self.phases = {}
+    self.totals = {}
+    self.slides = []
+    self.current_slide = None
+    self.current_phase = None
+    self.lock = threading.Lock()
+    self.local = threading.local()
+
+  def timer_stack(self):
+    if not hasattr(self.local, 'stack'):
+      self.local.stack = []
+    return self.local.stack
+
+  def begin_phase(self, name):
+    # sequential phases of the main script: ends the running phase, if any.
+    if not self.enabled:
+      return
+    self.end_phase()
+    self.current_phase = (name, time.perf_counter())
+
+  def end_phase(self):
+    if not self.enabled or self.current_phase is None:
+      return
+    name, start = self.current_phase
+    self.current_phase = None
+    self.add_phase(name, time.perf_counter()-start)
+
+  def phase(self, name):
+    if not self.enabled:
+      return NULL_TIMER
+    return phase_timer(self, name)
+
+  def timer(self, category):
+    # time attributed to the slide being laid out, if any.
+    if not self.enabled:
+      return NULL_TIMER
+    return category_timer(self, category)
+
+  def slide(self, page_number, line_number, headline):
+    if not self.enabled:
+      return NULL_TIMER
+    record = {'page': page_number, 'line': line_number, 'headline': headline, 'cached': False, 'layout_s': 0.0, 'breakdown_s': {}}
+    self.slides.append(record)
+    return slide_timer(self, record)
+
+  def mark_cached(self):
+    # the slide being timed was taken from the build cache.
+    if self.current_slide is not None:
+      self.current_slide['cached'] = True
+
+  def add_phase(self, name, seconds):
+    with self.lock:
+      self.phases[name] = self.phases.get(name, 0.0)+seconds
+
+  def add(self, category, seconds, slide=None):
+    # slide defaults to the one being laid out; image conversions run later
+    # and pass the slide that queued them.
+    if slide is None:
+      slide = self.current_slide
+    with self.lock:
+      self.totals[category] = self.totals.get(category, 0.0)+seconds
+      if slide is not None:
+        slide['breakdown_s'][category] = slide['breakdown_s'].get(category, 0.0)+seconds
+
+  def slide_summary(self, record):
+    # categories are markdown, formula, io (reading and placing images) and
+    # image_conversion; other is the rest of the layout time. Image conversion
+    # happens after layout, in parallel, everything else is part of layout_s.
+    breakdown = dict(record['breakdown_s'])
+    timed = sum([v for k,v in breakdown.items() if k != 'image_conversion'])
+    breakdown['other'] = max(0.0, record['layout_s']-timed)
+    total = record['layout_s']+breakdown.get('image_conversion', 0.0)
+    cause = max(breakdown.keys(), key=lambda k: breakdown[k])
+    return {'page': record['page'], 'line': record['line'], 'headline': record['headline'], 'cached': record['cached'], 'total_s': round(total, 6), 'layout_s': round(record['layout_s'], 6), 'dominant_cause': cause, 'breakdown_s': {k: round(v, 6) for k,v in breakdown.items()}}
+
+  def report(self, top_n=10):
+    slides = [self.slide_summary(r) for r in self.slides]
+    slowest = sorted(slides, key=lambda s: -s['total_s'])[:top_n]
+    return {
+      'total_s': round(time.perf_counter()-self.start, 6),
+      'phases_s': {k: round(v, 6) for k,v in self.phases.items()},
+      'categories_s': {k: round(v, 6) for k,v in self.totals.items()},
+      'slides': slides,
+      'slowest': [{'page': s['page'], 'line': s['line'], 'total_s': s['total_s'], 'dominant_cause': s['dominant_cause']} for s in slowest],
+    }
+
+  def write_report(self, filename, top_n=10):
+    report = self.report(top_n)
+    with open(filename, 'w') as f:
+      json.dump(report, f, indent=1)
+    log.info('profile: %.3f s in total, report written to %s', report['total_s'], filename)
+    for name, seconds in report['phases_s'].items():
+      log.info('  phase %-18s %8.3f s', name, seconds)
+    log.info('  slowest slides:')
+    for s in report['slowest']:
+      log.info('  %8.3f s  page %-4s line %-6s %s', s['total_s'], s['page'], s['line'], s['dominant_cause'])
+    return report
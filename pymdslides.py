@@ -19,15 +19,23 @@ from PIL import Image, ImageOps
 from subprocess import Popen,PIPE
 from datetime import datetime
 
-import shutil
+import shutil, glob, traceback
 import yaml
-import copy
-from backend_html import backend_html
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from backend_html import backend_html, render_markdown
 from backend_odp import backend_odp
+from asset_publisher import memory_publisher
+import build_daemon
+import live_reload
+from build_cache import build_cache, referenced_files, file_signature
+from image_cache import image_cache, DEFAULT_MAX_SIZE_MB
+from profiler import build_profiler
+from layered_config import layered_config
+from layout_engine import layout_engine
+from slide_parser import parse_slides, TITLE, SUBTITLE, BOX_TITLE, HEADING, IMAGE
+from log import log, trace, tracing, setup_logging
 
-import copy
-
-layouts = ['image_left_half', 'image_left_small', 'image_right_half', 'image_right_small', 'image_center', 'image_fill']
 
 default_text_color= [0,0,0]
 default_layout = 'image_center'
@@ -52,12 +60,11 @@ default_dimensions = {
         'margin_footer': 4,
 }
 
-def dump_page_content(backend, content, formatting, headlines, raster_images, treat_as_raster_images, md_file_stripped, line_number, page_number):
-  print('--------------------------------------')
+def dump_page_content(backend, geometry, page, headlines, raster_images, treat_as_raster_images, md_file_stripped, page_number):
+  trace('--------------------------------------')
   backend.add_page()
-  #backend.text(txt=content, markdown=True)
-  # this seems to do nothing. checking also in render_text_line.
-  formatting = preprocess_formatting(formatting)
+  line_number = page.first_line()
+  formatting = page.config
   with backend.unbreakable():
     title = ''
     subtitle = ''
@@ -67,10 +74,8 @@ def dump_page_content(backend, content, formatting, headlines, raster_images, tr
     l4_boxes = []
     l4_subtitle = None
     l4_lines = []
-    #print('content', content)
-    for line in content:
-      #print('line:', line)
-      if l4_subtitle is not None and line.startswith('#'):
+    for n in page.nodes():
+      if l4_subtitle is not None and n.kind in [TITLE, SUBTITLE, BOX_TITLE, HEADING]:
         if l4_subtitle != '':
           l4_lines = ['**'+l4_subtitle+'**\n\n']+strip_lines(l4_lines)
         else:
@@ -78,30 +83,25 @@ def dump_page_content(backend, content, formatting, headlines, raster_images, tr
         l4_boxes.append(l4_lines)
         l4_subtitle = None
         l4_lines = []
-      if line.startswith('#') and (len(line) <= 1 or line[1] != '#'):
-        title = line[2:]
-        #print('title', title, '"', line, '"')
-      elif line.startswith('##') and (len(line) <= 2 or line[2] != '#'):
-        subtitle = line[3:]
+      if n.kind == TITLE:
+        title = n.text
+      elif n.kind == SUBTITLE:
+        subtitle = n.text
         #l3 headlines will go as lines.
-      elif line.startswith('####') and (len(line) <= 4 or line[4] != '#'):
+      elif n.kind == BOX_TITLE:
         # l4 headlines will be put in boxes with following lines.
         # links and formulas are allowed but not images.
-        #print('l4 headline:', line)
-        l4_subtitle = line[5:]
-      elif line.startswith('![') and line.endswith(')') and '](' in line[2:-1]:
-        [alt_text,image] = line[2:-1].split('](')
-        images.append(image)
-        alt_texts.append(alt_text)
+        l4_subtitle = n.text
+      elif n.kind == IMAGE:
+        images.append(n.src)
+        alt_texts.append(n.alt)
       elif l4_subtitle is not None:
-        #print('l4 line:', line)
-        l4_lines.append(line)
+        l4_lines.append(n.text)
       else:
-      #elif line:
-        if line == '__':
-          print('{}:{}: ignoring empty line "{}"'.format(md_file_stripped, line_number, line))
+        if n.text == '__':
+          trace('%s:%s: ignoring empty line "%s"', md_file_stripped, n.line, n.text)
         else:
-          lines.append(line)
+          lines.append(n.text)
     if l4_subtitle is not None:
       if l4_subtitle != '':
         l4_lines = ['**'+l4_subtitle+'**']+strip_lines(l4_lines)
@@ -110,35 +110,32 @@ def dump_page_content(backend, content, formatting, headlines, raster_images, tr
       l4_boxes.append(l4_lines)
       l4_subtitle = None
       l4_lines = []
-  return render_page(backend, title, subtitle, images, alt_texts, lines, l4_boxes, formatting, headlines, raster_images, treat_as_raster_images, md_file_stripped, line_number, page_number)
+  return render_page(backend, geometry, title, subtitle, images, alt_texts, lines, l4_boxes, formatting, headlines, raster_images, treat_as_raster_images, md_file_stripped, line_number, page_number)
 
-def render_page(backend, title, subtitle, images, alt_texts, lines, l4_boxes, formatting, headlines, raster_images, treat_as_raster_images, md_file_stripped, line_number, page_number):
-  print('{}:{}: rendering page "{}"'.format(md_file_stripped, line_number, title))
+def render_page(backend, geometry, title, subtitle, images, alt_texts, lines, l4_boxes, formatting, headlines, raster_images, treat_as_raster_images, md_file_stripped, line_number, page_number):
+  log.debug('%s:%s: rendering page "%s"', md_file_stripped, line_number, title)
   lines = strip_lines(lines)
   text_color = default_text_color
   if 'text_color' in formatting:
-    print('{}:{}: text_color {}'.format(md_file_stripped, line_number, formatting['text_color']))
+    trace('%s:%s: text_color %s', md_file_stripped, line_number, formatting['text_color'])
     text_color = formatting['text_color']
-  if 'background_color' not in formatting:
-    formatting['background_color'] = [255,255,255]
-
-  backend.set_background_color(formatting['background_color'])
+  backend.set_background_color(formatting.get('background_color', [255,255,255]))
   backend.set_text_color(text_color)
 
   packed_images = True
   if 'background_image' in formatting:
-    print('{}:{}: background_image {}'.format(md_file_stripped, line_number, formatting['background_image']))
-    put_images_on_page(md_file_stripped, line_number, [formatting['background_image']], [''], formatting['layout'], len(lines) > 0, packed_images, True, background=True, raster_images=raster_images, treat_as_raster_images=treat_as_raster_images)
+    trace('%s:%s: background_image %s', md_file_stripped, line_number, formatting['background_image'])
+    put_images_on_page(backend, geometry, md_file_stripped, line_number, [formatting['background_image']], [''], formatting['layout'], len(lines) > 0, packed_images, True, background=True, raster_images=raster_images, treat_as_raster_images=treat_as_raster_images)
 
   if 'packed_images' in formatting and formatting['packed_images'] == False:
     packed_images = False
-  print('{}:{}: crop_images {}'.format(md_file_stripped, line_number, formatting['crop_images']))
-  put_images_on_page(md_file_stripped, line_number, images, alt_texts, formatting['layout'], len(lines) > 0, packed_images, formatting['crop_images'], background=False, raster_images=raster_images, treat_as_raster_images=treat_as_raster_images)
+  trace('%s:%s: crop_images %s', md_file_stripped, line_number, formatting['crop_images'])
+  put_images_on_page(backend, geometry, md_file_stripped, line_number, images, alt_texts, formatting['layout'], len(lines) > 0, packed_images, formatting['crop_images'], background=False, raster_images=raster_images, treat_as_raster_images=treat_as_raster_images)
   
-  offsets = get_offsets(formatting['layout'])
+  offsets = geometry.offsets(formatting['layout'])
   offsets_title = offsets
   if 'title_full_width' in formatting and formatting['title_full_width']:
-    offsets_title = get_offsets('image_center')
+    offsets_title = geometry.offsets('image_center')
   x_title = offsets_title['x0']
   y_title = offsets_title['y0']
 
@@ -146,10 +143,10 @@ def render_page(backend, title, subtitle, images, alt_texts, lines, l4_boxes, fo
   if 'title_vertical_center' in formatting and formatting['title_vertical_center']: # and formatting['layout'] in ['image_full', 'image_left_half', 'image_left_small', 'image_right_half', 'image_right_full']:
     y_title = formatting['dimensions']['page_height']//2-int(1.5*formatting['dimensions']['em_title'])
   if 'fonts' in formatting and 'font_file_title' in formatting['fonts']:
-    print('Setting font title with size',formatting['dimensions']['font_size_title'])
+    trace('Setting font title with size %s', formatting['dimensions']['font_size_title'])
     backend.set_font('title', '', formatting['dimensions']['font_size_title'])
   else:
-    print('Setting font size title',formatting['dimensions']['font_size_title'])
+    trace('Setting font size title %s', formatting['dimensions']['font_size_title'])
     backend.set_font_size('title', formatting['dimensions']['font_size_title'])
 
   backend.set_xy(x_title,y_title)
@@ -171,13 +168,14 @@ def render_page(backend, title, subtitle, images, alt_texts, lines, l4_boxes, fo
   x = offsets['x0']
   y = y_title+formatting['dimensions']['em_title']
 
-  print('images', len(images))
-  offsets = get_offsets_for_text(formatting['layout'], images=(len(images) > 0))
+  trace('images %s', len(images))
+  has_images = len(images) > 0
+  offsets = geometry.text_offsets(formatting['layout'], images=has_images)
   column_offsets = offsets
   num_columns = 1
   if 'columns' in formatting and formatting['columns'] > 1:
     num_columns = formatting['columns']
-    column_offsets = get_column_offsets(offsets, formatting['columns'], column=0)
+    column_offsets = geometry.column_offsets(formatting['layout'], has_images, num_columns, column=0)
   column_lines = split_lines_into_columns(lines, num_columns)
   #print('column_lines', column_lines)
   for c in range(num_columns):
@@ -194,7 +192,8 @@ def render_page(backend, title, subtitle, images, alt_texts, lines, l4_boxes, fo
       vertical_align = formatting['text_vertical_align']
     backend.textbox(lines=lines_this_column, x=x, y=y, w=column_offsets['w'], h=column_offsets['h'], headlines=headlines, h_level=None, text_color=text_color, align=get_alignment(formatting), markdown_format=True, text_vertical_align=vertical_align)
     # for next column:
-    column_offsets = get_column_offsets(offsets, num_columns, column=c+1)
+    if c+1 < num_columns:
+      column_offsets = geometry.column_offsets(formatting['layout'], has_images, num_columns, column=c+1)
   if 'footer' in formatting:
     backend.set_text_color(formatting.get('footer_color', default_footer_color))
     if 'fonts' in formatting and 'font_file_footer' in formatting['fonts']:
@@ -208,8 +207,8 @@ def render_page(backend, title, subtitle, images, alt_texts, lines, l4_boxes, fo
       footer_text = str(page_number)+('&nbsp;&nbsp;&nbsp;' if len(footer_text) > 0 else '')+footer_text
     backend.text(txt=footer_text, x=x, y=formatting['dimensions']['page_height']-formatting['dimensions']['margin_footer']-formatting['dimensions']['em_footer'], headlines=headlines, em=formatting['dimensions']['em_footer'], footer=True, markdown_format=True) #, w=offsets['w'], align='L')
 
-  if len(l4_boxes):
-    print('{}:{}: l4_boxes: \n  {}'.format(md_file_stripped, line_number, yaml.dump(l4_boxes).replace('\n', '\n  ')))
+  if len(l4_boxes) and tracing():
+    trace('%s:%s: l4_boxes: \n  %s', md_file_stripped, line_number, yaml.dump(l4_boxes).replace('\n', '\n  '))
   if 'fonts' in formatting and 'font_file_standard' in formatting['fonts']:
     backend.set_font('standard', '', formatting['dimensions']['font_size_standard'])
   else:
@@ -255,63 +254,10 @@ def split_lines_into_columns(lines, num_columns):
   return column_lines
 
 
-def preprocess_formatting(formatting):
-  for color in ['background_color', 'text_color', 'footer_color', 'l4_box_fill_color']:
-    if color in formatting:
-      #print('color',formatting[color])
-      if formatting[color] == 'white':
-        formatting[color] = [255,255,255]
-      elif formatting[color] == 'grey':
-        formatting[color] = [100,100,100]
-      elif formatting[color] == 'black':
-        formatting[color] = [0,0,0]
-      elif formatting[color] == 'orange':
-        formatting[color] = [255,180,0]
-      elif formatting[color] == 'red':
-        formatting[color] = [255,0,0]
-      elif formatting[color] == 'green':
-        formatting[color] = [0,255,0]
-      elif formatting[color] == 'blue':
-        formatting[color] = [0,0,255]
-      elif formatting[color] == 'yellow':
-        formatting[color] = [255,255,0]
-      elif formatting[color] == 'purple':
-        formatting[color] = [225,0,255]
-      elif formatting[color] == 'pink':
-        formatting[color] = [255,86,235]
-      elif formatting[color] == 'darkorange':
-        formatting[color] = [180,100,0]
-      elif formatting[color] == 'darkred':
-        formatting[color] = [100,0,0]
-      elif formatting[color] == 'darkgreen':
-        formatting[color] = [0,80,45]
-      elif formatting[color] == 'darkblue':
-        formatting[color] = [0,0,100]
-      elif formatting[color] == 'darkpurple':
-        formatting[color] = [120,0,140]
-      elif formatting[color] == 'lightgrey':
-        formatting[color] = [180,180,180]
-      elif formatting[color] == 'lightpink':
-        formatting[color] = [255,155,235]
-      elif formatting[color] == 'lightgreen':
-        formatting[color] = [120,255,180]
-      elif formatting[color] == 'lightblue':
-        formatting[color] = [160,180,255]
-      elif formatting[color] is not None and formatting[color][0] == '#':
-        # html:
-        r_hex = formatting[color][1:3]
-        r = int(r_hex, 16)
-        g_hex = formatting[color][3:5]
-        g = int(g_hex, 16)
-        b_hex = formatting[color][5:7]
-        b = int(b_hex, 16)
-        #print('detected hex',formatting[color],'computed decimals',r,g,b)
-        formatting[color] = [r,g,b]
-  return formatting
 def no_text(lines):
   for l in lines:
     l = l.strip()
-    print(l)
+    trace(l)
     if l[:2] == '![':
       continue
     elif len(l) == 0:
@@ -368,63 +314,7 @@ def strip_lines_division(lines):
     lines = lines[1:]
   return lines
 
-def get_column_offsets(offsets, num_columns, column):
-  #print('get_column_offsets',offsets, num_columns, column)
-  column_offsets = offsets.copy()
-  column_width_incl_margin = offsets['w']//num_columns
-  column_width_excl_margin = column_width_incl_margin-formatting['dimensions']['internal_margin']
-  column_offsets['x0'] = offsets['x0']+ (column_width_incl_margin)*column
-  column_offsets['x1'] = column_offsets['x0']+column_width_excl_margin
-  column_offsets['w'] = column_width_excl_margin
-  return column_offsets
-
-def get_offsets_for_text(layout, images=True):
-  # returns offsets for text area.
-  # layouts = ['image_left_half', 'image_left_small', 'image_right_half', 'image_right_small', 'image_center', 'image_fill']
-  if layout in ['image_center']:
-    y = formatting['dimensions']['page_margins']['y0']+formatting['dimensions']['em_title']+formatting['dimensions']['internal_margin']*2
-    drawable_height = formatting['dimensions']['page_height']-formatting['dimensions']['page_margins']['y0']-formatting['dimensions']['em_title']-formatting['dimensions']['page_margins']['y1']
-    if images:
-      drawable_height = drawable_height//2
-      y += formatting['dimensions']['internal_margin']//2
-      y += drawable_height
-    offsets = {'x0': formatting['dimensions']['page_margins']['x0'], 'y0': y, 'x1': formatting['dimensions']['page_width']-formatting['dimensions']['page_margins']['x1'], 'y1': formatting['dimensions']['page_height']-formatting['dimensions']['page_margins']['y1']}
-  elif layout == 'image_left_half':
-    offsets =  {'x0': (formatting['dimensions']['page_width']//2)+formatting['dimensions']['internal_margin']//2, 'y0': formatting['dimensions']['page_margins']['y0']+formatting['dimensions']['em_title']+formatting['dimensions']['internal_margin']*2, 'x1': formatting['dimensions']['page_width']-formatting['dimensions']['page_margins']['x1'], 'y1': formatting['dimensions']['page_height']-formatting['dimensions']['page_margins']['y1']}
-  elif layout == 'image_left_small':
-    offsets =  {'x0': (formatting['dimensions']['page_width']//2)+formatting['dimensions']['internal_margin']//2, 'y0': formatting['dimensions']['page_margins']['y0']+formatting['dimensions']['em_title']+formatting['dimensions']['internal_margin']*2, 'x1': formatting['dimensions']['page_width']-formatting['dimensions']['page_margins']['x1'], 'y1': formatting['dimensions']['page_height']-formatting['dimensions']['page_margins']['y1']}
-  elif layout == 'image_right_half':
-    offsets =  {'x0': formatting['dimensions']['page_margins']['x0'], 'y0': formatting['dimensions']['page_margins']['y0']+formatting['dimensions']['em_title']+formatting['dimensions']['internal_margin']*2, 'x1': (formatting['dimensions']['page_width']//2)-formatting['dimensions']['internal_margin']//2, 'y1': formatting['dimensions']['page_height']-formatting['dimensions']['page_margins']['y1']}
-  elif layout == 'image_right_small':
-    offsets =  {'x0': formatting['dimensions']['page_margins']['x0'], 'y0': formatting['dimensions']['page_margins']['y0']+formatting['dimensions']['em_title']+formatting['dimensions']['internal_margin']*2, 'x1': (formatting['dimensions']['page_width']//2)-formatting['dimensions']['internal_margin']//2, 'y1': formatting['dimensions']['page_height']-formatting['dimensions']['page_margins']['y1']}
-  else: #image_fill
-    offsets = {'x0': formatting['dimensions']['page_margins']['x0'], 'y0': formatting['dimensions']['page_margins']['y0']+formatting['dimensions']['em_title']+formatting['dimensions']['internal_margin']*2, 'x1': formatting['dimensions']['page_width']-formatting['dimensions']['page_margins']['x1'], 'y1': formatting['dimensions']['page_height']-formatting['dimensions']['page_margins']['y1']}
-    #offsets =  {'x0': 0, 'y0': 0, 'x1': formatting['dimensions']['page_width'], 'y1': formatting['dimensions']['page_height']}
-  offsets['w'] = offsets['x1']-offsets['x0']
-  offsets['h'] = offsets['y1']-offsets['y0']
-  return offsets
-
-def get_offsets(layout):
-  # returns offsets for text area.
-  # layouts = ['image_left_half', 'image_left_small', 'image_right_half', 'image_right_small', 'image_center','image_fill']
-  if layout in ['image_center']:
-    offsets = {'x0': formatting['dimensions']['page_margins']['x0'], 'y0': formatting['dimensions']['page_margins']['y0'], 'x1': formatting['dimensions']['page_width']-formatting['dimensions']['page_margins']['x1'], 'y1': formatting['dimensions']['page_height']-formatting['dimensions']['page_margins']['y1']}
-  elif layout == 'image_left_half':
-    offsets =  {'x0': (formatting['dimensions']['page_width']//2)+formatting['dimensions']['page_margins']['x0'], 'y0': formatting['dimensions']['page_margins']['y0'], 'x1': formatting['dimensions']['page_width']-formatting['dimensions']['page_margins']['x1'], 'y1': formatting['dimensions']['page_height']-formatting['dimensions']['page_margins']['y1']}
-  elif layout == 'image_left_small':
-    offsets = {'x0': formatting['dimensions']['page_margins']['x0'], 'y0': formatting['dimensions']['page_margins']['y0'], 'x1': formatting['dimensions']['page_width']-formatting['dimensions']['page_margins']['x1'], 'y1': formatting['dimensions']['page_height']-formatting['dimensions']['page_margins']['y1']}
-  elif layout == 'image_right_half':
-    offsets =  {'x0': formatting['dimensions']['page_margins']['x0'], 'y0': formatting['dimensions']['page_margins']['y0'], 'x1': (formatting['dimensions']['page_width']//2)-formatting['dimensions']['page_margins']['x1'], 'y1': formatting['dimensions']['page_height']-formatting['dimensions']['page_margins']['y1']}
-  elif layout == 'image_right_small':
-    offsets = {'x0': formatting['dimensions']['page_margins']['x0'], 'y0': formatting['dimensions']['page_margins']['y0'], 'x1': formatting['dimensions']['page_width']-formatting['dimensions']['page_margins']['x1'], 'y1': formatting['dimensions']['page_height']-formatting['dimensions']['page_margins']['y1']}
-  else: #image_fill
-    offsets = {'x0': formatting['dimensions']['page_margins']['x0'], 'y0': formatting['dimensions']['page_margins']['y0'], 'x1': formatting['dimensions']['page_width']-formatting['dimensions']['page_margins']['x1'], 'y1': formatting['dimensions']['page_height']-formatting['dimensions']['page_margins']['y1']}
-    #offsets =  {'x0': 0, 'y0': 0, 'x1': formatting['dimensions']['page_width'], 'y1': formatting['dimensions']['page_height']}
-  offsets['w'] = offsets['x1']-offsets['x0']
-  offsets['h'] = offsets['y1']-offsets['y0']
-  return offsets
-
-def put_images_on_page(md_file_stripped, line_number, images, alt_texts, layout, has_text, packed_images, crop_images, background=False, raster_images=False, treat_as_raster_images=[]):
+def put_images_on_page(backend, geometry, md_file_stripped, line_number, images, alt_texts, layout, has_text, packed_images, crop_images, background=False, raster_images=False, treat_as_raster_images=[]):
   #print('crop_images', crop_images)
   #print('put_images_on_page()', 'layout', layout)
   if len(images) == 0:
@@ -437,7 +327,7 @@ def put_images_on_page(md_file_stripped, line_number, images, alt_texts, layout,
       images_to_remove.append(i)
   images_to_remove.reverse()
   for index in images_to_remove:
-    print("{}:{}: Warning: Empty image tag, or image file does not exist. '{}'. Ignoring.".format(md_file_stripped, line_number, images[index], alt_texts[index]))
+    log.warning("%s:%s: Empty image tag, or image file does not exist. '%s'. Ignoring.", md_file_stripped, line_number, images[index])
     del images[index]
     del alt_texts[index]
   page_images_alts = [(im,alt) for (im, alt) in zip(images, alt_texts) if not alt.startswith('credits:')]
@@ -448,235 +338,550 @@ def put_images_on_page(md_file_stripped, line_number, images, alt_texts, layout,
   if len(page_images) > 0:
     # page images:
     if background:
-      locations = [{'x0': 0, 'y0': 0, 'w': formatting['dimensions']['page_width'], 'h': formatting['dimensions']['page_height']}]
+      locations = [geometry.background_location()]
       #print('background location', locations)
     else:
-      locations = get_images_locations(page_images, layout, has_text, packed_images, cred=False)
+      locations = geometry.image_locations(len(page_images), layout, has_text, packed_images, cred=False)
       #print('locations',locations)
     for image,location in zip(page_images,locations):
       image_to_display = image
-      backend.image(image_to_display, x=location['x0'], y = location['y0'], w = location['w'], h = location['h'], link = '', crop_images=crop_images)
+      with backend.profiler.timer('io'):
+        backend.image(image_to_display, x=location['x0'], y = location['y0'], w = location['w'], h = location['h'], link = '', crop_images=crop_images)
 
   # credit images:
   if len(credit_images):
-    locations = get_images_locations(credit_images, layout, has_text, packed_images, cred=True)
+    locations = geometry.image_locations(len(credit_images), layout, has_text, packed_images, cred=True)
     # print("credit_images", credit_images)
     for image,location in zip(credit_images,locations):
-      backend.image(image, x=location['x0'], y = location['y0'], w = location['w'], h = location['h'], link = '', crop_images=True)
+      with backend.profiler.timer('io'):
+        backend.image(image, x=location['x0'], y = location['y0'], w = location['w'], h = location['h'], link = '', crop_images=True)
   return 
 
-def get_images_locations(images, layout, has_text, packed_images=False, cred=False):
-  # layouts = ['image_left_half', 'image_left_small', 'image_right_half', 'image_right_small', 'image_center', 'image_fill']
-  #print('get_images_locations()', 'layout', layout)
-  locations = []
-  image_area = [0,0,formatting['dimensions']['page_width'],formatting['dimensions']['page_height']]
-  #print('formatting['dimensions']['page_margins']',formatting['dimensions']['page_margins'])
-  #print('layout',layout)
-  image_area = get_image_area(layout, has_text)
-
-  #print('num_images', len(images))
-  #print('cred', cred)
-  cred_aspect_ratio = 1.05 # /1.1
-  cred_fraction = 0.6 # TODO: set reasonable constant somewhere, or let it be configurable.
-  if cred:
-    image_area = get_offsets_for_text(layout)
-    cred_image_height = int(cred_fraction*formatting['dimensions']['page_margins']['y1'])
-    image_area['y0'] = formatting['dimensions']['page_height']-formatting['dimensions']['page_margins']['y1']+int((formatting['dimensions']['page_margins']['y1']-cred_image_height)/2)
-    image_area['y1'] = image_area['y0']+cred_image_height
-
-  image_area['w'] = image_area['x1']-image_area['x0']
-  image_area['h'] = image_area['y1']-image_area['y0']
-
-  if cred:
-    grid_width = len(images)
-    grid_height = 1
-  elif layout in ['image_center']:
-    grid_width = len(images)
-    grid_height = 1
-  else:
-    grid_height = math.sqrt(len(images))
-    #print(grid_height)
-    if grid_height - int(grid_height) > 0.0:
-      grid_height = int(grid_height)+1
-      grid_width = math.ceil(len(images)/grid_height)
-    else:
-      grid_height = int(grid_height)
-      grid_width = grid_height
-
-  if layout in ['image_fill'] and not cred:
-    # prefer to put images side-by-side instead of on top of each other:
-    g_w = grid_height
-    grid_height = grid_width
-    grid_width = g_w
-  #print('grid',grid_width,grid_height)
-  #print('images',len(images))
-
-  if cred:
-    tot_height = image_area['h']
-    tot_width = int(image_area['h']*cred_aspect_ratio*len(images))
-    image_area['x0'] = image_area['x0']+image_area['w']//2-tot_width//2
-    image_area['x1'] = image_area['x0']+tot_width
-    image_area['w'] = image_area['x1']-image_area['x0']
-    image_area['h'] = image_area['y1']-image_area['y0']
-
-  #print('image area size:', image_area['w'], image_area['h'], 'image grid:', grid_width, grid_height, 'margin',formatting['dimensions']['internal_margin'])
-  image_size = {'w': int(image_area['w']/grid_width),
-                'h': int(image_area['h']/grid_height)}
-  if not packed_images and not cred:
-    image_size = {'w': int((image_area['w']-(grid_width-1)*formatting['dimensions']['internal_margin'])/grid_width),
-                  'h': int((image_area['h']-(grid_height-1)*formatting['dimensions']['internal_margin'])/grid_height)}
-  
-  #print('image_size', image_size)
-  for i,image in enumerate(images):
-    pos_x = i % grid_width
-    pos_y = i // grid_width
-    marg_x = 0
-    if not packed_images and not cred:
-      marg_x = formatting['dimensions']['internal_margin']
-    marg_y = 0
-    if not packed_images and not cred:
-      marg_y = formatting['dimensions']['internal_margin']
-    #print('image-grid:', pos_x, pos_y, marg_x, marg_y)
-    #location  = {'x0': image_area['x0']+pos_x*image_size['w']+marg_x, 'y0': image_area['y0']+pos_y*image_size['h']+marg_y, 'w': image_size['w']-marg_x, 'h': image_size['h']-marg_y}
-    location  = {'x0': image_area['x0']+pos_x*(image_size['w']+marg_x),
-                 'y0': image_area['y0']+pos_y*(image_size['h']+marg_y),
-                 'w': image_size['w'],
-                 'h': image_size['h']}
-    #print('location',location)
-    locations.append(location)
-  return locations
-
-def get_image_area(layout, has_text):
-  if layout in ['image_center']:
-    drawable_height = formatting['dimensions']['page_height']-formatting['dimensions']['page_margins']['y0']-formatting['dimensions']['em_title']-formatting['dimensions']['page_margins']['y1']
-    if has_text:
-      image_area = {'x0': formatting['dimensions']['page_margins']['x0'], 'y0': formatting['dimensions']['page_margins']['y0']+formatting['dimensions']['em_title']+formatting['dimensions']['internal_margin']*2, 'x1': formatting['dimensions']['page_width']-formatting['dimensions']['page_margins']['x1'], 'y1': drawable_height//2+formatting['dimensions']['page_margins']['y0']+formatting['dimensions']['em_title']-formatting['dimensions']['internal_margin']//2}
-    else:
-      image_area = {'x0': formatting['dimensions']['page_margins']['x0'], 'y0': formatting['dimensions']['page_margins']['y0']+formatting['dimensions']['em_title']+formatting['dimensions']['internal_margin']*2, 'x1': formatting['dimensions']['page_width']-formatting['dimensions']['page_margins']['x1'], 'y1': formatting['dimensions']['page_height']-formatting['dimensions']['page_margins']['y1']}
-  elif layout == 'image_left_half':
-    image_area =  {'x0': 0, 'y0': 0, 'x1': formatting['dimensions']['page_width']//2, 'y1': formatting['dimensions']['page_height']}
-  elif layout == 'image_left_small':
-    image_area =  {'x0': formatting['dimensions']['page_margins']['x0'], 'y0': formatting['dimensions']['page_margins']['y0']+formatting['dimensions']['em_title']+formatting['dimensions']['internal_margin']*2, 'x1': (formatting['dimensions']['page_width']//2)-formatting['dimensions']['page_margins']['x1'], 'y1': formatting['dimensions']['page_height']-formatting['dimensions']['page_margins']['y1']}
-  elif layout == 'image_right_half':
-    image_area =  {'x0': formatting['dimensions']['page_width']//2, 'y0': 0, 'x1': formatting['dimensions']['page_width'], 'y1': formatting['dimensions']['page_height']}
-  elif layout == 'image_right_small':
-    image_area =  {'x0': (formatting['dimensions']['page_width']//2)+formatting['dimensions']['page_margins']['x0'], 'y0': formatting['dimensions']['page_margins']['y0']+formatting['dimensions']['em_title']+formatting['dimensions']['internal_margin']*2, 'x1': formatting['dimensions']['page_width']-formatting['dimensions']['page_margins']['x1'], 'y1': formatting['dimensions']['page_height']-formatting['dimensions']['page_margins']['y1']}
-  else: #image_full
-    image_area =  {'x0': 0, 'y0': 0, 'x1': formatting['dimensions']['page_width'], 'y1': formatting['dimensions']['page_height']}
-  #print('image_area',image_area)
-  return image_area
-
-
+@lru_cache(maxsize=None)
 def get_git_commit(script_home):
+  # looked up once per process, batch builds share it.
   p = Popen(["/usr/bin/git","log","--pretty=format:\"%H\"","-1"], cwd=script_home, stdout=PIPE, stderr=PIPE)
   res_out,res_err = p.communicate()
   git_commit = res_out.decode()
-  print("{}: git commit: {}".format(datetime.today().strftime('%Y-%m-%d %H:%M:%S'), git_commit))
+  log.debug('%s: git commit: %s', datetime.today().strftime('%Y-%m-%d %H:%M:%S'), git_commit)
   return git_commit
 
 #def markdown_to_text(md_data):
 #  parser = MarkdownIt(renderer_cls=RendererPlain)
 #  return parser.render(md_data)
 
-def recursive_dict_update(d1, d2):
-  for k in d2:
-    if k in d1 and isinstance(d1[k], dict) and isinstance(d2[k], dict):
-      #print('dict',k,d1[k], d2[k])
-      d1[k] = recursive_dict_update(d1[k], d2[k])
-    else:
-      #print('key not in d1 or not dict. replacing.',k,d2[k])
-      d1[k] = d2[k]
-  return d1
-
-def cleanup_md_line(line):
-  #line = re.sub(r'(?<!\*)\*(?![\*\s])', '__', line)
-  line = re.sub(r'(?<![\\*])\*(?![\*\s])', '__', line)
-  if '$' in line:
-    splits = line.split('$')
-    corrected_splits = []
-    for i,split in enumerate(splits):
-      if i%2==1:
-        #formula:
-        if '__' in split:
-          split = split.replace('__', '*')
-      corrected_splits.append(split)
-    line = '$'.join(corrected_splits)
-  return line
-
-def preprocess_md_page(content, line_number, config):
-  page = {'headline': '', 'headline_h2': '', 'content': [], 'line_numbers': [], 'images': [], 'config': copy.deepcopy(config)}
-  for i,line in enumerate(content):
-    content[i] = cleanup_md_line(line)
-    if line.startswith('[//]: # (') and line.endswith(')'):
-      print('{}:{}: Ignoring markdown comment: {}'.format(md_file_stripped, line_number, line[9:-1]))
-      content[i] = '' # needed to not mess up line numbers.
-    #print(content[i])
-          
-      
-    stripped_line = line.strip()
-    if stripped_line.startswith('#') and (len(stripped_line) <= 1 or stripped_line[1] != '#'):
-      page['headline'] = stripped_line[2:]
-    elif stripped_line.startswith('##') and (len(stripped_line) <= 2 or stripped_line[2] != '#'):
-      page['headline_l2'] = stripped_line[3:]
-
-  image_lines = []
-  image_line_numbers = []
-  content_lines = []
-  content_line_numbers = []
-  page_lengths = []
-
-  # TODO: extract images, even if line does not start with image.
-
-  for i,line in enumerate(content):
-    stripped_line = line.strip()
-    if stripped_line.startswith('!['):
-      image_lines.append(line)
-      image_line_numbers.append(line_number+i)
+def get_alignment(formatting, section='text'):
+  # title_align, text_align
+  key = '{}_align'.format(section)
+  return formatting.get(key, 'left')  
+
+def default_formatting(script_home, config=None):
+  # the built-in defaults, config.yaml next to the script and config (a dict) on top.
+  formatting = layered_config({'layout': default_layout, 'crop_images': default_crop, 'dimensions': default_dimensions})
+  config_file = os.path.join(script_home, 'config.yaml')
+  if os.path.exists(config_file):
+    log.debug('Reading default config in %s.', config_file)
+    with open(config_file, 'r') as f:
+      default_config = yaml.safe_load(f.read())
+    formatting = formatting.overlay(default_config, config_file)
+  return formatting.overlay(config, 'config')
+
+def parse_deck(md_contents, formatting, md_file_stripped, incremental_steps):
+  # PARSING. ONE SLIDE PER HEADLINE, WITH ITS CONFIGURATION. INCREMENTAL
+  # BULLETS TURN A SLIDE INTO SEVERAL PAGES.
+  slides, formatting = parse_slides(md_contents, formatting, md_file_stripped)
+  pages = []
+  for slide in slides:
+    pages += slide.pages(incremental_steps)
+  headlines = [page.headline for page in pages if not page.hidden]
+  log.debug('headlines %s', headlines)
+  return pages, headlines, formatting
+
+def resolve_assets(pages, assets):
+  # images and background images named in the markdown become the local files
+  # assets maps them to. Those it does not know are left as they are, and
+  # reported as missing when the page is laid out.
+  resolved = {}
+  def resolve(name):
+    if '://' in name:
+      return name
+    base = name.split('#')[0]
+    if base not in resolved:
+      resolved[base] = assets(base)
+    return name if resolved[base] is None else resolved[base]+name[len(base):]
+  seen = set()
+  for page in pages:
+    for n in page.images:
+      # the pages of incremental bullets share their nodes.
+      if n.src is not None and id(n) not in seen:
+        seen.add(id(n))
+        n.src = resolve(n.src)
+    if page.config.get('background_image'):
+      page.config = page.config.overlay({'background_image': resolve(page.config['background_image'])}, 'assets')
+
+def deck_assets(md_file):
+  # a deck refers to its files relative to its own directory, and is built
+  # next to it, whatever the working directory.
+  directory = os.path.dirname(md_file)
+  if directory == '':
+    return None
+  return lambda name: os.path.join(directory, name)
+
+def find_logo(formatting, script_home, assets=None):
+  logo_path = os.path.join(script_home,'logo.png')
+  if 'logo_path' in formatting:
+    if formatting['logo_path'] == '':
+      logo_path = None
+    elif os.path.exists(os.path.join(script_home,formatting['logo_path'])):
+      logo_path = os.path.join(script_home,formatting['logo_path'])
+    elif assets is not None:
+      logo_path = assets(formatting['logo_path'])
     else:
-      content_lines.append(line)
-      content_line_numbers.append(line_number+i)
-  page['images'] = image_lines
-  page['content'] = content_lines
-  page['line_numbers'] = content_line_numbers
-
-  #print('images', page['images'])
-  #print('content', page['content'])
-  #print('line_numbers', page['line_numbers'])
-
-  if 'incremental_bullets' not in config or not config['incremental_bullets']:
-    page_lengths = [len(content_lines)]
+      logo_path = formatting['logo_path']
+  return logo_path
+
+def render_deck(backend, pages, headlines, formatting, logo_path, script_home, md_file_stripped, cache, cache_context, raster_images, treat_as_raster_images):
+  # lays out the pages on the backend and writes its output.
+  profiler = backend.profiler
+  if logo_path is not None:
+    logo_width=18
+    logo_height=23
+    backend.set_logo(logo_path, x=formatting['dimensions']['page_width']-logo_width-formatting['dimensions']['margin_footer'], y=formatting['dimensions']['page_height']-logo_height-formatting['dimensions']['margin_footer'] , w=logo_width, h=logo_height)
+
+  # page geometry follows the document's dimensions (those in effect at its end).
+  geometry = layout_engine(formatting['dimensions'])
+
+  document_title = headlines[0] if len(headlines) else ''
+  if document_title == '':
+    document_title = 'PYMD HTML SLIDES'
+
+  # MAIN PROCESSING LOOP.
+
+  #print('\n'.join(preprocessed_md_contents))
+  profiler.begin_phase('slides')
+  display_page_number = 1
+  for page_number, page in enumerate(pages):
+    if page.hidden:
+      log.debug('%s:%s: This page is hidden. Will not generate page.', md_file_stripped, page.first_line())
+      continue
+    #print(page['headline'])
+    #print(yaml.dump(page['config']))
+    # supporting single asterixes for italics in markdown.
+
+    with profiler.slide(display_page_number, page.first_line()+1, page.headline):
+      fragment = None
+      if cache.enabled:
+        fingerprint = cache.fingerprint(page, headlines, display_page_number, cache_context)
+        fragment = cache.get(fingerprint)
+      if fragment is not None and backend.add_cached_page(fragment):
+        log.debug('%s:%s: reusing cached page (#) %s', md_file_stripped, page.first_line(), page_number)
+        cache.put(fingerprint, fragment, reused=True)
+        profiler.mark_cached()
+      else:
+        log.debug('%s:%s: generating page (#) %s', md_file_stripped, page.first_line(), page_number)
+        dump_page_content(backend, geometry, page, headlines, raster_images, treat_as_raster_images, md_file_stripped, display_page_number)
+        if page.incremental_steps:
+          backend.add_incremental_steps()
+        if cache.enabled:
+          cache.put(fingerprint, backend.get_page_fragment())
+    display_page_number += 1
+    trace('------------------------------------')
+
+
+  # POST PROCESSING. LOGGING GIT COMMIT.
+  profiler.begin_phase('metadata')
+
+  git_commit = get_git_commit(script_home)
+
+  backend.set_title(document_title)
+  backend.set_producer('pymdslides, git commit: '+git_commit+' https://github.com/olofmogren/pymdslides/')
+  backend.set_creator('pymdslides, git commit: '+git_commit+' https://github.com/olofmogren/pymdslides/')
+  backend.set_creation_date(datetime.now(datetime.now().astimezone().tzinfo))
+
+
+  profiler.end_phase()
+  backend.output()
+
+def build_deck(md_file, argv, images=None):
+  # builds one deck. argv holds the command line options; images is the
+  # image cache, shared by the decks of a batch.
+  profiler = build_profiler('--profile' in argv)
+  profiler.begin_phase('parse')
+  log.debug('md_file: %s', md_file)
+  output_format = 'html'
+  if '--odp' in argv:
+    log.info('Using the OpenDocument odp output format.')
+    output_format = 'odp'
+  output_file = os.path.join('.'.join(md_file.split('.')[:-1]),'index.'+output_format)
+  md_file_stripped = md_file.split('/')[-1]
+  # the html viewer reveals bullets step by step. printed output (and odp) needs a page per step.
+  incremental_steps = output_format == 'html' and '--pdf' not in argv
+
+  raster_images = False
+  if '--raster-images' in argv or output_format == 'html':
+    raster_images = True
+  if output_format == 'html':
+    treat_as_raster_images = ['svg']
   else:
-    for content_line_number,line in enumerate(content_lines):
-      stripped_line = line.strip()
-      if any([stripped_line.startswith(x) for x in ['*', '1.', '2.', '3.', '4.', '5.', '6.', '7.', '8.', '9.']]):
+    treat_as_raster_images = []
+    
+  overwrite_images = False
+  if '--overwrite-images' in argv or '-o' in argv:
+    overwrite_images = True
 
-        page_lengths.append(content_line_number+1)
+  jobs = os.cpu_count() or 1
+  if '-j' in argv:
+    jobs = int(argv[argv.index('-j')+1])
 
-  #print('page_lengths',page_lengths)
-  pages = []
-  for page_length in page_lengths:
-    p = copy.deepcopy(page)
-    p['content'] = p['content'][:page_length]
-    p['line_numbers'] = p['line_numbers'][:page_length]
-    #print('p',p)
-    pages.append(p)
-  return pages
+  script_home = os.path.dirname(os.path.realpath(__file__))
+  log.debug('script_home %s', script_home)
+
+  with open(md_file, 'r') as f:
+    md_contents = f.read()
+  formatting = default_formatting(script_home)
+
+  #print(yaml.dump(formatting))
+
+  preprocessed_md, headlines, formatting = parse_deck(md_contents, formatting, md_file_stripped, incremental_steps)
+  assets = deck_assets(md_file)
+  if assets is not None:
+    resolve_assets(preprocessed_md, assets)
+  # INITIALIZE FPDF:
+  profiler.begin_phase('setup')
+
+  if output_format == 'html':
+    log.debug('backend_html(%s, %s, %s, overwrite_images=%s, jobs=%s)', md_file_stripped, formatting, script_home, overwrite_images, jobs)
+    # headless printing to pdf does not give the viewer a chance to load images lazily.
+    lazy_images = '--pdf' not in argv and '--no-lazy-images' not in argv
+    virtual_slides = '--virtual-slides' in argv
+    # with --watch, a new character would rename the fonts and reload the viewer.
+    subset_fonts = '--no-font-subset' not in argv and '--watch' not in argv
+    prerender_math = '--prerender-math' in argv
+    stream = '--no-stream' not in argv
+    minify = '--minify' in argv
+    site_assets = None
+    if '--site-assets' in argv:
+      site_assets = os.path.abspath(argv[argv.index('--site-assets')+1])
+    backend = backend_html(md_file, formatting, script_home, overwrite_images=overwrite_images, jobs=jobs, image_cache=images, lazy_images=lazy_images, virtual_slides=virtual_slides, subset_fonts=subset_fonts, prerender_math=prerender_math, stream=stream, minify=minify, site_assets=site_assets, profiler=profiler)
+  elif output_format == 'odp':
+    log.debug('backend_odp(%s, %s, %s, overwrite_images=%s)', md_file_stripped, formatting, script_home, overwrite_images)
+    backend = backend_odp(md_file, formatting, script_home, overwrite_images=overwrite_images, profiler=profiler)
+  else:
+    raise Exception('Dude! Unknown output format: '+output_format)
+
+  logo_path = find_logo(formatting, script_home, assets)
+
+  # slides whose inputs are unchanged since the last build are reused from the cache.
+  use_cache = output_format == 'html' and '--no-cache' not in argv and not overwrite_images
+  if output_format == 'html':
+    cache = build_cache(backend.output_dir, script_home, enabled=use_cache)
+  else:
+    cache = build_cache('', script_home, enabled=False)
+  # everything besides the page itself that changes its markup.
+  cache_context = {'logo': file_signature(logo_path) if logo_path is not None else None, 'raster_images': raster_images, 'treat_as_raster_images': treat_as_raster_images, 'incremental_steps': incremental_steps}
+  if output_format == 'html':
+    cache_context.update({'lazy_images': backend.lazy_images, 'prerender_math': backend.formula_renderer is not None, 'site_assets': backend.shared_dir, 'virtual_slides': backend.virtual_slides, 'minify': backend.minify})
+
+  render_deck(backend, preprocessed_md, headlines, formatting, logo_path if output_format == 'html' else None, script_home, md_file_stripped, cache, cache_context, raster_images, treat_as_raster_images)
+  profiler.begin_phase('finish')
+  cache.save()
+  if cache.enabled:
+    log.info('build cache: %s pages reused, %s pages rendered', cache.hits, cache.misses)
+  if output_format == 'html':
+    md_cache = render_markdown.cache_info()
+    log.info('markdown cache: %s hits, %s misses (%s of %s entries used)', md_cache.hits, md_cache.misses, md_cache.currsize, md_cache.maxsize)
+
+  if '--pdf' in argv:
+    pdf_file_final = '.'.join(md_file.split('.')[:-1])+'.pdf'
+    pdf_file = '.'.join(md_file.split('.')[:-1])+'-pre-cropping.pdf'
+    pdf_file_post_cropping = '.'.join(md_file.split('.')[:-1])+'-pre-cropping-fixed-margins.pdf'
+    executables = ['chrome','chromium',None]
+    for executable in executables:
+      if executable is None:
+        log.error('found no supported browser to generate pdf. supported: %s', executables[:-1])
+        break
+      if shutil.which(executable) is not None:
+        log.debug('%s exists on the system', executable)
+        break
+    if executable is not None:
+      command = '{} --headless --disable-gpu --print-to-pdf={} {}'.format(executable, pdf_file, output_file) # output_file is the html target.
+      log.info(command)
+      os.system(command)
+
+      executables = ['pdfjam',None]
+      for executable in executables:
+        if executable is None:
+          log.error('did not find pdfjam. will not be able to fix margins in generated pdf.')
+          break
+        if shutil.which(executable) is not None:
+          log.debug('%s exists on the system', executable)
+          break
+      if executable is not None:
+        command = 'pdfjam --quiet --keepinfo --papersize \'{{159mm,89mm}}\' --trim \'2mm 1mm 1mm 1mm\' --clip true --suffix "fixed-margins" {}'.format(pdf_file)
+        log.info(command)
+        os.system(command)
+        command = 'mv {} {}'.format(pdf_file_post_cropping, pdf_file_final)
+        log.info(command)
+        os.system(command)
+
+
+
+  profiler.end_phase()
+  if profiler.enabled:
+    profiler.write_report('.'.join(md_file.split('.')[:-1])+'-profile.json')
+  return output_file
+
+
+class build_result:
+  # what build() made of a deck: the html, and the files it refers to by
+  # their path relative to it (graphics/..., resources/...). Both are None
+  # and empty when a writer took them.
+  def __init__(self, html, assets):
+    self.html = html
+    self.assets = assets
+
+  def __repr__(self):
+    return 'build_result({} bytes of html, {} assets)'.format(len(self.html or ''), len(self.assets))
+
+
+def build(markdown_text, config=None, backend='html', assets=None, writer=None, images=None, jobs=1, lazy_images=True, virtual_slides=False, subset_fonts=True, prerender_math=False, minify=False, disk_caches=True):
+  # Library api: builds a deck from markdown_text in memory and returns a
+  # build_result. No output is written to disk and nothing is read from the
+  # command line: config (a dict) is put on top of the defaults and
+  # config.yaml, as a preamble would be. assets maps a file named in the markdown (an image or
+  # the logo_path) to a local file, or to None if there is no such file;
+  # without it, names are relative to the working directory. writer, if
+  # given, is called as writer(path, data) for index.html and each asset as
+  # soon as it is done, instead of collecting them. images is an image_cache
+  # for conversions; without one they pass through temporary files. Font
+  # subsets and prerendered formulas are cached under ~/.cache/pymdslides
+  # unless disk_caches is False. Each build has its own profiler, so builds
+  # may run in several threads at once; messages go to the 'pymdslides'
+  # logger, which build() leaves for the caller to configure.
+  if backend != 'html':
+    raise ValueError('only the html backend can build in memory, not {!r}'.format(backend))
+  script_home = os.path.dirname(os.path.realpath(__file__))
+  name = 'deck'
+  pages, headlines, formatting = parse_deck(markdown_text, default_formatting(script_home, config), name, True)
+  if assets is not None:
+    resolve_assets(pages, assets)
+  publisher = memory_publisher(name, writer)
+  deck = backend_html(name+'.md', formatting, script_home, jobs=jobs, image_cache=images, lazy_images=lazy_images, virtual_slides=virtual_slides, subset_fonts=subset_fonts, prerender_math=prerender_math, stream=False, minify=minify, publisher=publisher, disk_caches=disk_caches)
+  logo_path = find_logo(formatting, script_home, assets)
+  cache = build_cache('', script_home, enabled=False)
+  render_deck(deck, pages, headlines, formatting, logo_path, script_home, name, cache, None, True, ['svg'])
+  if writer is not None:
+    return build_result(None, {})
+  html = publisher.assets.pop('index.html').decode('utf-8')
+  return build_result(html, publisher.assets)
+
+
+def open_image_cache(argv):
+  if '--no-image-cache' in argv:
+    return None
+  image_cache_dir = None
+  if '--image-cache' in argv:
+    image_cache_dir = argv[argv.index('--image-cache')+1]
+  image_cache_size = DEFAULT_MAX_SIZE_MB
+  if '--image-cache-size' in argv:
+    image_cache_size = int(argv[argv.index('--image-cache-size')+1])
+  return image_cache(image_cache_dir, image_cache_size)
+
+# options followed by a value, which is not an input file.
+OPTIONS_WITH_VALUES = ['-j', '--image-cache', '--image-cache-size', '--batch-jobs', '--site-assets', '--socket', '--port']
+# options naming a directory, made absolute before batch builds change directory.
+PATH_OPTIONS = ['--image-cache', '--site-assets']
+
+def absolute_paths(argv):
+  argv = list(argv)
+  for option in PATH_OPTIONS:
+    if option in argv:
+      i = argv.index(option)+1
+      argv[i] = os.path.abspath(argv[i])
+  return argv
+
+def input_files(argv):
+  # the markdown files named on the command line, with patterns expanded
+  # (quoted, so that the shell leaves them alone, or on systems without one).
+  md_files = []
+  skip = False
+  for arg in argv[1:]:
+    if skip:
+      skip = False
+      continue
+    if arg in OPTIONS_WITH_VALUES:
+      skip = True
+      continue
+    if arg.startswith('-') or arg in ['html', 'odp']:
+      continue
+    if any([c in arg for c in '*?[']):
+      md_files += sorted(glob.glob(arg))
+      continue
+    if not arg.endswith('.md'):
+      arg += '.md'
+    md_files.append(arg)
+  return md_files
+
+worker_images = {}
+
+def init_batch_worker(argv):
+  setup_logging(argv)
+
+def build_batch_worker(md_file, argv):
+  # runs in a worker process, which keeps its image cache between decks.
+  if 'images' not in worker_images:
+    worker_images['images'] = open_image_cache(argv)
+  return build_batch_deck(md_file, argv, worker_images['images'])
+
+def build_batch_deck(md_file, argv, images):
+  start = time.time()
+  try:
+    build_deck(md_file, argv, images)
+    return (md_file, None, time.time()-start)
+  except Exception as e:
+    log.error('%s: build failed: %s', md_file, e)
+    log.debug(traceback.format_exc())
+    return (md_file, str(e) or type(e).__name__, time.time()-start)
+
+def build_batch(md_files, argv):
+  # builds several decks in one process, or in --batch-jobs worker processes.
+  # Imports, the markdown and git caches and the image cache are shared by
+  # the decks a process builds. Returns the exit status.
+  start = time.time()
+  batch_jobs = 1
+  if '--batch-jobs' in argv:
+    batch_jobs = max(1, int(argv[argv.index('--batch-jobs')+1]))
+  argv = absolute_paths(argv)
+  results = []
+  if batch_jobs == 1:
+    images = open_image_cache(argv)
+    for md_file in md_files:
+      log.info('building %s', md_file)
+      results.append(build_batch_deck(md_file, argv, images))
+  else:
+    if '-j' not in argv:
+      # image conversion threads are split between the workers.
+      argv = argv+['-j', str(max(1, (os.cpu_count() or 1)//batch_jobs))]
+    with ProcessPoolExecutor(max_workers=batch_jobs, initializer=init_batch_worker, initargs=(argv,)) as executor:
+      results = list(executor.map(build_batch_worker, md_files, [argv]*len(md_files)))
+  failed = [(md_file, error) for md_file, error, seconds in results if error is not None]
+  for md_file, error, seconds in results:
+    log.info('  %-40s %-6s %7.2f s', md_file, 'failed' if error is not None else 'ok', seconds)
+  log.info('batch: %s of %s decks built in %.2f s using %s process%s', len(results)-len(failed), len(results), time.time()-start, batch_jobs, 'es' if batch_jobs > 1 else '')
+  for md_file, error in failed:
+    log.error('%s: %s', md_file, error)
+  return 1 if len(failed) else 0
+
+def run(argv, images=None):
+  # one invocation: builds the input files named in argv and returns the
+  # exit status. images is an image cache to use instead of opening one.
+  md_files = input_files(argv)
+  if len(md_files) == 0:
+    log.error('no input files. See pymdslides --help.')
+    return 2
+  if '--watch' in argv:
+    if len(md_files) != 1:
+      log.error('--watch takes one input file.')
+      return 2
+    return watch(md_files[0], argv)
+  if len(md_files) == 1 and '--batch-jobs' not in argv:
+    build_deck(md_files[0], argv, images if images is not None else open_image_cache(argv))
+    return 0
+  return build_batch(md_files, argv)
+
+def watched_files(md_file):
+  # what a deck is built from: the markdown, config.yaml, the logo and the images it refers to.
+  script_home = os.path.dirname(os.path.realpath(__file__))
+  files = [md_file, os.path.join(script_home, 'config.yaml')]
+  try:
+    with open(md_file, 'r') as f:
+      md_contents = f.read()
+    pages, headlines, formatting = parse_deck(md_contents, default_formatting(script_home), md_file.split('/')[-1], True)
+  except (OSError, SyntaxError, ValueError):
+    return files
+  assets = deck_assets(md_file)
+  if assets is not None:
+    resolve_assets(pages, assets)
+  logo_path = find_logo(formatting, script_home, assets)
+  if logo_path is not None:
+    files.append(logo_path)
+  for page in pages:
+    files += [f.split('#')[0] for f in referenced_files(page) if '://' not in f and f.split('#')[0] not in files]
+  return files
+
+def watch(md_file, argv):
+  # --watch: builds the deck whenever its inputs change (only the slides
+  # that changed are rendered again, thanks to the build cache) and serves it
+  # with live updates.
+  port = 8000
+  if '--port' in argv:
+    port = int(argv[argv.index('--port')+1])
+  images = open_image_cache(argv)
+  return live_reload.watch(lambda: build_deck(md_file, argv, images), lambda: watched_files(md_file), port)
+
+daemon_images = {}
+
+def daemon_build(argv):
+  # one invocation forwarded to the daemon, in the client's directory. The
+  # image caches stay open between builds.
+  argv = absolute_paths(argv)
+  key = tuple(argv[argv.index(o)+1] if o in argv else None for o in ['--image-cache', '--image-cache-size'])
+  images = None
+  if '--no-image-cache' not in argv:
+    if key not in daemon_images:
+      daemon_images[key] = open_image_cache(argv)
+    images = daemon_images[key]
+  return run(argv, images)
 
-def get_alignment(formatting, section='text'):
-  # title_align, text_align
-  key = '{}_align'.format(section)
-  return formatting.get(key, 'left')  
 
 if __name__ == "__main__":
   if "--help" in sys.argv:
     print('''pymdslides usage
-pymdslides [options] inputfile.md
+pymdslides [options] inputfile.md [inputfile.md ...]
 
 options:
   --help             - print this message and exit
   --pdf              - produce a pdf output file
   --raster-images    - generate raster images from vector images
   --overwrite-images - overwrite images in target directory
+  --no-cache         - render every slide, ignoring the per-slide build cache
+  -j N               - convert images using N parallel workers (default: number of cpus)
+  --image-cache DIR  - directory for converted images shared between decks
+                       (default: ~/.cache/pymdslides/images)
+  --image-cache-size MB - size limit of the image cache (default: 1024)
+  --no-image-cache   - convert images directly into the output directory
+  --no-lazy-images   - load all images when the html is opened, not only
+                       those of the slides around the current one
+  --virtual-slides   - emit slides as inert templates that the viewer only
+                       instantiates around the current slide (for very large decks)
+  --no-font-subset   - ship the full fonts instead of subsets with the
+                       characters used in the deck (--watch always does)
+  --prerender-math   - render formulas to svg at build time (requires matplotlib);
+                       MathJax is only included for formulas it can not handle
+  --profile          - time each build phase and each slide, print the slowest
+                       slides and write a report to inputfile-profile.json
+  --no-stream        - keep the whole document in memory until it is written,
+                       instead of writing finished slides to disk as it goes
+  --minify           - write the html without indentation
+  --site-assets DIR  - put fonts, mathjax, css, javascript and the logo in DIR,
+                       shared by all decks built with the same DIR
+  --batch-jobs N     - build the input files in N worker processes (default: 1)
+  --daemon           - keep running and build decks for the pymd client, which
+                       forwards its builds to the daemon when it is running
+  --socket PATH      - the daemon's unix socket
+                       (default: $XDG_RUNTIME_DIR/pymdslides-UID.sock)
+  --no-daemon        - (pymd) build in a new process even if a daemon is running
+  --watch            - build again whenever the input file, config.yaml or an
+                       image it refers to changes, and serve the deck over http;
+                       open viewers are updated in place
+  --port N           - the port for --watch (default: 8000)
+  -q                 - only print warnings and errors
+  -v, -vv            - more verbose output: one line per slide (-v), or
+                       one line per element on every slide (-vv)
+
+  Several input files (or quoted patterns such as 'lectures/*.md') are built
+  in one process, sharing its caches, followed by a summary. The exit status
+  is non-zero if any of them failed.
 
   Input files are formatted using markdown. you can configure the processing
   using yaml snippets either in the beginning of the file (global scope) or
@@ -714,7 +919,7 @@ options:
       -- colors are coded with RGB, 0-255, or with names, or with html hex strings (but these require quotation marks).
   * logo_path: logo_path.png
   * columns: integer_value, the number of columns for content
-  * incremental_bullets: true|**false**
+  * incremental_bullets: true|steps|**false**
   * l4_box_fill_color:
       - 230
       - 240
@@ -755,224 +960,7 @@ Available colors: white, grey, black, orange, red, green, blue, yellow, purple,
   ''');
     sys.exit()
 
-  md_file = ''
-  for i in range(len(sys.argv)-1, 0, -1):
-    md_file = sys.argv[i]
-    if md_file.startswith('--') or md_file == 'html' or md_file == 'odp':
-      continue
-    else:
-      break
-  print('md_file:',md_file)
-  output_format = 'html'
-  if '--odp' in sys.argv:
-    print('Using the OpenDocument odp output format.')
-    output_format = 'odp'
-  if not md_file.endswith('.md'):
-    md_file += '.md'
-  output_file = os.path.join('.'.join(md_file.split('.')[:-1]),'index.'+output_format)
-  md_file_stripped = md_file.split('/')[-1]
-
-  raster_images = False
-  if '--raster-images' in sys.argv or output_format == 'html':
-    raster_images = True
-  if output_format == 'html':
-    treat_as_raster_images = ['svg']
-  else:
-    treat_as_raster_images = []
-    
-  overwrite_images = False
-  if '--overwrite-images' in sys.argv or '-o' in sys.argv:
-    overwrite_images = True
-  
-  script_home = os.path.dirname(os.path.realpath(__file__))
-  print('script_home', script_home)
-
-  document_title = ""
-
-  with open(md_file, 'r') as f:
-    md_contents = f.read()
-  content = []
-  # default formatting:
-  formatting = {'layout': default_layout, 'crop_images': default_crop, 'dimensions': default_dimensions}
-  #print('initial formatting', yaml.dump(formatting))
-  config_file = os.path.join(script_home, 'config.yaml')
-  if os.path.exists(config_file):
-    print('Reading default config in {}.'.format(config_file))
-    with open(config_file, 'r') as f:
-      default_config = yaml.safe_load(f.read())
-    formatting = recursive_dict_update(formatting, default_config)
-
-  #print(yaml.dump(formatting))
-
-  # PREPROCESSING LOOP. TAKE CARE OF CONFIGURATION AND INCREMENTAL BULLETS.
-  # will produce a list preprocessed_md of one dict per page.
-  # d = {headline: str, headline_h2: str, lines: [str], line_numbers: [int], config: str}
-  #
-  # will also produce one list headlines and one list headlines_h2
-  
-
-  global_formatting = {}
-  md_contents_lines = md_contents.split('\n')
-
-  preamble=True
-  current_yaml = ''
-  page_number = 0
-
-  preprocessed_md = []
-
-  previous_headline = -1
-  
-  for line_number,line in enumerate(md_contents_lines):
-    if current_yaml:
-      # this line contains a continuation of yaml content. Parsing later.
-      current_yaml += '\n'+line
-      #print('current_yaml',current_yaml)
-    elif line.startswith('#') and (len(line) <= 1 or line[1] != '#'):
-      if preamble:
-        # formatting from preamble is global for whole document:
-        #print('preamble. setting global formatting')
-        global_formatting = copy.deepcopy(formatting)
-        content = [line]
-        preamble = False
-      else:
-        #print(yaml.dump(formatting))
-        preprocessed = preprocess_md_page(content, previous_headline, formatting)
-        #print('preprocessed',preprocessed)
-        preprocessed_md += preprocessed
-        # reset to global config.
-        formatting = copy.deepcopy(global_formatting)
-        content = [line]
-      print('headline',line)
-      previous_headline = line_number
-      #current_headline = line[2:]
-    elif line == '---':
-      # this line begins yaml content. Parsing later.
-      current_yaml = line
-      #print('current_yaml',current_yaml)
-    else:
-      content.append(line)
-    if len(current_yaml) > 3 and current_yaml[-3:] == '---':
-      # this and possibly preceding lines has contained yaml content. Parse formatting yaml:
-      current_yaml = current_yaml[3:-3] # remove beginning and ending three dashes (syntax)
-      try:
-        new_formatting = yaml.safe_load(current_yaml)
-        if new_formatting is not None:
-          #formatting.update(new_formatting)
-          formatting = recursive_dict_update(formatting, new_formatting)
-          #print('formatting', formatting)
-          print('{}:{}: Updating formatting from Yaml syntax: \n  {}'.format(md_file_stripped, line_number, current_yaml.replace('\n', '\n  ')))
-          #print(yaml.dump(formatting))
-        else:
-          print('{}:{}: Ignoring Yaml formatting configuration: \n  {}'.format(md_file_stripped, line_number, current_yaml.replace('\n', '\n  ')))
-      except Exception as e:
-        #print(e)
-        raise SyntaxError('Line '+str(line_number)+': Incorrect YAML formatting information: '+current_yaml+'\nMore information: '+str(e))
-      current_yaml = '' # reset yaml. Next line is not a continuation of a yaml configuration.
-
-  # last page:
-  preprocessed = preprocess_md_page(content, previous_headline, formatting)
-  #print('preprocessed',preprocessed)
-  preprocessed_md += preprocessed
-
-  headlines = []
-  headlines_h2 = []
-  for page in preprocessed_md:
-    if 'hidden' in page['config'] and page['config']['hidden']:
-      continue
-    headlines.append(page['headline'])
-    headlines_h2.append(page['headline_h2'])
-    if headlines[-1] == '':
-      headlines[-1] = headlines_h2[-1]
-  print('headlines',headlines)
-
-  document_title = headlines[0]+' '+headlines_h2[0].strip()
-  if document_title == '':
-    document_title = 'PYMD HTML SLIDES'
-  # INITIALIZE FPDF:
-
-  if output_format == 'html':
-    print('backend_html('+md_file_stripped, formatting, script_home+', overwrite_images='+str(overwrite_images)+')')
-    backend = backend_html(md_file_stripped, formatting, script_home, overwrite_images=overwrite_images)
-  elif output_format == 'odp':
-    print('backend_odp('+md_file_stripped, formatting, script_home+', overwrite_images='+str(overwrite_images)+')')
-    backend = backend_odp(md_file_stripped, formatting, script_home, overwrite_images=overwrite_images)
-  else:
-    raise Exception('Dude! Unknown output format: '+output_format)
-
-  logo_path = os.path.join(script_home,'logo.png')
-  if 'logo_path' in formatting:
-    if formatting['logo_path'] == '':
-      logo_path = None
-    elif os.path.exists(os.path.join(script_home,formatting['logo_path'])):
-      logo_path = os.path.join(script_home,formatting['logo_path'])
-    else:
-      logo_path = formatting['logo_path']
-  if output_format == 'html':
-    logo_width=18
-    logo_height=23
-    if logo_path is not None:
-      backend.set_logo(logo_path, x=formatting['dimensions']['page_width']-logo_width-formatting['dimensions']['margin_footer'], y=formatting['dimensions']['page_height']-logo_height-formatting['dimensions']['margin_footer'] , w=logo_width, h=logo_height)
-
-  # MAIN PROCESSING LOOP.
-
-  #print('\n'.join(preprocessed_md_contents))
-  display_page_number = 1
-  for page_number, page in enumerate(preprocessed_md):
-    if 'hidden' in page['config'] and page['config']['hidden']:
-      print('------------------------------------\n{}:{}: This page is hidden. Will not generate page.'.format(md_file_stripped, page['line_numbers'][0]))
-      continue
-    #print(page['headline'])
-    #print(yaml.dump(page['config']))
-    # supporting single asterixes for italics in markdown.
-
-    print('{}:{}: generating page (#) {}'.format(md_file_stripped, page['line_numbers'][-1], page_number))
-    dump_page_content(backend, page['images']+page['content'], page['config'], headlines, raster_images, treat_as_raster_images, md_file_stripped, page['line_numbers'][0], display_page_number)
-    display_page_number += 1
-    print('------------------------------------')
-
-
-  # POST PROCESSING. LOGGING GIT COMMIT.
-
-  git_commit = get_git_commit(script_home)
-
-  backend.set_title(document_title)
-  backend.set_producer('pymdslides, git commit: '+git_commit+' https://github.com/olofmogren/pymdslides/')
-  backend.set_creator('pymdslides, git commit: '+git_commit+' https://github.com/olofmogren/pymdslides/')
-  backend.set_creation_date(datetime.now(datetime.now().astimezone().tzinfo))
-
-  backend.output()
-
-  if '--pdf' in sys.argv:
-    pdf_file_final = '.'.join(md_file.split('.')[:-1])+'.pdf'
-    pdf_file = '.'.join(md_file.split('.')[:-1])+'-pre-cropping.pdf'
-    pdf_file_post_cropping = '.'.join(md_file.split('.')[:-1])+'-pre-cropping-fixed-margins.pdf'
-    executables = ['chrome','chromium',None]
-    for executable in executables:
-      if executable is None:
-        print('error: found no supported browser to generate pdf. supported: {}'.format(executables[:-1]))
-        break
-      if shutil.which(executable) is not None:
-        print('{} exists on the system'.format(executable))
-        break
-    if executable is not None:
-      command = '{} --headless --disable-gpu --print-to-pdf={} {}'.format(executable, pdf_file, output_file) # output_file is the html target.
-      print(command)
-      os.system(command)
-
-      executables = ['pdfjam',None]
-      for executable in executables:
-        if executable is None:
-          print('error: did not find pdfjam. will not be able to fix margins in generated pdf.')
-          break
-        if shutil.which(executable) is not None:
-          print('{} exists on the system', executable)
-          break
-      if executable is not None:
-        command = 'pdfjam --quiet --keepinfo --papersize \'{{159mm,89mm}}\' --trim \'2mm 1mm 1mm 1mm\' --clip true --suffix "fixed-margins" {}'.format(pdf_file)
-        print(command)
-        os.system(command)
-        command = 'mv {} {}'.format(pdf_file_post_cropping, pdf_file_final)
-        print(command)
-        os.system(command)
-
-
+  setup_logging(sys.argv)
+  if '--daemon' in sys.argv:
+    sys.exit(build_daemon.serve(build_daemon.socket_path(sys.argv), daemon_build))
+  sys.exit(run(sys.argv))
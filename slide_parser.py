@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+import re
+import yaml
+
+from log import log, trace
+
+# node kinds.
+TITLE = 'title'           # '# ', the slide headline
+SUBTITLE = 'subtitle'     # '## '
+BOX_TITLE = 'box_title'   # '#### ', starts a box holding the following lines
+HEADING = 'heading'       # '###' and '#####'..., rendered as text lines
+IMAGE = 'image'           # '![alt](src)' on a line of its own
+TEXT = 'text'
+
+# single asterisks mean italics; markdown2 wants underscores for that.
+SINGLE_ASTERISK = re.compile(r'(?<![\\*])\*(?![\*\s])')
+LIST_ITEM = re.compile(r'\*|[1-9]\.')
+COMMENT_PREFIX = '[//]: # ('
+
+
+class node:
+  # one source line of a slide. source is the line after cleanup, as the
+  # renderer sees it; text is the payload (headline text, or the line).
+  __slots__ = ('kind', 'text', 'source', 'line', 'alt', 'src')
+
+  def __init__(self, kind, text, source, line, alt=None, src=None):
+    self.kind = kind
+    self.text = text
+    self.source = source
+    self.line = line
+    self.alt = alt
+    self.src = src
+
+  def __repr__(self):
+    return 'node({}, {!r}, line={})'.format(self.kind, self.text, self.line)
+
+
+class slide:
+  # one '# ' headline and everything up to the next one. Image lines are kept
+  # apart from the content, as images are placed by the layout and not in the
+  # text flow. line is the 0-based source line of the headline (-1 for a
+  # document without headlines).
+  def __init__(self, headline, subtitle, line, config, images, content):
+    self.headline = headline
+    self.subtitle = subtitle
+    self.line = line
+    self.config = config
+    self.images = images
+    self.content = content
+    self.incremental_steps = False
+
+  @property
+  def hidden(self):
+    return bool(self.config.get('hidden', False))
+
+  def nodes(self):
+    return self.images+self.content
+
+  def source_lines(self):
+    return [n.source for n in self.images+self.content]
+
+  def first_line(self):
+    # the headline, unless there is only an image (no headline at all).
+    return self.content[0].line if len(self.content) else self.line
+
+  def pages(self, incremental_steps=False):
+    # the slide as it is rendered: one page, or with incremental_bullets one
+    # page per list item, each showing the content up to that item. The pages
+    # share the config and the nodes with the slide.
+    incremental = self.config.get('incremental_bullets', False)
+    if not incremental:
+      lengths = [len(self.content)]
+    elif incremental == 'steps' and incremental_steps:
+      lengths = [len(self.content)]
+    else:
+      lengths = [i+1 for i,n in enumerate(self.content) if LIST_ITEM.match(n.source.strip())]
+    pages = []
+    for length in lengths:
+      p = slide(self.headline, self.subtitle, self.line, self.config, self.images, self.content[:length])
+      p.incremental_steps = incremental == 'steps' and incremental_steps
+      pages.append(p)
+    return pages
+
+
+def cleanup_md_line(line):
+  line = SINGLE_ASTERISK.sub('__', line)
+  if '$' in line:
+    splits = line.split('$')
+    # inside formulas, the asterisks were not italics.
+    for i in range(1, len(splits), 2):
+      if '__' in splits[i]:
+        splits[i] = splits[i].replace('__', '*')
+    line = '$'.join(splits)
+  return line
+
+
+def heading_level(line):
+  return len(line)-len(line.lstrip('#'))
+
+
+def classify(raw_line, line_number, filename):
+  # returns (node, is_image_line).
+  if raw_line.startswith(COMMENT_PREFIX) and raw_line.endswith(')'):
+    log.debug('%s:%s: Ignoring markdown comment: %s', filename, line_number, raw_line[9:-1])
+    # kept as an empty line, which separates paragraphs like the comment did.
+    return node(TEXT, '', '', line_number), False
+  line = cleanup_md_line(raw_line)
+  stripped = line.strip()
+  if stripped.startswith('!['):
+    alt = src = None
+    if stripped.endswith(')') and '](' in stripped[2:-1]:
+      alt, src = stripped[2:-1].split('](', 1)
+    # only unindented image lines are placed by the layout; others are text,
+    # but the file is still referenced.
+    kind = IMAGE if src is not None and line == stripped else TEXT
+    return node(kind, line, line, line_number, alt=alt, src=src), True
+  level = heading_level(line)
+  if level == 1:
+    return node(TITLE, line[2:], line, line_number), False
+  if level == 2:
+    return node(SUBTITLE, line[3:], line, line_number), False
+  if level == 4:
+    return node(BOX_TITLE, line[5:], line, line_number), False
+  if level > 0:
+    return node(HEADING, line, line, line_number), False
+  return node(TEXT, line, line, line_number), False
+
+
+def parse_slides(md_contents, config, filename=''):
+  # Walks the markdown once. config is a layered_config with the defaults.
+  # Returns the slides and the config in effect at the end of the document.
+  # yaml blocks (between '---' lines) before the first headline add a layer
+  # for the whole document, those after a headline one for that slide only.
+  # Text before the first headline is ignored.
+  global_config = config
+  slides = []
+  current = None
+  preamble = []
+  current_yaml = None
+
+  def add(current, line_number, line):
+    n, is_image = classify(line, line_number, filename)
+    (current.images if is_image else current.content).append(n)
+    # indented headlines do not start a new slide, but still name it.
+    stripped = line.strip()
+    level = heading_level(stripped)
+    if level == 1:
+      current.headline = stripped[2:]
+    elif level == 2:
+      current.subtitle = stripped[3:]
+
+  for line_number,line in enumerate(md_contents.split('\n')):
+    if current_yaml is not None:
+      current_yaml.append(line)
+      if not line.endswith('---'):
+        continue
+      # this and possibly preceding lines have contained yaml content.
+      yaml_source = '\n'.join(current_yaml)[3:-3]
+      current_yaml = None
+      try:
+        new_formatting = yaml.safe_load(yaml_source)
+        if new_formatting is not None:
+          config = config.overlay(new_formatting, '{}:{}'.format(filename, line_number))
+      except Exception as e:
+        raise SyntaxError('Line '+str(line_number)+': Incorrect YAML formatting information: '+yaml_source+'\nMore information: '+str(e))
+      if new_formatting is not None:
+        log.debug('%s:%s: Updating formatting from Yaml syntax: \n  %s', filename, line_number, yaml_source.replace('\n', '\n  '))
+      else:
+        log.warning('%s:%s: Ignoring Yaml formatting configuration: \n  %s', filename, line_number, yaml_source.replace('\n', '\n  '))
+      continue
+    if line == '---':
+      current_yaml = [line]
+    elif line.startswith('#') and (len(line) <= 1 or line[1] != '#'):
+      trace('headline %s', line)
+      if current is None:
+        # formatting from the preamble is global for the whole document.
+        global_config = config
+      else:
+        current.config = config
+        slides.append(current)
+        config = global_config
+      current = slide('', '', line_number, None, [], [])
+      add(current, line_number, line)
+    elif current is None:
+      preamble.append((line_number, line))
+    else:
+      add(current, line_number, line)
+
+  if current is None:
+    # no headline: the whole document is one slide.
+    current = slide('', '', -1, None, [], [])
+    for line_number,line in preamble:
+      add(current, line_number, line)
+  current.config = config
+  slides.append(current)
+  return slides, config